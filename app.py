@@ -1,29 +1,74 @@
+import startup
 import os
 import json
+import logging
+import threading
+import time
+import uuid
 import requests
+import click
 from io import BytesIO
 from flask import Flask, request, jsonify, send_from_directory, make_response, render_template_string, session, redirect
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import configure_mappers
 from flask_login import current_user
 from datetime import datetime, date, timedelta
 from werkzeug.middleware.proxy_fix import ProxyFix
-from openai import OpenAI
-import stripe
 
-from models import Base, JournalEntry, User, OAuth, GuestUsage, GuestTotalUsage, BookingRequest, DiscoverySession, OracleReading, TIER_FREE, TIER_BASIC, TIER_PREMIUM
+from models import Base, JournalEntry, User, OAuth, BookingRequest, DiscoverySession, OracleReading, StripeWebhookEvent, WEBHOOK_DEAD, TIER_FREE, TIER_BASIC, TIER_PREMIUM
 from replit_auth import make_replit_blueprint, require_login, init_login_manager
-from stripe_client import get_stripe_client, get_stripe_publishable_key, get_stripe_credentials
+from stripe_client import get_stripe_client, get_stripe_publishable_key, get_stripe_credentials, reset_after_fork as reset_stripe_http_client
+from connector_credentials import get_cached_credential, get_credential_metrics, reset_after_fork as reset_connector_state
+from stripe_catalog import get_catalog_snapshot, handle_catalog_event, sync_catalog, warm_catalog, resolve_tier, upsert_product
+from webhook_inbox import parse_event, enqueue_event, drain_until_idle, replay_events, inbox_stats, purge_old_events, start_worker as start_webhook_worker
+from stripe_customers import provision_customer, schedule_customer_provisioning, provision_missing_customers, create_session as create_stripe_session
+from subscription_reconcile import reconcile_subscriptions
+from quota import consume_user_decoder_use, consume_guest_decoder_use, guest_decoder_uses, consume_guide_message, buffers_usage, pending_guide_tokens, guide_allowance, DECODER_FREE_LIMIT
+from usage_buffer import start_flusher as start_usage_flusher
+from entitlements import entitled_user, display_name, refresh_entitlements_cookie
+from data_version import install as install_data_versions, versioned_json
+import schema_migrations
+import db_pool
+import db_routing
+from db_routing import replica_reads
+import request_metrics
+import tracing
+import structured_log
+import profiler
+import query_audit
+from query_audit import query_budget
+from guest_retention import purge_guest_data, partition_guest_usage, table_sizes, vacuum_tables
+from guide_metering import get_daily_token_budget, usage_from_completion, record_guide_usage, tier_spend_report, user_daily_usage
 
 AI_INTEGRATIONS_OPENAI_API_KEY = os.environ.get("AI_INTEGRATIONS_OPENAI_API_KEY")
 AI_INTEGRATIONS_OPENAI_BASE_URL = os.environ.get("AI_INTEGRATIONS_OPENAI_BASE_URL")
 
-openai_client = None
-if AI_INTEGRATIONS_OPENAI_API_KEY and AI_INTEGRATIONS_OPENAI_BASE_URL:
-    openai_client = OpenAI(
-        api_key=AI_INTEGRATIONS_OPENAI_API_KEY,
-        base_url=AI_INTEGRATIONS_OPENAI_BASE_URL
-    )
+structured_log.configure()
+logger = logging.getLogger(__name__)
+
+startup.mark('imports')
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """OpenAI client, built on first use (the SDK is slow to import), or None
+    when the AI integration is not configured"""
+    global _openai_client
+    if _openai_client is None and AI_INTEGRATIONS_OPENAI_API_KEY and AI_INTEGRATIONS_OPENAI_BASE_URL:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import OpenAI, DefaultHttpxClient
+                _openai_client = OpenAI(
+                    api_key=AI_INTEGRATIONS_OPENAI_API_KEY,
+                    base_url=AI_INTEGRATIONS_OPENAI_BASE_URL,
+                    # Count each HTTP attempt, so spans report the SDK's retries
+                    http_client=DefaultHttpxClient(event_hooks={'request': [tracing.note_attempt]})
+                )
+    return _openai_client
+
 
 SOULART_GUIDE_SYSTEM_PROMPT = """You are the SoulArt Guide, a gentle and compassionate AI companion within SoulArt Temple - a spiritual wellness application focused on emotional healing and self-therapy.
 
@@ -50,7 +95,7 @@ Always structure your response with:
 
 Remember: You are a supportive mirror, not an authority. Help users connect with their own inner knowing."""
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': db_routing.RoutingSession})
 
 app = Flask(__name__, static_folder='.')
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -58,26 +103,53 @@ CORS(app)
 
 app.secret_key = os.environ.get("SESSION_SECRET") or os.environ.get("FLASK_SECRET_KEY") or "soulart-temple-secret-key"
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = db_pool.engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+app.config["SQLALCHEMY_BINDS"] = db_routing.bind_config(db_pool.engine_options)
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 app.config["SESSION_COOKIE_SECURE"] = False  # Set to True if using HTTPS only
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 
 db.init_app(app)
+with app.app_context():
+    for engine in db.engines.values():
+        db_pool.install(engine)
+    db_routing.install(db)
+    request_metrics.install(app, db.engines.values())
+    query_audit.install(app, db.engines.values())
+tracing.install(app)
+structured_log.install(app)
+profiler.install(app)
 
 init_login_manager(app, db, User)
+install_data_versions()
 
-app.register_blueprint(make_replit_blueprint(db, User, OAuth), url_prefix="/auth")
+def provision_stripe_customer_later(user):
+    """Create the user's Stripe customer in the background after sign-up/login"""
+    if user.email and not user.stripe_customer_id:
+        schedule_customer_provisioning(app, db, user.id, get_stripe_client)
+
+app.register_blueprint(make_replit_blueprint(db, User, OAuth, on_user_saved=provision_stripe_customer_later), url_prefix="/auth")
 
 DEMO_ACCESS_TOKEN = os.environ.get("DEMO_ACCESS_TOKEN", "")
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+startup.mark('app configured')
+
+@app.before_request
+def note_first_request():
+    if startup.run_once('first request', lambda: startup.mark('first request')):
+        logger.info("Startup timeline: %s", startup.summary(), extra={'event': 'startup.first_request'})
+        if startup.LAZY_INIT:
+            # Off the request path, so the first response is not held up
+            threading.Thread(target=start_background_work, name='lazy-init', daemon=True).start()
 
 @app.before_request
 def make_session_permanent():
     session.permanent = True
 
+app.after_request(refresh_entitlements_cookie)
+app.after_request(db_routing.remember_writes)
+
 @app.after_request
 def add_cache_control_headers(response):
     if request.path.endswith(('.html', '.css', '.js')):
@@ -123,28 +195,35 @@ def activate_demo_mode(token):
     else:
         return "Invalid demo token", 403
 
-with app.app_context():
-    db.create_all()
-
-@app.route('/api/auth/check', methods=['GET'])
-def check_auth():
-    if current_user.is_authenticated:
-        return jsonify({
+# With LAZY_INIT the schema is managed by `flask schema apply` at deploy time.
+# Otherwise apply pending revisions here too: the models already read the
+# columns those revisions add, so starting without them would fail requests.
+if not startup.LAZY_INIT:
+    with app.app_context():
+        db.create_all()
+        schema_migrations.upgrade(db.engine, echo=lambda message: logger.info(message, extra={'event': 'schema.migrate'}))
+    startup.mark('schema')
+
+def auth_state():
+    """Login state and user summary, from the entitlements cookie when valid"""
+    user = entitled_user()
+    if user.is_authenticated:
+        return {
             'authenticated': True,
             'user': {
-                'id': current_user.id,
-                'email': current_user.email,
-                'first_name': current_user.first_name,
-                'last_name': current_user.last_name,
-                'name': f"{current_user.first_name or ''} {current_user.last_name or ''}".strip() or current_user.email.split('@')[0],
-                'profile_image_url': current_user.profile_image_url,
-                'membership_tier': current_user.subscription_tier or 'free'
+                'id': user.id,
+                'email': user.email,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'name': display_name(user),
+                'profile_image_url': user.profile_image_url,
+                'membership_tier': user.subscription_tier or 'free'
             }
-        })
+        }
     
     is_demo = session.get('demo_mode', False)
     if is_demo:
-        return jsonify({
+        return {
             'authenticated': True,
             'user': {
                 'id': 'demo',
@@ -156,11 +235,17 @@ def check_auth():
                 'membership_tier': 'premium',
                 'demo_mode': True
             }
-        })
+        }
     
-    return jsonify({'authenticated': False})
+    return {'authenticated': False}
+
+@app.route('/api/auth/check', methods=['GET'])
+@query_budget(1)
+def check_auth():
+    return jsonify(auth_state())
 
 @app.route('/api/auth/register', methods=['POST'])
+@query_budget(3)
 def register():
     try:
         data = request.json
@@ -191,6 +276,8 @@ def register():
         db.session.add(user)
         db.session.commit()
         
+        provision_stripe_customer_later(user)
+        
         return jsonify({'message': 'Account created successfully', 'user_id': user.id}), 201
         
     except Exception as e:
@@ -198,6 +285,7 @@ def register():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/auth/login', methods=['POST'])
+@query_budget(1)
 def login():
     try:
         from flask_login import login_user
@@ -230,6 +318,7 @@ def login():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/auth/logout', methods=['POST'])
+@query_budget(1)
 def logout_api():
     from flask_login import logout_user
     logout_user()
@@ -282,12 +371,21 @@ def serve_icon(filename):
 
 # Protected premium tool pages - require authentication and correct subscription tier
 def requires_premium(user):
-    """Check if user has premium tier access"""
+    """Check if user has premium tier access. Gates that grant paid access
+    pass current_user, not entitled_user(): the cookie's tier can be up to
+    ENTITLEMENTS_TTL_SECONDS old, and webhooks and checkout change tiers
+    outside the user's own requests. Loading the row also makes the
+    after_request hook reissue a stale cookie."""
     return user.is_authenticated and user.subscription_tier == TIER_PREMIUM
 
+def requires_admin(user):
+    """Check if user is listed in ADMIN_EMAILS"""
+    return user.is_authenticated and bool(user.email) and user.email.lower() in ADMIN_EMAILS
+
 @app.route('/tools/guide.html')
 def serve_guide():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/guide.html')
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -295,7 +393,8 @@ def serve_guide():
 
 @app.route('/tools/playroom.html')
 def serve_playroom():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/playroom.html')
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -303,7 +402,8 @@ def serve_playroom():
 
 @app.route('/tools/emotion-decoder.html')
 def serve_emotion_decoder():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/emotion-decoder.html')
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -311,7 +411,8 @@ def serve_emotion_decoder():
 
 @app.route('/tools/allergy-decoder.html')
 def serve_allergy_decoder():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/allergy-decoder.html')
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -319,7 +420,8 @@ def serve_allergy_decoder():
 
 @app.route('/tools/belief-decoder.html')
 def serve_belief_decoder():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/belief-decoder.html')
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -331,7 +433,8 @@ def serve_game(game_path):
     if game_path == 'lotus-breath.html':
         return send_from_directory('tools/games', game_path)
     # Other games require premium
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=tools/games/' + game_path)
     if not requires_premium(current_user):
         return redirect('/membership.html?upgrade=premium')
@@ -340,13 +443,15 @@ def serve_game(game_path):
 # Members dashboard requires login
 @app.route('/members-dashboard.html')
 def serve_dashboard():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=members-dashboard.html')
     return send_from_directory('.', 'members-dashboard.html')
 
 @app.route('/profile.html')
 def serve_profile():
-    if not current_user.is_authenticated:
+    viewer = entitled_user()
+    if not viewer.is_authenticated:
         return redirect('/login.html?redirect=profile.html')
     return send_from_directory('.', 'profile.html')
 
@@ -364,15 +469,27 @@ def serve_file(path):
     return send_from_directory('.', path)
 
 @app.route('/api/journal/entries', methods=['GET'])
+@query_budget(2)
+@replica_reads
 @require_login
 def get_entries():
     try:
-        entries = db.session.query(JournalEntry).filter_by(user_id=current_user.id).order_by(JournalEntry.created_at.desc()).all()
-        return jsonify([entry.to_dict() for entry in entries])
+        fields = JournalEntry.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        def build():
+            query = db.session.query(JournalEntry).filter_by(user_id=current_user.id)
+            if fields:
+                query = query.options(JournalEntry.load_only_fields(fields))
+            entries = query.order_by(JournalEntry.created_at.desc()).all()
+            return [entry.to_dict(fields) for entry in entries]
+        return versioned_json('journal_entries', current_user, build)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/journal/entries', methods=['POST'])
+@query_budget(4)
 @require_login
 def create_entry():
     try:
@@ -391,13 +508,18 @@ def create_entry():
             prompt_used=data.get('prompt_used', '')
         )
         db.session.add(entry)
+        db.session.flush()
+        # Serialised before the commit, which expires the entry; to_dict()
+        # afterwards would reload it with another SELECT
+        result = entry.to_dict()
         db.session.commit()
-        return jsonify(entry.to_dict()), 201
+        return jsonify(result), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/journal/entries/<int:entry_id>', methods=['DELETE'])
+@query_budget(5)
 @require_login
 def delete_entry(entry_id):
     try:
@@ -412,6 +534,7 @@ def delete_entry(entry_id):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/journal/save-doodle', methods=['POST'])
+@query_budget(4)
 @require_login
 def save_doodle():
     try:
@@ -435,13 +558,16 @@ def save_doodle():
             doodle_image=image_data
         )
         db.session.add(entry)
+        db.session.flush()
+        entry_id = entry.id
         db.session.commit()
-        return jsonify({'success': True, 'entry_id': entry.id}), 201
+        return jsonify({'success': True, 'entry_id': entry_id}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/markings/save', methods=['POST'])
+@query_budget(4)
 @require_login
 def save_markings():
     try:
@@ -462,8 +588,10 @@ def save_markings():
             doodle_image=image_data
         )
         db.session.add(entry)
+        db.session.flush()
+        entry_id = entry.id
         db.session.commit()
-        return jsonify({'success': True, 'entry_id': entry.id}), 201
+        return jsonify({'success': True, 'entry_id': entry_id}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -614,35 +742,7 @@ def generate_pdf_content(entry):
     
     return HTML(string=html).write_pdf()
 
-def get_google_drive_access_token():
-    hostname = os.environ.get('REPLIT_CONNECTORS_HOSTNAME')
-    x_replit_token = os.environ.get('REPL_IDENTITY')
-    
-    if x_replit_token:
-        x_replit_token = 'repl ' + x_replit_token
-    else:
-        x_replit_token = os.environ.get('WEB_REPL_RENEWAL')
-        if x_replit_token:
-            x_replit_token = 'depl ' + x_replit_token
-    
-    if not x_replit_token or not hostname:
-        raise Exception('Replit connection credentials not found')
-    
-    response = requests.get(
-        f'https://{hostname}/api/v2/connection?include_secrets=true&connector_names=google-drive',
-        headers={
-            'Accept': 'application/json',
-            'X_REPLIT_TOKEN': x_replit_token
-        }
-    )
-    
-    data = response.json()
-    items = data.get('items', [])
-    
-    if not items:
-        raise Exception('Google Drive not connected')
-    
-    connection = items[0]
+def _parse_google_drive_connection(connection):
     access_token = connection.get('settings', {}).get('access_token')
     
     if not access_token:
@@ -654,6 +754,9 @@ def get_google_drive_access_token():
     
     return access_token
 
+def get_google_drive_access_token():
+    return get_cached_credential('google-drive', _parse_google_drive_connection).get()
+
 @app.route('/api/journal/entries/<int:entry_id>/pdf', methods=['GET'])
 @require_login
 def download_pdf(entry_id):
@@ -696,11 +799,13 @@ def upload_to_drive(entry_id):
             'file': (filename, BytesIO(pdf_content), 'application/pdf')
         }
         
-        response = requests.post(
-            'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart',
-            headers={'Authorization': f'Bearer {access_token}'},
-            files=files
-        )
+        with tracing.span('google_drive', 'files.upload') as span:
+            response = requests.post(
+                'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart',
+                headers={'Authorization': f'Bearer {access_token}'},
+                files=files
+            )
+            span.status = response.status_code
         
         if response.status_code in [200, 201]:
             file_data = response.json()
@@ -754,6 +859,7 @@ def get_or_create_guest_session_id():
     return guest_id
 
 @app.route('/api/discovery/sessions', methods=['POST'])
+@query_budget(4)
 def create_discovery_session():
     try:
         data = request.json or {}
@@ -785,59 +891,78 @@ def create_discovery_session():
             discovery.completed_at = datetime.utcnow()
         
         db.session.add(discovery)
+        db.session.flush()
+        result = discovery.to_dict()
         db.session.commit()
         
-        return jsonify(discovery.to_dict()), 201
+        return jsonify(result), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/discovery/sessions', methods=['GET'])
+@query_budget(2)
+@replica_reads
 def get_discovery_sessions():
+    try:
+        fields = DiscoverySession.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     try:
         if current_user.is_authenticated:
-            sessions = db.session.query(DiscoverySession).filter_by(
-                user_id=current_user.id
-            ).order_by(DiscoverySession.started_at.desc()).limit(20).all()
+            def build():
+                query = db.session.query(DiscoverySession).filter_by(user_id=current_user.id)
+                if fields:
+                    query = query.options(DiscoverySession.load_only_fields(fields))
+                sessions = query.order_by(DiscoverySession.started_at.desc()).limit(20).all()
+                return [s.to_dict(fields) for s in sessions]
+            return versioned_json('discovery_sessions', current_user, build)
         else:
             guest_session_id = session.get('guest_discovery_id')
             if guest_session_id:
-                sessions = db.session.query(DiscoverySession).filter_by(
-                    session_id=guest_session_id
-                ).order_by(DiscoverySession.started_at.desc()).limit(5).all()
+                query = db.session.query(DiscoverySession).filter_by(session_id=guest_session_id)
+                if fields:
+                    query = query.options(DiscoverySession.load_only_fields(fields))
+                sessions = query.order_by(DiscoverySession.started_at.desc()).limit(5).all()
             else:
                 sessions = []
         
-        return jsonify([s.to_dict() for s in sessions])
+        return jsonify([s.to_dict(fields) for s in sessions])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/discovery/sessions/latest', methods=['GET'])
-def get_latest_discovery_session():
-    try:
-        if current_user.is_authenticated:
+def latest_discovery_state():
+    """The visitor's most recent discovery session, or None"""
+    if current_user.is_authenticated:
+        discovery = db.session.query(DiscoverySession).filter_by(
+            user_id=current_user.id
+        ).order_by(DiscoverySession.started_at.desc()).first()
+    else:
+        guest_session_id = session.get('guest_discovery_id')
+        if guest_session_id:
             discovery = db.session.query(DiscoverySession).filter_by(
-                user_id=current_user.id
+                session_id=guest_session_id
             ).order_by(DiscoverySession.started_at.desc()).first()
         else:
-            guest_session_id = session.get('guest_discovery_id')
-            if guest_session_id:
-                discovery = db.session.query(DiscoverySession).filter_by(
-                    session_id=guest_session_id
-                ).order_by(DiscoverySession.started_at.desc()).first()
-            else:
-                discovery = None
-        
-        if discovery:
-            return jsonify(discovery.to_dict())
-        return jsonify(None)
+            discovery = None
+    
+    return discovery.to_dict() if discovery else None
+
+
+@app.route('/api/discovery/sessions/latest', methods=['GET'])
+@query_budget(2)
+@replica_reads
+def get_latest_discovery_session():
+    try:
+        return jsonify(latest_discovery_state())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/discovery/sessions/<session_id>', methods=['PUT'])
+@query_budget(5)
 def update_discovery_session(session_id):
     try:
         data = request.json or {}
@@ -873,8 +998,10 @@ def update_discovery_session(session_id):
             if data['is_completed']:
                 discovery.completed_at = datetime.utcnow()
         
+        db.session.flush()
+        result = discovery.to_dict()
         db.session.commit()
-        return jsonify(discovery.to_dict())
+        return jsonify(result)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -882,6 +1009,7 @@ def update_discovery_session(session_id):
 
 # Oracle Reading API endpoints
 @app.route('/api/oracle/readings', methods=['POST'])
+@query_budget(4)
 @require_login
 def save_oracle_reading():
     try:
@@ -900,28 +1028,40 @@ def save_oracle_reading():
         )
         
         db.session.add(reading)
+        db.session.flush()
+        result = reading.to_dict()
         db.session.commit()
         
-        return jsonify(reading.to_dict()), 201
+        return jsonify(result), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/oracle/readings', methods=['GET'])
+@query_budget(2)
+@replica_reads
 @require_login
 def get_oracle_readings():
     try:
-        readings = db.session.query(OracleReading).filter_by(
-            user_id=current_user.id
-        ).order_by(OracleReading.created_at.desc()).limit(20).all()
-        
-        return jsonify([r.to_dict() for r in readings])
+        fields = OracleReading.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        def build():
+            query = db.session.query(OracleReading).filter_by(user_id=current_user.id)
+            if fields:
+                query = query.options(OracleReading.load_only_fields(fields))
+            readings = query.order_by(OracleReading.created_at.desc()).limit(20).all()
+            return [r.to_dict(fields) for r in readings]
+        
+        return versioned_json('oracle_readings', current_user, build)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/oracle/readings/<int:reading_id>', methods=['PUT'])
+@query_budget(5)
 @require_login
 def update_oracle_reading(reading_id):
     try:
@@ -934,70 +1074,63 @@ def update_oracle_reading(reading_id):
         if 'reflection' in data:
             reading.reflection = data['reflection']
         
+        db.session.flush()
+        result = reading.to_dict()
         db.session.commit()
-        return jsonify(reading.to_dict())
+        return jsonify(result)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
-def get_or_create_guest_usage(session_id):
-    today = date.today()
-    usage = db.session.query(GuestUsage).filter_by(
-        session_id=session_id,
-        usage_date=today
-    ).first()
+def guide_usage_state():
+    """AI Guide access and usage for the current visitor"""
+    is_demo = session.get('demo_mode', False)
     
-    if not usage:
-        usage = GuestUsage(
-            session_id=session_id,
-            usage_date=today,
-            guide_messages=0,
-            decoder_uses=0
-        )
-        db.session.add(usage)
-        db.session.commit()
+    if is_demo:
+        return {
+            'can_send': True,
+            'remaining': 999,
+            'is_member': True,
+            'subscription_tier': 'premium',
+            'requires_premium': True,
+            'has_premium': True,
+            'demo_mode': True
+        }
     
-    return usage
+    token_budget = get_daily_token_budget()
+    # Premium access is read from the users row, never the entitlements cookie
+    if current_user.is_authenticated:
+        # Same check as the send path, so buffered tokens count against the budget
+        can_use, remaining = guide_allowance(current_user, token_budget)
+        has_active = current_user.has_active_subscription()
+        is_premium = current_user.subscription_tier == TIER_PREMIUM and has_active
+        return {
+            'can_send': can_use,
+            'remaining': remaining,
+            'is_member': has_active,
+            'subscription_tier': current_user.subscription_tier,
+            'requires_premium': True,
+            'has_premium': is_premium,
+            'tokens_today': pending_guide_tokens(current_user),
+            'daily_token_budget': token_budget
+        }
+    else:
+        return {
+            'can_send': False,
+            'remaining': 0,
+            'is_member': False,
+            'subscription_tier': 'guest',
+            'requires_premium': True,
+            'has_premium': False
+        }
 
 
 @app.route('/api/guide/usage', methods=['GET'])
+@query_budget(2)
 def get_guide_usage():
     try:
-        is_demo = session.get('demo_mode', False)
-        
-        if is_demo:
-            return jsonify({
-                'can_send': True,
-                'remaining': 999,
-                'is_member': True,
-                'subscription_tier': 'premium',
-                'requires_premium': True,
-                'has_premium': True,
-                'demo_mode': True
-            })
-        
-        if current_user.is_authenticated:
-            can_use, remaining = current_user.can_use_guide()
-            has_active = current_user.has_active_subscription()
-            is_premium = current_user.subscription_tier == TIER_PREMIUM and has_active
-            return jsonify({
-                'can_send': can_use,
-                'remaining': remaining,
-                'is_member': has_active,
-                'subscription_tier': current_user.subscription_tier,
-                'requires_premium': True,
-                'has_premium': is_premium
-            })
-        else:
-            return jsonify({
-                'can_send': False,
-                'remaining': 0,
-                'is_member': False,
-                'subscription_tier': 'guest',
-                'requires_premium': True,
-                'has_premium': False
-            })
+        return jsonify(guide_usage_state())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1019,15 +1152,21 @@ def guide_chat():
         if is_demo:
             pass
         elif current_user.is_authenticated:
-            can_use, remaining = current_user.can_use_guide()
-            if not can_use:
+            allowed, _ = consume_guide_message(db, current_user, get_daily_token_budget())
+            if not allowed:
+                db.session.rollback()
+                if current_user.subscription_tier == TIER_PREMIUM and current_user.has_active_subscription():
+                    return jsonify({
+                        'error': 'You have reached today\'s SoulArt AI Guide allowance. Please come back tomorrow.',
+                        'daily_limit_reached': True
+                    }), 429
                 return jsonify({
                     'error': 'SoulArt AI Guide is available exclusively for Premium members (£6.99/month).',
                     'upgrade_required': True,
                     'required_tier': 'premium'
                 }), 403
-            current_user.increment_guide_usage()
-            db.session.commit()
+            if not buffers_usage(current_user):
+                db.session.commit()
         else:
             return jsonify({
                 'error': 'Please sign in and upgrade to Premium (£6.99/month) to use the SoulArt AI Guide.',
@@ -1035,20 +1174,35 @@ def guide_chat():
                 'required_tier': 'premium'
             }), 403
         
+        openai_client = get_openai_client()
         if not openai_client:
             return jsonify({'error': 'AI Guide is not configured'}), 503
         
         # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
         # do not change this unless explicitly requested by the user
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SOULART_GUIDE_SYSTEM_PROMPT},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=800,
-            temperature=0.7
-        )
+        model = "gpt-4o-mini"
+        started = time.perf_counter()
+        with tracing.span('openai', 'chat.completions.create') as span:
+            response = openai_client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SOULART_GUIDE_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_message}
+                ],
+                max_tokens=800,
+                temperature=0.7
+            )
+            span.status = 200
+        latency_ms = int((time.perf_counter() - started) * 1000)
+        
+        if current_user.is_authenticated and not is_demo:
+            try:
+                record_guide_usage(db, current_user, model, usage_from_completion(response), latency_ms)
+                if not buffers_usage(current_user):
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Guide metering error: %s", e, extra={'event': 'guide.metering_error'})
         
         ai_response = response.choices[0].message.content
         
@@ -1099,29 +1253,184 @@ def guide_chat():
         })
         
     except Exception as e:
-        print(f"Guide chat error: {e}")
+        logger.exception("Guide chat error: %s", e, extra={'event': 'guide.chat_error'})
         return jsonify({'error': 'An error occurred processing your request'}), 500
 
 
+@app.route('/api/guide/metering', methods=['GET'])
+@require_login
+def get_guide_metering():
+    """Current user's daily AI Guide token usage and spend"""
+    try:
+        days = min(max(request.args.get('days', 30, type=int), 1), 366)
+        return jsonify({
+            'days': days,
+            'daily_token_budget': get_daily_token_budget(),
+            'usage': user_daily_usage(db, current_user.id, days)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/guide-spend', methods=['GET'])
+@require_login
+def get_guide_spend_report():
+    """AI Guide token usage and spend per subscription tier (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        days = min(max(request.args.get('days', 30, type=int), 1), 366)
+        return jsonify(tier_spend_report(db, days))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/connector-metrics', methods=['GET'])
+@require_login
+def get_connector_metrics():
+    """Credential cache age and fetch latency per connector (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'connectors': get_credential_metrics()})
+
+
+@app.route('/api/admin/db-pool', methods=['GET'])
+@require_login
+def get_db_pool_stats():
+    """Connection pool gauges and checkout wait times for this process (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    stats = db_pool.pool_stats(db.engine)
+    replica = db.engines.get(db_routing.REPLICA_BIND)
+    if replica is not None:
+        stats['replica'] = db_pool.pool_stats(replica)
+    stats['routing'] = db_routing.routing_stats()
+    return jsonify(stats)
+
+
+@app.route('/api/admin/dependencies', methods=['GET'])
+@require_login
+def get_dependency_spans():
+    """Recent outbound calls, per-dependency latency and the slow-call log for
+    this process (admins only). Filter with ?request_id=, ?dependency=, ?limit="""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    limit = min(request.args.get('limit', 100, type=int), tracing.SPAN_BUFFER_SIZE)
+    return jsonify({
+        'summary': tracing.dependency_summary(),
+        'slow_call_seconds': tracing.SLOW_CALL_SECONDS,
+        'slow_calls': [s.to_dict() for s in reversed(tracing.slow_calls)],
+        'spans': tracing.recent_spans(request.args.get('request_id'), request.args.get('dependency'), limit)
+    })
+
+
+@app.route('/api/admin/query-audit', methods=['GET'])
+@require_login
+def get_query_audit():
+    """Query audit findings (QUERY_AUDIT=1): the worst request per route and
+    the most recent requests that had findings (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    flagged = [r for r in query_audit.reports
+               if r['over_budget'] or r['repeated'] or r['slow'] or r['full_scans']]
+    return jsonify({
+        'enabled': query_audit.ENABLED,
+        'routes': query_audit.summary(),
+        'flagged': flagged[-request.args.get('limit', 50, type=int):][::-1]
+    })
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@require_login
+def get_profiles():
+    """Saved request profiles, newest first (admins only). Filter with
+    ?endpoint=/api/journal/entries and ?limit="""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    limit = min(request.args.get('limit', 50, type=int), profiler.MAX_FILES)
+    return jsonify({
+        'enabled': profiler.enabled(),
+        'sample_rate': profiler.SAMPLE_RATE,
+        'profiles': profiler.list_profiles(request.args.get('endpoint'), limit)
+    })
+
+
+@app.route('/api/admin/profiles/<name>', methods=['GET'])
+@require_login
+def download_profile(name):
+    """One profile's collapsed stacks, ready for flamegraph.pl or speedscope
+    (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    if not profiler.valid_name(name) or not os.path.exists(os.path.join(profiler.PROFILE_DIR, name)):
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_from_directory(profiler.PROFILE_DIR, name, mimetype='text/plain', as_attachment=True)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_prometheus_metrics():
+    """Request, SQL and pool metrics in Prometheus text format
+    (METRICS_TOKEN bearer token, or an admin session)"""
+    if not (request_metrics.authorized(request) or requires_admin(current_user)):
+        return jsonify({'error': 'Forbidden'}), 403
+    body = request_metrics.render(db_pool.gauges(db.engines) + structured_log.gauges())
+    response = app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/api/admin/startup', methods=['GET'])
+@require_login
+def get_startup_timeline():
+    """How long this process spent in each import and init phase (admins only)"""
+    if not requires_admin(current_user):
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'lazy_init': startup.LAZY_INIT, 'phases': startup.timeline()})
+
+
+@app.cli.command('guide-spend')
+@click.option('--days', type=click.IntRange(min=1), default=30, show_default=True, help='Number of days to include.')
+def guide_spend_command(days):
+    """Print AI Guide token usage and spend per subscription tier.
+
+    Each user's day counts under the tier they had at their last Guide
+    message that day.
+    """
+    report = tier_spend_report(db, days)
+    click.echo(f"AI Guide spend since {report['since']} ({report['days']} days)")
+    click.echo(f"{'tier':<10} {'users':>7} {'messages':>9} {'prompt':>11} {'completion':>11} {'cached':>9} {'cost (USD)':>11}")
+    for row in report['tiers']:
+        click.echo(
+            f"{row['subscription_tier']:<10} {row['users']:>7} {row['messages']:>9} "
+            f"{row['prompt_tokens']:>11} {row['completion_tokens']:>11} {row['cached_tokens']:>9} "
+            f"{row['cost_usd']:>11.4f}"
+        )
+
+
 @app.route('/api/profile', methods=['GET'])
+@query_budget(2)
+@replica_reads
 @require_login
 def get_profile():
     try:
-        journal_count = db.session.query(JournalEntry).filter_by(user_id=current_user.id).count()
-        
-        return jsonify({
-            'id': current_user.id,
-            'email': current_user.email,
-            'first_name': current_user.first_name,
-            'last_name': current_user.last_name,
-            'profile_image_url': current_user.profile_image_url,
-            'is_member': current_user.is_member,
-            'membership_started_at': current_user.membership_started_at.isoformat() if current_user.membership_started_at else None,
-            'stats': {
-                'journal_entries': journal_count,
-                'journal_entries_count': journal_count
+        def build():
+            journal_count = db.session.query(JournalEntry).filter_by(user_id=current_user.id).count()
+            return {
+                'id': current_user.id,
+                'email': current_user.email,
+                'first_name': current_user.first_name,
+                'last_name': current_user.last_name,
+                'profile_image_url': current_user.profile_image_url,
+                'is_member': current_user.is_member,
+                'membership_started_at': current_user.membership_started_at.isoformat() if current_user.membership_started_at else None,
+                'stats': {
+                    'journal_entries': journal_count,
+                    'journal_entries_count': journal_count
+                }
             }
-        })
+        
+        # Profile fields live on the user row itself, so updated_at is part of the tag
+        return versioned_json('profile', current_user, build, current_user.updated_at)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1170,67 +1479,71 @@ def upload_profile_image():
         return jsonify({'error': str(e)}), 500
 
 
+def decoder_usage_state():
+    """Decoder access and remaining uses for the current visitor"""
+    is_demo = session.get('demo_mode', False)
+    
+    if is_demo:
+        return {
+            'can_use': True,
+            'remaining': 999,
+            'is_member': True,
+            'subscription_tier': 'premium',
+            'is_total_limit': False,
+            'demo_mode': True
+        }
+    
+    if current_user.is_authenticated:
+        can_use, remaining = current_user.can_use_decoder()
+        return {
+            'can_use': can_use,
+            'remaining': remaining,
+            'is_member': current_user.has_active_subscription(),
+            'subscription_tier': current_user.subscription_tier,
+            'is_total_limit': current_user.subscription_tier == TIER_FREE
+        }
+    else:
+        # Read-only: a guest without an id or a usage row has the full quota
+        session_id = session.get('guest_id')
+        total_uses = guest_decoder_uses(db, session_id) if session_id else 0
+        remaining = max(0, DECODER_FREE_LIMIT - total_uses)
+        
+        return {
+            'can_use': remaining > 0,
+            'remaining': remaining,
+            'is_member': False,
+            'subscription_tier': 'guest',
+            'is_total_limit': True
+        }
+
+
 @app.route('/api/decoder/usage', methods=['GET'])
+@query_budget(1)
 def get_decoder_usage():
     try:
-        is_demo = session.get('demo_mode', False)
-        
-        if is_demo:
-            return jsonify({
-                'can_use': True,
-                'remaining': 999,
-                'is_member': True,
-                'subscription_tier': 'premium',
-                'is_total_limit': False,
-                'demo_mode': True
-            })
-        
-        if current_user.is_authenticated:
-            can_use, remaining = current_user.can_use_decoder()
-            return jsonify({
-                'can_use': can_use,
-                'remaining': remaining,
-                'is_member': current_user.has_active_subscription(),
-                'subscription_tier': current_user.subscription_tier,
-                'is_total_limit': current_user.subscription_tier == TIER_FREE
-            })
-        else:
-            session_id = session.get('guest_id')
-            if not session_id:
-                import uuid
-                session_id = str(uuid.uuid4())
-                session['guest_id'] = session_id
-            
-            usage = get_or_create_guest_total_usage(session_id)
-            limit = 3
-            remaining = max(0, limit - usage.decoder_total_uses)
-            
-            return jsonify({
-                'can_use': remaining > 0,
-                'remaining': remaining,
-                'is_member': False,
-                'subscription_tier': 'guest',
-                'is_total_limit': True
-            })
+        return jsonify(decoder_usage_state())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/decoder/track-use', methods=['POST'])
+@query_budget(3)
 def track_decoder_use():
     try:
         if current_user.is_authenticated:
-            can_use, remaining = current_user.can_use_decoder()
-            if can_use:
-                current_user.increment_decoder_usage()
-                db.session.commit()
+            allowed, _ = consume_user_decoder_use(db, current_user)
+            if allowed:
                 _, new_remaining = current_user.can_use_decoder()
+                is_total_limit = current_user.subscription_tier == TIER_FREE
+                if not buffers_usage(current_user):
+                    db.session.commit()
                 return jsonify({
                     'success': True,
                     'remaining': new_remaining,
-                    'is_total_limit': current_user.subscription_tier == TIER_FREE
+                    'is_total_limit': is_total_limit
                 })
             else:
+                db.session.rollback()
                 return jsonify({
                     'error': 'Usage limit reached. Upgrade to continue using the decoder.',
                     'upgrade_required': True
@@ -1238,29 +1551,29 @@ def track_decoder_use():
         else:
             session_id = session.get('guest_id')
             if not session_id:
-                import uuid
                 session_id = str(uuid.uuid4())
                 session['guest_id'] = session_id
             
-            usage = get_or_create_guest_total_usage(session_id)
-            limit = 3
-            if usage.decoder_total_uses >= limit:
+            allowed, total_uses = consume_guest_decoder_use(db, session_id)
+            if not allowed:
+                db.session.rollback()
                 return jsonify({
                     'error': 'Free uses exhausted. Sign up for a membership to continue.',
                     'upgrade_required': True
                 }), 429
-            usage.decoder_total_uses += 1
             db.session.commit()
             return jsonify({
                 'success': True,
-                'remaining': limit - usage.decoder_total_uses,
+                'remaining': DECODER_FREE_LIMIT - total_uses,
                 'is_total_limit': True
             })
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/booking', methods=['POST'])
+@query_budget(1)
 def create_booking():
     try:
         data = request.json
@@ -1294,10 +1607,16 @@ def create_booking():
 
 
 @app.route('/api/bookings', methods=['GET'])
+@query_budget(2)
+@replica_reads
 @require_login
 def get_bookings():
+    """Most recent booking requests (?limit=, default 100, at most 500)"""
     try:
-        bookings = db.session.query(BookingRequest).order_by(BookingRequest.created_at.desc()).all()
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+        bookings = db.session.query(BookingRequest).order_by(
+            BookingRequest.created_at.desc()
+        ).limit(limit).all()
         return jsonify([b.to_dict() for b in bookings])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1317,42 +1636,24 @@ def get_stripe_config():
 
 @app.route('/api/stripe/products', methods=['GET'])
 def get_stripe_products():
-    """Get available subscription products and prices"""
+    """Get available subscription products and prices from the local catalog"""
     try:
-        stripe_client = get_stripe_client()
-        
-        products = stripe_client.Product.search(query="metadata['app']:'soulart_temple' AND active:'true'")
-        
-        result = []
-        for product in products.data:
-            prices = stripe_client.Price.list(product=product.id, active=True)
-            
-            product_data = {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'tier': product.metadata.get('tier', 'basic'),
-                'prices': []
-            }
-            
-            for price in prices.data:
-                recurring = price.recurring or {}
-                product_data['prices'].append({
-                    'id': price.id,
-                    'unit_amount': price.unit_amount,
-                    'currency': price.currency,
-                    'interval': recurring.get('interval', 'month'),
-                    'interval_count': recurring.get('interval_count', 1),
-                    'plan_type': price.metadata.get('plan_type', 'monthly')
-                })
-            
-            result.append(product_data)
-        
-        return jsonify({'products': result})
+        etag, payload = get_catalog_snapshot(db)
+        response = jsonify(payload)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.cli.command('stripe-catalog-sync')
+def stripe_catalog_sync_command():
+    """Reconcile the local Stripe product catalog against Stripe."""
+    products, prices = sync_catalog(db, get_stripe_client())
+    click.echo(f"Synced {products} products and {prices} prices")
+
+
 @app.route('/api/stripe/create-checkout-session', methods=['POST'])
 @require_login
 def create_checkout_session():
@@ -1366,23 +1667,19 @@ def create_checkout_session():
         
         stripe_client = get_stripe_client()
         
+        # Normally created in the background at sign-up; this only runs if
+        # that hasn't finished, and shares its idempotency key
         customer_id = current_user.stripe_customer_id
         if not customer_id:
-            customer = stripe_client.Customer.create(
-                email=current_user.email,
-                metadata={
-                    'user_id': current_user.id,
-                    'app': 'soulart_temple'
-                }
-            )
-            current_user.stripe_customer_id = customer.id
-            db.session.commit()
-            customer_id = customer.id
+            customer_id = provision_customer(db, current_user, stripe_client)
         
         domains = os.environ.get('REPLIT_DOMAINS', '').split(',')
         base_url = f"https://{domains[0]}" if domains and domains[0] else 'http://localhost:5000'
         
-        checkout_session = stripe_client.checkout.Session.create(
+        # A retried or double-submitted request gets the same session
+        checkout_session = create_stripe_session(
+            'checkout', current_user.id, stripe_client.checkout.Session.create,
+            idempotency_key=request.headers.get('Idempotency-Key'),
             customer=customer_id,
             payment_method_types=['card'],
             mode='subscription',
@@ -1413,7 +1710,9 @@ def create_customer_portal():
         domains = os.environ.get('REPLIT_DOMAINS', '').split(',')
         base_url = f"https://{domains[0]}" if domains and domains[0] else 'http://localhost:5000'
         
-        portal_session = stripe_client.billing_portal.Session.create(
+        portal_session = create_stripe_session(
+            'portal', current_user.id, stripe_client.billing_portal.Session.create,
+            idempotency_key=request.headers.get('Idempotency-Key'),
             customer=current_user.stripe_customer_id,
             return_url=f"{base_url}/profile.html"
         )
@@ -1423,28 +1722,85 @@ def create_customer_portal():
         return jsonify({'error': str(e)}), 500
 
 
+def subscription_state(user):
+    """Subscription summary for a logged-in user"""
+    can_use_decoder, decoder_remaining = user.can_use_decoder()
+    return {
+        'subscription_tier': user.subscription_tier,
+        'tier_display_name': user.get_tier_display_name(),
+        'has_active_subscription': user.has_active_subscription(),
+        'stripe_subscription_id': user.stripe_subscription_id,
+        'subscription_expires_at': user.subscription_expires_at.isoformat() if user.subscription_expires_at else None,
+        'can_use_guide': user.can_use_guide()[0],
+        'can_use_decoder': can_use_decoder,
+        'decoder_uses_remaining': decoder_remaining
+    }
+
+
 @app.route('/api/stripe/subscription', methods=['GET'])
+@query_budget(1)
 @require_login
 def get_subscription_status():
     """Get current user's subscription status"""
     try:
-        return jsonify({
-            'subscription_tier': current_user.subscription_tier,
-            'tier_display_name': current_user.get_tier_display_name(),
-            'has_active_subscription': current_user.has_active_subscription(),
-            'stripe_subscription_id': current_user.stripe_subscription_id,
-            'subscription_expires_at': current_user.subscription_expires_at.isoformat() if current_user.subscription_expires_at else None,
-            'can_use_guide': current_user.can_use_guide()[0],
-            'can_use_decoder': current_user.can_use_decoder()[0],
-            'decoder_uses_remaining': current_user.can_use_decoder()[1]
-        })
+        return jsonify(subscription_state(current_user))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def _bootstrap_subscription():
+    return subscription_state(current_user) if current_user.is_authenticated else None
+
+
+# Sections of /api/bootstrap, each the body of the matching single-purpose endpoint
+BOOTSTRAP_SECTIONS = {
+    'auth': auth_state,
+    'subscription': _bootstrap_subscription,
+    'latest_discovery': latest_discovery_state,
+    'decoder_usage': decoder_usage_state,
+    'guide_usage': guide_usage_state,
+}
+
+
+@app.route('/api/bootstrap', methods=['GET'])
+@query_budget(3)
+def get_bootstrap():
+    """Page-load state in one response.
+    
+    ?sections=auth,subscription,latest_discovery,decoder_usage,guide_usage
+    picks what to include (default: all). The user is loaded at most once and
+    the response carries an ETag, so an unchanged state revalidates with 304.
+    """
+    try:
+        requested = request.args.get('sections')
+        if requested:
+            names = [name.strip() for name in requested.split(',') if name.strip()]
+        else:
+            names = list(BOOTSTRAP_SECTIONS)
+        unknown = [name for name in names if name not in BOOTSTRAP_SECTIONS]
+        if unknown:
+            return jsonify({
+                'error': f"Unknown sections: {', '.join(unknown)}",
+                'sections': list(BOOTSTRAP_SECTIONS)
+            }), 400
+        
+        response = jsonify({name: BOOTSTRAP_SECTIONS[name]() for name in names})
+        response.add_etag()
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/stripe/webhook', methods=['POST'])
 def stripe_webhook():
-    """Handle Stripe webhook events"""
+    """Verify a Stripe webhook event and store it in the inbox.
+    
+    Processing happens in the inbox worker, so Stripe gets its acknowledgement
+    without waiting on handlers. Redelivered events are acknowledged again but
+    stored only once.
+    """
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
     
@@ -1452,47 +1808,207 @@ def stripe_webhook():
         return jsonify({'error': 'Missing signature'}), 400
     
     webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
+    if not webhook_secret:
+        logger.warning("STRIPE_WEBHOOK_SECRET not set - webhook signatures not verified",
+                       extra={'event': 'stripe.webhook_unverified'})
     
     try:
-        stripe_client = get_stripe_client()
-        
-        if webhook_secret:
-            event = stripe_client.webhooks.construct_event(
-                payload, sig_header, webhook_secret
-            )
-            event_type = event.type
-            event_data = event.data.object
-        else:
-            print("WARNING: STRIPE_WEBHOOK_SECRET not set - webhook signatures not verified")
-            event = json.loads(payload)
-            event_type = event.get('type', '')
-            event_data = event.get('data', {}).get('object', {})
-        
-        print(f"Stripe webhook received: {event_type}")
-        
-        if event_type == 'checkout.session.completed':
-            handle_checkout_completed(event_data)
-        
-        elif event_type == 'customer.subscription.created':
-            handle_subscription_created(event_data)
-        
-        elif event_type == 'customer.subscription.updated':
-            handle_subscription_updated(event_data)
-        
-        elif event_type == 'customer.subscription.deleted':
-            handle_subscription_deleted(event_data)
-        
-        elif event_type == 'invoice.payment_succeeded':
-            handle_payment_succeeded(event_data)
-        
-        elif event_type == 'invoice.payment_failed':
-            handle_payment_failed(event_data)
-        
-        return jsonify({'received': True}), 200
+        event = parse_event(payload, sig_header, webhook_secret)
+    except Exception as e:
+        logger.warning("Webhook verification error: %s", e, extra={'event': 'stripe.webhook_rejected'})
+        return jsonify({'error': 'Invalid payload or signature'}), 400
     
+    if not event.get('id'):
+        return jsonify({'error': 'Missing event id'}), 400
+    
+    try:
+        is_new = enqueue_event(db, event, payload)
     except Exception as e:
-        print(f"Webhook error: {e}")
-        return jsonify({'error': str(e)}), 400
+        db.session.rollback()
+        logger.exception("Webhook inbox error: %s", e, extra={'event': 'stripe.webhook_inbox_error'})
+        return jsonify({'error': 'Could not store event'}), 500
+    
+    return jsonify({'received': True, 'duplicate': not is_new}), 200
+
+
+def dispatch_stripe_event(event_type, event_data):
+    """Apply one Stripe event; called by the webhook inbox worker"""
+    logger.info("Stripe webhook processing: %s", event_type,
+                extra={'event': 'stripe.webhook', 'stripe_event_type': event_type})
+    
+    if event_type == 'checkout.session.completed':
+        handle_checkout_completed(event_data)
+    
+    elif event_type == 'customer.subscription.created':
+        handle_subscription_created(event_data)
+    
+    elif event_type == 'customer.subscription.updated':
+        handle_subscription_updated(event_data)
+    
+    elif event_type == 'customer.subscription.deleted':
+        handle_subscription_deleted(event_data)
+    
+    elif event_type == 'invoice.payment_succeeded':
+        handle_payment_succeeded(event_data)
+    
+    elif event_type == 'invoice.payment_failed':
+        handle_payment_failed(event_data)
+    
+    elif event_type.startswith(('product.', 'price.')):
+        handle_catalog_event(db, event_type, event_data)
+
+
+@app.cli.command('provision-stripe-customers')
+@click.option('--limit', type=int, default=None, help='Maximum number of users to provision.')
+def provision_stripe_customers_command(limit):
+    """Create Stripe customers for users who don't have one yet."""
+    created, failed = provision_missing_customers(db, get_stripe_client(), limit)
+    click.echo(f"Provisioned {created} Stripe customers, {failed} failed")
+
+
+@app.cli.command('reconcile-subscriptions')
+@click.option('--dry-run', is_flag=True, help='Report differences without writing them.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Users per batched UPDATE.')
+@click.option('--verbose', is_flag=True, help='List every changed user.')
+def reconcile_subscriptions_command(dry_run, chunk_size, verbose):
+    """Bring users' subscription columns in line with Stripe (run nightly)."""
+    report = reconcile_subscriptions(db, get_stripe_client(), dry_run=dry_run, chunk_size=chunk_size)
+    click.echo(f"Stripe customers: {report['stripe_customers']}, users checked: {report['users_checked']}")
+    click.echo(f"Users {'to change' if dry_run else 'changed'}: {report['users_changed']} {report['summary']}")
+    if verbose:
+        for change in report['changes']:
+            click.echo(f"  {change}")
+        for user in report['unresolved']:
+            click.echo(f"  unresolved tier, left unchanged: {user}")
+    click.echo(f"Fetched from Stripe in {report['fetch_seconds']:.1f}s, total {report['total_seconds']:.1f}s")
+
+
+@app.cli.group('webhook-inbox')
+def webhook_inbox_cli():
+    """Inspect, drain and replay the Stripe webhook inbox."""
+
+
+@webhook_inbox_cli.command('status')
+def webhook_inbox_status_command():
+    """Show inbox counts by status."""
+    stats = inbox_stats(db)
+    for key, value in stats.items():
+        click.echo(f"{key}: {value}")
+    for row in db.session.query(StripeWebhookEvent).filter_by(status=WEBHOOK_DEAD).limit(20):
+        click.echo(f"  dead {row.id} {row.event_type} attempts={row.attempts} error={row.last_error}")
+
+
+@webhook_inbox_cli.command('drain')
+def webhook_inbox_drain_command():
+    """Process all due pending events now."""
+    processed, failed = drain_until_idle(db, dispatch_stripe_event)
+    click.echo(f"Processed {processed} events, {failed} failed")
+
+
+@webhook_inbox_cli.command('replay')
+@click.argument('event_ids', nargs=-1)
+@click.option('--dead', is_flag=True, help='Replay every dead-lettered event.')
+def webhook_inbox_replay_command(event_ids, dead):
+    """Reset events (by id, or all dead-lettered ones) to pending."""
+    if not event_ids and not dead:
+        raise click.UsageError('Pass event ids or --dead')
+    count = replay_events(db, list(event_ids), dead)
+    click.echo(f"Queued {count} events for replay")
+
+
+@webhook_inbox_cli.command('purge')
+def webhook_inbox_purge_command():
+    """Delete processed and dead-lettered events past their retention."""
+    count = purge_old_events(db)
+    click.echo(f"Purged {count} events")
+
+
+@app.cli.group('schema')
+def schema_cli():
+    """Apply, verify and roll back schema migrations."""
+
+
+@schema_cli.command('status')
+def schema_status_command():
+    """List migrations and whether each is applied."""
+    applied = schema_migrations.applied_versions(db.engine)
+    for migration in schema_migrations.MIGRATIONS:
+        applied_at = applied.get(migration.version)
+        state = f"applied {applied_at:%Y-%m-%d %H:%M}" if applied_at else 'pending'
+        click.echo(f"{migration.version:<45} {state:<24} {migration.description}")
+
+
+@schema_cli.command('apply')
+@click.option('--to', 'target', help='Stop after this version.')
+def schema_apply_command(target):
+    """Create missing tables and apply pending migrations (run before starting a new release)."""
+    db.create_all()
+    applied = schema_migrations.upgrade(db.engine, target, echo=click.echo)
+    click.echo(f"Applied {len(applied)} migrations")
+
+
+@schema_cli.command('rollback')
+@click.argument('target', required=False)
+def schema_rollback_command(target):
+    """Revert migrations newer than TARGET (default: the latest one; 'base' for all)."""
+    reverted = schema_migrations.rollback(db.engine, target, echo=click.echo)
+    click.echo(f"Reverted {len(reverted)} migrations")
+
+
+@schema_cli.command('verify')
+@click.option('--explain/--no-explain', default=True, show_default=True, help='EXPLAIN the hot queries too.')
+def schema_verify_command(explain):
+    """Check the live schema matches the applied migrations."""
+    failures = 0
+    for version, applied, ok, detail in schema_migrations.verify(db.engine):
+        if applied and not ok:
+            failures += 1
+        click.echo(f"{version:<45} {'applied' if applied else 'pending':<8} {detail}")
+    if explain:
+        for name, index, used, plan in schema_migrations.explain_hot_queries(db.engine):
+            if not used:
+                failures += 1
+            click.echo(f"{name:<30} {'uses' if used else 'DOES NOT USE'} {index}")
+            if not used:
+                click.echo(f"  {plan}")
+    if failures:
+        raise click.ClickException(f"{failures} problems found")
+
+
+@app.cli.group('guest-retention')
+def guest_retention_cli():
+    """Purge expired guest usage and guest discovery data."""
+
+
+@guest_retention_cli.command('purge')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per DELETE and commit.')
+@click.option('--vacuum/--no-vacuum', default=True, show_default=True, help='VACUUM the tables afterwards (Postgres).')
+@click.option('--reindex', is_flag=True, help='Also REINDEX CONCURRENTLY to reclaim index bloat (Postgres).')
+def guest_retention_purge_command(batch_size, vacuum, reindex):
+    """Delete guest rows past their retention period (run daily)."""
+    before = table_sizes(db)
+    report = purge_guest_data(db, batch_size=batch_size)
+    for table, removed in report['removed'].items():
+        click.echo(f"{table}: removed {removed} rows")
+    for name in report['partitions_dropped']:
+        click.echo(f"guest_usage: dropped partition {name}")
+
+    if vacuum:
+        vacuum_tables(db, reindex=reindex)
+    after = table_sizes(db)
+    for table, size in after.items():
+        table_freed = before[table]['table_bytes'] - size['table_bytes']
+        index_freed = before[table]['index_bytes'] - size['index_bytes']
+        click.echo(f"{table}: {size['table_bytes']} table bytes ({table_freed} reclaimed), "
+                   f"{size['index_bytes']} index bytes ({index_freed} reclaimed), "
+                   f"{size['dead_rows']} dead rows")
+
+
+@guest_retention_cli.command('partition-guest-usage')
+def guest_retention_partition_command():
+    """Convert guest_usage to monthly range partitions (Postgres, one-off)."""
+    copied = partition_guest_usage(db)
+    click.echo(f"guest_usage partitioned by month, {copied} rows copied")
 
 
 def handle_checkout_completed(session_data):
@@ -1502,12 +2018,12 @@ def handle_checkout_completed(session_data):
     customer_id = session_data.get('customer')
     
     if not user_id:
-        print("No user_id in checkout session")
+        logger.warning("No user_id in checkout session", extra={'event': 'stripe.checkout_unmatched'})
         return
     
     user = db.session.get(User, user_id)
     if not user:
-        print(f"User not found: {user_id}")
+        logger.warning("User not found: %s", user_id, extra={'event': 'stripe.checkout_unmatched', 'user_id': user_id})
         return
     
     user.stripe_customer_id = customer_id
@@ -1515,7 +2031,7 @@ def handle_checkout_completed(session_data):
     user.membership_started_at = datetime.utcnow()
     
     db.session.commit()
-    print(f"Checkout completed for user {user_id}")
+    logger.info("Checkout completed for user %s", user_id, extra={'event': 'stripe.checkout_completed', 'user_id': user_id})
 
 
 def handle_subscription_created(subscription_data):
@@ -1526,7 +2042,8 @@ def handle_subscription_created(subscription_data):
     
     user = db.session.query(User).filter_by(stripe_customer_id=customer_id).first()
     if not user:
-        print(f"User not found for customer: {customer_id}")
+        logger.warning("User not found for customer: %s", customer_id,
+                       extra={'event': 'stripe.customer_unmatched', 'customer_id': customer_id})
         return
     
     tier = determine_tier_from_subscription(subscription_data)
@@ -1540,7 +2057,8 @@ def handle_subscription_created(subscription_data):
         user.subscription_expires_at = datetime.fromtimestamp(current_period_end)
     
     db.session.commit()
-    print(f"Subscription created for user {user.id}: tier={tier}")
+    logger.info("Subscription created for user %s: tier=%s", user.id, tier,
+                extra={'event': 'stripe.subscription_created', 'user_id': user.id, 'tier': tier})
 
 
 def handle_subscription_updated(subscription_data):
@@ -1551,7 +2069,8 @@ def handle_subscription_updated(subscription_data):
     
     user = db.session.query(User).filter_by(stripe_customer_id=customer_id).first()
     if not user:
-        print(f"User not found for customer: {customer_id}")
+        logger.warning("User not found for customer: %s", customer_id,
+                       extra={'event': 'stripe.customer_unmatched', 'customer_id': customer_id})
         return
     
     if status in ['active', 'trialing']:
@@ -1572,7 +2091,8 @@ def handle_subscription_updated(subscription_data):
         user.stripe_subscription_id = None
     
     db.session.commit()
-    print(f"Subscription updated for user {user.id}: status={status}")
+    logger.info("Subscription updated for user %s: status=%s", user.id, status,
+                extra={'event': 'stripe.subscription_updated', 'user_id': user.id, 'status': status})
 
 
 def handle_subscription_deleted(subscription_data):
@@ -1581,7 +2101,8 @@ def handle_subscription_deleted(subscription_data):
     
     user = db.session.query(User).filter_by(stripe_customer_id=customer_id).first()
     if not user:
-        print(f"User not found for customer: {customer_id}")
+        logger.warning("User not found for customer: %s", customer_id,
+                       extra={'event': 'stripe.customer_unmatched', 'customer_id': customer_id})
         return
     
     user.subscription_tier = TIER_FREE
@@ -1589,7 +2110,8 @@ def handle_subscription_deleted(subscription_data):
     user.stripe_subscription_id = None
     
     db.session.commit()
-    print(f"Subscription deleted for user {user.id}")
+    logger.info("Subscription deleted for user %s", user.id,
+                extra={'event': 'stripe.subscription_deleted', 'user_id': user.id})
 
 
 def handle_payment_succeeded(invoice_data):
@@ -1601,7 +2123,7 @@ def handle_payment_succeeded(invoice_data):
     if not user:
         return
     
-    print(f"Payment succeeded for user {user.id}")
+    logger.info("Payment succeeded for user %s", user.id, extra={'event': 'stripe.payment_succeeded', 'user_id': user.id})
 
 
 def handle_payment_failed(invoice_data):
@@ -1613,44 +2135,94 @@ def handle_payment_failed(invoice_data):
     if not user:
         return
     
-    print(f"Payment failed for user {user.id}")
+    logger.warning("Payment failed for user %s", user.id, extra={'event': 'stripe.payment_failed', 'user_id': user.id})
 
 
 def determine_tier_from_subscription(subscription_data):
-    """Determine the tier based on subscription product metadata"""
+    """Determine the tier from the subscription's price.
+    
+    Resolved locally from the price/product tier index; Stripe is only asked
+    for the product on a miss, and the answer is added to the index. A failed
+    lookup raises, so the webhook inbox retries the event rather than
+    applying a guessed tier.
+    """
     items = subscription_data.get('items', {}).get('data', [])
     if not items:
         return TIER_BASIC
     
     price_data = items[0].get('price', {})
-    product_id = price_data.get('product')
+    tier = resolve_tier(db, price_data)
     
-    try:
-        stripe_client = get_stripe_client()
-        product = stripe_client.Product.retrieve(product_id)
-        tier = product.metadata.get('tier', 'basic')
-        
-        if tier == 'premium':
-            return TIER_PREMIUM
-        return TIER_BASIC
-    except Exception as e:
-        print(f"Error determining tier: {e}")
-        return TIER_BASIC
-
-
-def get_or_create_guest_total_usage(session_id):
-    """Get or create guest total usage record (not daily)"""
-    usage = db.session.query(GuestTotalUsage).filter_by(session_id=session_id).first()
-    
-    if not usage:
-        usage = GuestTotalUsage(
-            session_id=session_id,
-            decoder_total_uses=0
-        )
-        db.session.add(usage)
-        db.session.commit()
+    if tier is None:
+        product_id = price_data.get('product')
+        try:
+            stripe_client = get_stripe_client()
+            product = stripe_client.Product.retrieve(product_id)
+            tier = upsert_product(db, product).tier or 'basic'
+        except Exception as e:
+            logger.error("Error determining tier: %s", e, extra={'event': 'stripe.tier_lookup_error'})
+            raise
     
-    return usage
+    if tier == 'premium':
+        return TIER_PREMIUM
+    return TIER_BASIC
+
+
+def start_background_work():
+    """Warm the Stripe catalog and start the webhook, usage and metrics workers"""
+    warm_catalog(app, db, get_stripe_client)
+    start_webhook_worker(app, db, dispatch_stripe_event)
+    start_usage_flusher(app, db)
+    request_metrics.start_snapshot_writer()
+
+
+def warm_shared_state():
+    """Preload mode: load what every worker can share copy-on-write before
+    gunicorn forks - the SDK modules, the ORM mapper configuration and the
+    Stripe catalog snapshot - then close the master's DB connections."""
+    import openai
+    import stripe
+    configure_mappers()
+    with app.app_context():
+        try:
+            get_catalog_snapshot(db)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Catalog warm-up before fork failed: %s", e, extra={'event': 'startup.catalog_warm_error'})
+        finally:
+            db.session.remove()
+        db.engine.dispose()
+    startup.mark('shared state warmed')
+    # The master runs no log listener; write what it logged during startup
+    structured_log.drain()
+
+
+def reset_after_fork():
+    """Preload mode: give a freshly forked worker its own DB pool, HTTP
+    clients and background threads instead of the master's"""
+    global _openai_client, _openai_client_lock
+    structured_log.reset_after_fork()
+    with app.app_context():
+        for engine in db.engines.values():
+            # Leave the parent's connections (if any) alone; just forget them
+            engine.dispose(close=False)
+    _openai_client = None
+    _openai_client_lock = threading.Lock()
+    # The master's own SQL (create_all, warm-up) is not this worker's
+    request_metrics.metrics.reset()
+    tracing.spans.clear()
+    tracing.slow_calls.clear()
+    reset_connector_state()
+    reset_stripe_http_client()
+    if not startup.LAZY_INIT:
+        start_background_work()
+
+
+if not (startup.LAZY_INIT or startup.PRELOAD):
+    start_background_work()
+    startup.mark('background workers')
+logger.info("Startup timeline: %s%s%s", startup.summary(), ' (lazy init)' if startup.LAZY_INIT else '',
+            ' (preload)' if startup.PRELOAD else '', extra={'event': 'startup.ready'})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark for /api/stripe/create-checkout-session.
+
+Compares a user whose Stripe customer was pre-provisioned in the background
+at sign-up (one Stripe call at checkout) with a user who has none yet (the
+old path: Customer.create plus checkout.Session.create). Stripe is replaced
+by a local stand-in that sleeps for --stripe-latency-ms per call and
+enforces idempotency keys the way Stripe does.
+
+Usage: python benchmarks/checkout_latency.py [--requests 50] [--stripe-latency-ms 250]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+
+class Obj(dict):
+    __getattr__ = dict.__getitem__
+
+
+def make_stand_in(latency):
+    calls = {'Customer.create': 0, 'checkout.Session.create': 0}
+    customers = {}
+
+    class Customer:
+        @staticmethod
+        def create(idempotency_key=None, **kwargs):
+            calls['Customer.create'] += 1
+            time.sleep(latency)
+            if idempotency_key not in customers:
+                customers[idempotency_key] = Obj(id=f'cus_{uuid.uuid4().hex[:14]}')
+            return customers[idempotency_key]
+
+    class Session:
+        @staticmethod
+        def create(idempotency_key=None, **kwargs):
+            calls['checkout.Session.create'] += 1
+            time.sleep(latency)
+            return Obj(id='cs_test', url='https://checkout.stripe.test/session')
+
+    class checkout:
+        pass
+
+    checkout.Session = Session
+
+    class LocalStripe:
+        pass
+
+    LocalStripe.Customer = Customer
+    LocalStripe.checkout = checkout
+    return LocalStripe, calls, customers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--stripe-latency-ms', type=float, default=250)
+    args = parser.parse_args()
+
+    import app as app_module
+    from models import User
+
+    app, db = app_module.app, app_module.db
+    stand_in, calls, customers = make_stand_in(args.stripe_latency_ms / 1000)
+    app_module.get_stripe_client = lambda: stand_in
+
+    def sign_up_and_checkout(provisioned):
+        email = f'{uuid.uuid4().hex}@bench.local'
+        client = app.test_client()
+        with app.app_context():
+            user = User(id=str(uuid.uuid4()), email=email)
+            user.set_password('benchmark')
+            db.session.add(user)
+            db.session.commit()
+            if provisioned:
+                app_module.provision_customer(db, user, stand_in)
+        client.post('/api/auth/login', json={'email': email, 'password': 'benchmark'})
+        started = time.perf_counter()
+        response = client.post('/api/stripe/create-checkout-session', json={'price_id': 'price_bench'})
+        elapsed = (time.perf_counter() - started) * 1000
+        assert response.status_code == 200, response.get_json()
+        return elapsed
+
+    results = {}
+    for label, provisioned in (('not provisioned', False), ('pre-provisioned', True)):
+        before = dict(calls)
+        samples = [sign_up_and_checkout(provisioned) for _ in range(args.requests)]
+        results[label] = (samples, {k: calls[k] - before[k] for k in calls})
+
+    print(f"Stripe stand-in latency: {args.stripe_latency_ms:.0f}ms per call, {args.requests} checkouts each")
+    print(f"{'path':<17} {'p50 ms':>8} {'mean ms':>8} {'max ms':>8}  Stripe calls during setup+checkout")
+    for label, (samples, used) in results.items():
+        print(f"{label:<17} {statistics.median(samples):>8.1f} {statistics.mean(samples):>8.1f} {max(samples):>8.1f}  {used}")
+    print(f"Distinct customers created: {len(customers)} for {2 * args.requests} users")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: time from process spawn to the first successful response.
+
+Starts the app in a fresh Python process serving on a local port, polls
+GET /api/auth/check until it answers 200, and records the elapsed time,
+once with the default eager startup and once with LAZY_INIT=1. Each run
+also reports the app's own startup timeline (import and init phases).
+The schema is created beforehand with `flask schema apply`, as a lazy
+deploy would do at build time.
+
+Usage: python benchmarks/cold_start.py [--runs 5] [--timeout 60]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to include connection setup and create_all round trips.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVE = (
+    "import sys\n"
+    "from werkzeug.serving import make_server\n"
+    "import app\n"
+    "make_server('127.0.0.1', int(sys.argv[1]), app.app, threaded=True).serve_forever()\n"
+)
+
+
+def child_env(lazy):
+    env = dict(os.environ)
+    env.setdefault('REPL_ID', 'benchmark')
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    env['STRIPE_WEBHOOK_WORKER'] = '0'
+    env['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+    if lazy:
+        env['LAZY_INIT'] = '1'
+    else:
+        env.pop('LAZY_INIT', None)
+    return env
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_first_response(env, timeout):
+    """Seconds from spawn to the first 200, and the app's startup timeline line"""
+    port = free_port()
+    url = f'http://127.0.0.1:{port}/api/auth/check'
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c', SERVE, str(port)], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f'server exited early:\n{proc.stdout.read()}')
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError(f'no response within {timeout}s')
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        elapsed = time.perf_counter() - started
+                        break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+    finally:
+        proc.terminate()
+        output, _ = proc.communicate(timeout=10)
+    timeline = [line for line in output.splitlines() if line.startswith('Startup timeline:')]
+    return elapsed, timeline[-1] if timeline else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    env = child_env(lazy=False)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'schema', 'apply'],
+                   cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    # One untimed start so both modes run against a warm bytecode cache
+    time_to_first_response(env, args.timeout)
+
+    results = {}
+    for lazy in (False, True):
+        mode = 'lazy' if lazy else 'eager'
+        mode_env = child_env(lazy)
+        mode_env['DATABASE_URL'] = env['DATABASE_URL']
+        times = []
+        for _ in range(args.runs):
+            elapsed, timeline = time_to_first_response(mode_env, args.timeout)
+            times.append(elapsed * 1000)
+        results[mode] = times
+        print(f"{mode:<6} first response: median {statistics.median(times):7.1f} ms, "
+              f"min {min(times):7.1f} ms, max {max(times):7.1f} ms over {args.runs} runs")
+        print(f"       {timeline}")
+
+    saved = statistics.median(results['eager']) - statistics.median(results['lazy'])
+    print(f"LAZY_INIT=1 saves {saved:.1f} ms to first response (median)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Load test: connection pool behaviour up to and past saturation.
+
+Runs rounds of simulated requests at rising concurrency. Each one checks out
+a connection through the Flask-SQLAlchemy session, runs a query and holds the
+connection for --hold-ms, like a request doing work between queries. For each
+level it reports throughput, checkout wait percentiles, pool timeouts and the
+peak in-use and overflow gauges. While concurrency fits in pool_size plus
+max_overflow, waits stay near zero. Past that, requests queue for up to
+DB_POOL_TIMEOUT and then fail fast instead of piling up.
+
+On Postgres it also checks that an API-class query running past the statement
+timeout is cancelled by the server.
+
+Usage: python benchmarks/db_pool_saturation.py [--levels 2,4,6,8,16,32,64,128] [--hold-ms 50] [--gap-ms 10] [--seconds 3]
+
+Pool settings come from DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT
+(defaults here: 4 / 2 / 1s). DATABASE_URL defaults to a throwaway SQLite file.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ.setdefault('DB_POOL_SIZE', '4')
+os.environ.setdefault('DB_MAX_OVERFLOW', '2')
+os.environ.setdefault('DB_POOL_TIMEOUT', '1')
+
+
+def run_level(app, db, concurrency, hold, gap, seconds):
+    from sqlalchemy import exc, text
+    import db_pool
+
+    with app.app_context():
+        pool = db.engine.pool
+        db_pool.pool_metrics(db.engine).reset()
+    counts = {'ok': 0, 'timeouts': 0}
+    peaks = {'checked_out': 0, 'overflow': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    stop = threading.Event()
+
+    def worker():
+        while time.perf_counter() < deadline:
+            with app.app_context():
+                try:
+                    db.session.execute(text('SELECT 1'))
+                    time.sleep(hold)
+                    outcome = 'ok'
+                except exc.TimeoutError:
+                    outcome = 'timeouts'
+                finally:
+                    db.session.remove()
+            with lock:
+                counts[outcome] += 1
+            # Time between requests on this thread (parsing, rendering, network)
+            time.sleep(random.uniform(0, gap))
+
+    def sampler():
+        while not stop.is_set():
+            peaks['checked_out'] = max(peaks['checked_out'], pool.checkedout())
+            peaks['overflow'] = max(peaks['overflow'], pool.overflow())
+            time.sleep(0.002)
+
+    watcher = threading.Thread(target=sampler, daemon=True)
+    watcher.start()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    watcher.join()
+
+    with app.app_context():
+        stats = db_pool.pool_stats(db.engine)
+    waits = stats['checkout_wait_ms']
+    print(f"{concurrency:>5} {counts['ok'] / elapsed:9.1f} {waits['p50'] or 0:9.2f} {waits['p95'] or 0:9.2f} "
+          f"{waits['max']:9.2f} {counts['timeouts']:>8} {peaks['checked_out']:>7} {max(peaks['overflow'], 0):>8}")
+
+
+def check_statement_timeout(app, db):
+    from sqlalchemy import exc, text
+    import db_pool
+
+    limit_ms = db_pool.STATEMENT_TIMEOUTS_MS['api']
+    if not limit_ms:
+        print("API statement timeout disabled; skipping")
+        return
+    with app.test_request_context('/api/benchmark'):
+        started = time.perf_counter()
+        try:
+            db.session.execute(text('SELECT pg_sleep(:s)'), {'s': limit_ms / 1000 + 2})
+            print("statement timeout: NOT enforced")
+        except exc.OperationalError as e:
+            print(f"statement timeout: cancelled after {(time.perf_counter() - started) * 1000:.0f} ms "
+                  f"(limit {limit_ms} ms): {type(e.orig).__name__}")
+        finally:
+            db.session.rollback()
+            db.session.remove()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--levels', default='2,4,6,8,16,32,64,128')
+    parser.add_argument('--hold-ms', type=float, default=50)
+    parser.add_argument('--gap-ms', type=float, default=10, help='Max pause between requests per thread.')
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    import app as app_module
+    import db_pool
+
+    app, db = app_module.app, app_module.db
+    print(f"pool_size={db_pool.POOL_SIZE} max_overflow={db_pool.MAX_OVERFLOW} "
+          f"pool_timeout={db_pool.POOL_TIMEOUT}s hold={args.hold_ms}ms")
+    print("threads   req/s   wait p50  wait p95  wait max timeouts in-use overflow")
+    for level in [int(n) for n in args.levels.split(',')]:
+        run_level(app, db, level, args.hold_ms / 1000, args.gap_ms / 1000, args.seconds)
+
+    with app.app_context():
+        if db.engine.dialect.name == 'postgresql':
+            check_statement_timeout(app, db)
+
+
+if __name__ == '__main__':
+    main()
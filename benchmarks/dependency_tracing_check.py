@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Check: outbound dependency spans for OpenAI, Stripe and the connectors API.
+
+Points the real SDKs at local HTTP stand-ins. The Replit connectors API is
+served over HTTPS with a throwaway self-signed certificate, and it hands out
+test Stripe keys. The OpenAI and Stripe stand-ins fail each operation's first
+attempt with a 503, so the SDKs retry. The check then verifies that:
+
+  1. a request keeps the X-Request-ID it was sent and reports outbound time
+     in Server-Timing
+  2. the guide chat records an 'openai' span with one retry
+  3. the customer portal records a 'replit_connectors' span and a 'stripe'
+     span (with the object id templated out of the operation), and both
+     carry the request's id
+  4. the calls slowed down by retry backoff land in the slow-call log
+  5. /metrics exports the per-dependency histograms, outcomes and retries
+
+Needs the openssl command line tool for the certificate.
+
+Usage: python benchmarks/dependency_tracing_check.py
+"""
+
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_workdir = tempfile.mkdtemp()
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_workdir, 'check.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ['SLOW_CALL_SECONDS'] = '0.3'
+os.environ['DEMO_ACCESS_TOKEN'] = 'tracing-check'
+os.environ['ADMIN_EMAILS'] = 'tracing-check@example.com'
+os.environ['REPL_IDENTITY'] = 'tracing-check'
+os.environ['METRICS_TOKEN'] = 'tracing-check'
+
+EMAIL = 'tracing-check@example.com'
+PASSWORD = 'tracing-check-1'
+REQUEST_ID = 'tracing-check-0001'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Connectors API, OpenAI chat completions and Stripe billing portal"""
+    attempts = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _first_attempt(self):
+        with self.lock:
+            n = self.attempts[self.path] = self.attempts.get(self.path, 0) + 1
+        return n == 1
+
+    def do_GET(self):
+        if self.path.startswith('/api/v2/connection'):
+            return self._reply(200, {'items': [{'settings': {'publishable': 'pk_test_check', 'secret': 'sk_test_check'}}]})
+        if self.path.startswith('/v1/'):
+            # Catalog warm-up: an empty catalog
+            kind = 'search_result' if '/search' in self.path else 'list'
+            return self._reply(200, {'object': kind, 'data': [], 'has_more': False, 'next_page': None,
+                                     'url': self.path.split('?')[0]})
+        self._reply(404, {})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/v1/chat/completions':
+            if self._first_attempt():
+                return self._reply(503, {'error': {'message': 'overloaded'}})
+            return self._reply(200, {
+                'id': 'chatcmpl-check', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-mini',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': 'Breathe slowly.'}}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+            })
+        if self.path == '/v1/billing_portal/sessions':
+            if self._first_attempt():
+                return self._reply(503, {'error': {'message': 'try again'}}, [('Stripe-Should-Retry', 'true')])
+            return self._reply(200, {'id': 'bps_check', 'object': 'billing_portal.session',
+                                     'url': 'https://billing.stripe.test/session'})
+        self._reply(404, {})
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args()
+
+    cert, key = os.path.join(_workdir, 'cert.pem'), os.path.join(_workdir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    https = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    https.socket = context.wrap_socket(https.socket, server_side=True)
+    http_port = serve(ThreadingHTTPServer(('127.0.0.1', 0), StandIn))
+
+    os.environ['REPLIT_CONNECTORS_HOSTNAME'] = f'127.0.0.1:{serve(https)}'
+    os.environ['REQUESTS_CA_BUNDLE'] = cert
+    os.environ['STRIPE_API_BASE'] = f'http://127.0.0.1:{http_port}'
+    os.environ['AI_INTEGRATIONS_OPENAI_BASE_URL'] = f'http://127.0.0.1:{http_port}/v1'
+    os.environ['AI_INTEGRATIONS_OPENAI_API_KEY'] = 'sk-check'
+
+    import app as app_module
+    import connector_credentials
+    import tracing
+    from models import User
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        user = User(id='tracing-check', email=EMAIL, first_name='Tracing', stripe_customer_id='cus_Check01')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {detail}")
+        if not ok:
+            failures.append(label)
+
+    def spans_for(request_id, dependency):
+        return [s for s in tracing.recent_spans(request_id) if s['dependency'] == dependency]
+
+    guest = app.test_client()
+    guest.get('/demo/tracing-check')
+    response = guest.post('/api/guide/chat', json={'message': 'I feel tense'}, headers={'X-Request-ID': REQUEST_ID})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    check('request id is echoed', response.headers.get('X-Request-ID') == REQUEST_ID,
+          response.headers.get('X-Request-ID'))
+    check('Server-Timing reports the OpenAI time', 'openai;dur=' in response.headers.get('Server-Timing', ''),
+          response.headers.get('Server-Timing'))
+    openai_spans = spans_for(REQUEST_ID, 'openai')
+    check('OpenAI span with its retry', len(openai_spans) == 1 and openai_spans[0]['retries'] == 1
+          and openai_spans[0]['status'] == 200, openai_spans)
+
+    client = app.test_client()
+    client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    # The catalog warm-up already fetched the Stripe keys; make the portal
+    # request fetch them again
+    for credential in connector_credentials._credentials.values():
+        credential.invalidate()
+    response = client.post('/api/stripe/customer-portal', json={})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    request_id = response.headers['X-Request-ID']
+    connector_spans = spans_for(request_id, 'replit_connectors')
+    check('connectors API span', [(s['operation'], s['status']) for s in connector_spans] == [('connection/stripe', 200)],
+          connector_spans)
+    stripe_spans = spans_for(request_id, 'stripe')
+    check('Stripe span with its retry, id templated',
+          [(s['operation'], s['status'], s['retries']) for s in stripe_spans]
+          == [('POST /v1/billing_portal/sessions', 200, 1)], stripe_spans)
+
+    slow = {s.dependency for s in tracing.slow_calls}
+    check('retried calls are in the slow-call log', {'openai', 'stripe'} <= slow, sorted(slow))
+
+    summary = client.get('/api/admin/dependencies').json['summary']
+    check('admin summary covers all three dependencies',
+          {s['dependency'] for s in summary} == {'openai', 'stripe', 'replit_connectors'},
+          [(s['dependency'], s['operation'], s['calls'], s['p50_ms']) for s in summary])
+
+    body = app.test_client().get('/metrics', headers={'Authorization': 'Bearer tracing-check'}).get_data(as_text=True)
+    wanted = [
+        'soulart_dependency_calls_total{dependency="stripe",operation="POST /v1/billing_portal/sessions",outcome="ok"} 1',
+        'soulart_dependency_retries_total{dependency="openai",operation="chat.completions.create"} 1',
+        'soulart_dependency_duration_seconds_count{dependency="replit_connectors",operation="connection/stripe"} ',
+    ]
+    missing = [line for line in wanted if line not in body]
+    check('/metrics exports dependency families', not missing, missing or 'all present')
+
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == '__main__':
+    main()
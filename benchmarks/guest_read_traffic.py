@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Load test: anonymous read traffic must not write to the database.
+
+Sends GET /api/decoder/usage from many first-time visitors (a fresh client,
+so no session cookie, per request), then from returning guests, and counts
+INSERT/UPDATE/DELETE statements and COMMITs through SQLAlchemy engine events.
+Both counts should stay at zero however many visitors arrive. A final phase
+records real decoder uses to show rows are only created then.
+
+Usage: python benchmarks/guest_read_traffic.py [--visitors 2000] [--threads 8]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to test the production setup.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+WRITE_VERBS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--visitors', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    import app as app_module
+    from models import GuestTotalUsage
+    from sqlalchemy import event
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        engine = db.engine
+
+    counts = {'writes': 0, 'commits': 0}
+    lock = threading.Lock()
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(WRITE_VERBS):
+            with lock:
+                counts['writes'] += 1
+
+    def on_commit(conn):
+        with lock:
+            counts['commits'] += 1
+
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    event.listen(engine, 'commit', on_commit)
+
+    def guest_rows():
+        with app.app_context():
+            return db.session.query(GuestTotalUsage).count()
+
+    def phase(label, requests_per_thread, make_request):
+        counts['writes'] = counts['commits'] = 0
+        rows_before = guest_rows()
+
+        def worker():
+            for _ in range(requests_per_thread):
+                make_request()
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        total = requests_per_thread * args.threads
+        print(f"{label:<20} {total} requests in {elapsed:.2f}s: "
+              f"{counts['writes']} write statements, {counts['commits']} commits, "
+              f"{guest_rows() - rows_before} new guest rows")
+        return counts['writes']
+
+    per_thread = max(1, args.visitors // args.threads)
+
+    def first_visit():
+        response = app.test_client().get('/api/decoder/usage')
+        assert response.status_code == 200 and response.json['remaining'] == 3, response.json
+
+    returning = app.test_client()
+    returning.post('/api/decoder/track-use')
+
+    def returning_visit():
+        assert returning.get('/api/decoder/usage').status_code == 200
+
+    def record_use():
+        app.test_client().post('/api/decoder/track-use')
+
+    read_writes = phase('first-time visitors', per_thread, first_visit)
+    read_writes += phase('returning guest', per_thread, returning_visit)
+    phase('recorded uses', max(1, per_thread // 10), record_use)
+
+    if read_writes:
+        print('FAIL: read-only traffic wrote to the database')
+        sys.exit(1)
+    print('OK: read-only traffic caused no writes')
+
+
+if __name__ == '__main__':
+    main()
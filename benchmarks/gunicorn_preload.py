@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-worker memory and spawn time with and without gunicorn preload.
+
+Starts gunicorn with gunicorn.conf.py twice, once with GUNICORN_PRELOAD=0 (every
+worker imports the app) and once with preload (the master imports and warms
+it, then forks). Each time it waits for every worker to report ready, sends
+some traffic so the workers touch their memory, and reads each worker's
+/proc/<pid>/smaps_rollup:
+
+  RSS  resident pages, shared ones included
+  PSS  shared pages split between the processes sharing them
+  USS  pages private to the worker (what each extra worker really costs)
+
+It also reports the time from launch to every worker being ready and the
+per-worker boot time that gunicorn.conf.py logs.
+
+Usage: python benchmarks/gunicorn_preload.py [--workers 4] [--requests 400]
+
+Linux only (reads /proc). DATABASE_URL defaults to a throwaway SQLite file.
+"""
+
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY = re.compile(r'Worker (\d+) ready in ([\d.]+) ms')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def memory_kb(pid):
+    """{'rss', 'pss', 'uss'} in kB from smaps_rollup"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'uss': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
+
+
+def run(preload, workers, requests, database_url, timeout=60):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'REPL_ID': env.get('REPL_ID', 'benchmark'),
+        'DATABASE_URL': database_url,
+        'STRIPE_WEBHOOK_WORKER': '0',
+        'STRIPE_CATALOG_RECONCILE_SECONDS': '0',
+        'GUNICORN_PRELOAD': '1' if preload else '0',
+        'WEB_CONCURRENCY': str(workers),
+    })
+    log_path = os.path.join(tempfile.mkdtemp(), 'gunicorn.log')
+    log = open(log_path, 'w')
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    try:
+        ready = {}
+        while len(ready) < workers:
+            if proc.poll() is not None or time.perf_counter() - started > timeout:
+                raise RuntimeError(f'gunicorn did not start all workers:\n{open(log_path).read()}')
+            for pid, boot_ms in READY.findall(open(log_path).read()):
+                ready.setdefault(int(pid), float(boot_ms))
+            time.sleep(0.01)
+        all_ready_ms = (time.perf_counter() - started) * 1000
+
+        url = f'http://127.0.0.1:{port}/api/auth/check'
+        for _ in range(requests):
+            urllib.request.urlopen(url, timeout=5).read()
+
+        workers_memory = [memory_kb(pid) for pid in ready]
+        master_memory = memory_kb(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        log.close()
+
+    average = {key: sum(m[key] for m in workers_memory) / len(workers_memory) for key in ('rss', 'pss', 'uss')}
+    return {
+        'all_ready_ms': all_ready_ms,
+        'boot_ms': sum(ready.values()) / len(ready),
+        'worker': average,
+        'total_pss': master_memory['pss'] + sum(m['pss'] for m in workers_memory)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=400)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    # Create the schema and warm the bytecode cache before timing anything
+    run(False, 1, 1, database_url)
+
+    results = {}
+    for preload in (False, True):
+        mode = 'preload' if preload else 'no preload'
+        r = results[mode] = run(preload, args.workers, args.requests, database_url)
+        w = r['worker']
+        print(f"{mode:<11} all {args.workers} workers ready in {r['all_ready_ms']:7.1f} ms, "
+              f"worker boot {r['boot_ms']:7.1f} ms avg")
+        print(f"{'':<11} per worker RSS {w['rss'] / 1024:6.1f} MB  PSS {w['pss'] / 1024:6.1f} MB  "
+              f"USS {w['uss'] / 1024:6.1f} MB; total PSS {r['total_pss'] / 1024:6.1f} MB")
+
+    before, after = results['no preload'], results['preload']
+    print(f"Preload saves {(before['worker']['uss'] - after['worker']['uss']) / 1024:.1f} MB private memory "
+          f"per worker, {(before['total_pss'] - after['total_pss']) / 1024:.1f} MB in total, and "
+          f"{before['all_ready_ms'] - after['all_ready_ms']:.1f} ms until all workers are ready")
+
+
+if __name__ == '__main__':
+    main()
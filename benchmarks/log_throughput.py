@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark: what logging costs the calling thread when the log sink is slow.
+
+Each of --threads worker threads writes --records request-style log lines,
+with a request id set the way tracing sets it, in three modes:
+
+  print      print() of a JSON line, as the app did before structured_log
+  sync       logging.StreamHandler with structured_log's JsonFormatter:
+             formatting and the write happen in the calling thread
+  queue      structured_log's pipeline: NonBlockingQueueHandler, with
+             formatting and the write done by a QueueListener thread
+
+Every mode writes to a real pipe. A reader thread drains the pipe at
+--drain-kbps, standing in for a log collector that falls behind. The
+benchmark reports the per-call latency seen by the worker threads
+(p50/p99/max), the calls per second, and how many lines reached the reader
+or were dropped because the queue (--queue-size) was full.
+
+Usage: python benchmarks/log_throughput.py [--threads 1,4,16] [--records 2000] [--drain-kbps 2000]
+"""
+
+import argparse
+import io
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+
+
+class Drain:
+    """Reads the pipe at a fixed rate and counts complete lines"""
+
+    def __init__(self, kbps):
+        self.read_fd, write_fd = os.pipe()
+        self.stream = io.TextIOWrapper(os.fdopen(write_fd, 'wb'), line_buffering=True)
+        self.lines = 0
+        self.chunk = 4096
+        self.pause = self.chunk / (kbps * 1024) if kbps > 0 else 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = os.read(self.read_fd, self.chunk)
+            if not data:
+                break
+            self.lines += data.count(b'\n')
+            if self.pause:
+                time.sleep(self.pause)
+
+    def close(self):
+        self.stream.close()
+        self.thread.join()
+        os.close(self.read_fd)
+
+
+def make_logger(mode, stream, queue_size):
+    import structured_log
+
+    logger = logging.getLogger(f'bench.{mode}.{id(stream)}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    listener = None
+    if mode == 'sync':
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(structured_log.JsonFormatter())
+        handler.addFilter(structured_log.ContextFilter())
+    elif mode == 'queue':
+        handler = structured_log.NonBlockingQueueHandler(queue.Queue(queue_size))
+        handler.addFilter(structured_log.ContextFilter())
+        target = logging.StreamHandler(stream)
+        target.setFormatter(structured_log.JsonFormatter())
+        listener = logging.handlers.QueueListener(handler.queue, target)
+        listener.start()
+    else:
+        return None, None
+    logger.addHandler(handler)
+    return logger, listener
+
+
+def run(mode, threads, records, kbps, queue_size):
+    import json
+
+    import structured_log
+    import tracing
+
+    drain = Drain(kbps)
+    logger, listener = make_logger(mode, drain.stream, queue_size)
+    dropped_before = structured_log.stats['dropped']
+    latencies = []
+    latencies_lock = threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker(n):
+        tracing._local.request_id = f'{n:08x}{os.urandom(4).hex()}'
+        tracing._local.request_started = time.perf_counter()
+        mine = []
+        start.wait()
+        for i in range(records):
+            t0 = time.perf_counter()
+            if logger is None:
+                print(json.dumps({'event': 'http.request', 'message': 'GET /api/journal/entries 200',
+                                  'request_id': tracing._local.request_id, 'status': 200, 'n': i}),
+                      file=drain.stream)
+            else:
+                logger.info('%s %s %s', 'GET', '/api/journal/entries', 200,
+                            extra={'event': 'http.request', 'status': 200, 'n': i})
+            mine.append(time.perf_counter() - t0)
+        with latencies_lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    start.wait()
+    started = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    if listener is not None:
+        # Let the listener finish what was queued before stopping it
+        listener.queue.join()
+        listener.stop()
+    drain.close()
+
+    latencies.sort()
+    total = len(latencies)
+    return {
+        'p50_us': latencies[total // 2] * 1e6,
+        'p99_us': latencies[min(total - 1, int(total * 0.99))] * 1e6,
+        'max_us': latencies[-1] * 1e6,
+        'calls_per_s': total / elapsed,
+        'written': drain.lines,
+        'dropped': structured_log.stats['dropped'] - dropped_before,
+        'total': total
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', default='1,4,16', help='comma-separated thread counts')
+    parser.add_argument('--records', type=int, default=2000, help='log calls per thread')
+    parser.add_argument('--drain-kbps', type=int, default=2000, help='reader speed; 0 reads as fast as it can')
+    parser.add_argument('--queue-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{args.records} records per thread, pipe drained at "
+          f"{f'{args.drain_kbps} KB/s' if args.drain_kbps else 'full speed'}, queue size {args.queue_size}")
+    print(f"{'mode':<6} {'threads':>7} {'p50 us':>8} {'p99 us':>9} {'max us':>9} {'calls/s':>10} "
+          f"{'written':>8} {'dropped':>8}")
+    for threads in [int(t) for t in args.threads.split(',')]:
+        for mode in ('print', 'sync', 'queue'):
+            r = run(mode, threads, args.records, args.drain_kbps, args.queue_size)
+            print(f"{mode:<6} {threads:>7} {r['p50_us']:>8.1f} {r['p99_us']:>9.1f} {r['max_us']:>9.0f} "
+                  f"{r['calls_per_s']:>10.0f} {r['written']:>8} {r['dropped']:>8}")
+
+
+if __name__ == '__main__':
+    main()
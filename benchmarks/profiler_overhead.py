@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cost of the request profiler, and what a profile looks like.
+
+Times GET /api/journal/entries for a user with --entries journal entries in
+three modes, taking the best of three alternating rounds:
+
+  disabled     profiler hooks removed, as when no PROFILE_TOKEN or
+               PROFILE_SAMPLE_RATE is set
+  idle         hooks installed, request not selected for profiling
+  profiled     every request sends the X-Profile header
+
+Afterwards it checks that PROFILE_DIR holds no more than PROFILE_MAX_FILES
+profiles, downloads the newest one through /api/admin/profiles, and prints
+the functions with the most self time.
+
+Usage: python benchmarks/profiler_overhead.py [--requests 300] [--entries 1000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_workdir = tempfile.mkdtemp()
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_workdir, 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ['PROFILE_TOKEN'] = 'profiler-bench'
+os.environ['PROFILE_DIR'] = os.path.join(_workdir, 'profiles')
+os.environ.setdefault('PROFILE_MAX_FILES', '20')
+os.environ['ADMIN_EMAILS'] = 'profiler-bench@example.com'
+
+EMAIL = 'profiler-bench@example.com'
+PASSWORD = 'profiler-bench-1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--entries', type=int, default=1000)
+    args = parser.parse_args()
+
+    import app as app_module
+    import profiler
+    from models import JournalEntry, User
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        user = User(id='profiler-bench', email=EMAIL, first_name='Profiler')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        for i in range(args.entries):
+            db.session.add(JournalEntry(user_id=user.id, affirmation=f'entry {i}', feelings='calm'))
+        db.session.commit()
+
+    client = app.test_client()
+    assert client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD}).status_code == 200
+
+    hooks = [
+        (app.before_request_funcs[None], profiler._start_request),
+        (app.after_request_funcs[None], profiler._finish_request),
+        (app.teardown_request_funcs[None], profiler._teardown_request),
+    ]
+
+    def set_hooks(installed):
+        for funcs, hook in hooks:
+            if installed and hook not in funcs:
+                funcs.append(hook)
+            elif not installed and hook in funcs:
+                funcs.remove(hook)
+
+    def run(headers):
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            response = client.get('/api/journal/entries', headers=headers)
+            assert response.status_code == 200
+        return (time.perf_counter() - started) / args.requests * 1e6
+
+    modes = {
+        'disabled': (False, {}),
+        'idle': (True, {}),
+        'profiled': (True, {'X-Profile': 'profiler-bench'}),
+    }
+    best = {}
+    for _ in range(3):
+        for mode, (installed, headers) in modes.items():
+            set_hooks(installed)
+            us = run(headers)
+            best[mode] = min(best.get(mode, us), us)
+    set_hooks(True)
+    # Profiles are written by the sampler thread
+    time.sleep(0.5)
+
+    print(f"GET /api/journal/entries with {args.entries} entries, {args.requests} requests per round, "
+          f"sampling every {profiler.INTERVAL_SECONDS * 1000:g} ms")
+    for mode, us in best.items():
+        print(f"  {mode:<9} {us:>9.1f} us per request  ({us - best['disabled']:+.1f} us)")
+
+    listing = client.get('/api/admin/profiles').json['profiles']
+    on_disk = len([n for n in os.listdir(profiler.PROFILE_DIR) if n.endswith('.folded')])
+    print(f"Profiles kept: {on_disk} on disk (PROFILE_MAX_FILES={profiler.MAX_FILES}), {len(listing)} listed")
+    assert on_disk <= profiler.MAX_FILES
+
+    newest = listing[0]
+    response = client.get(f"/api/admin/profiles/{newest['name']}")
+    assert response.status_code == 200
+    folded = response.get_data(as_text=True)
+    print(f"Newest: {newest['name']}  {newest['duration_ms']} ms, {newest['samples']} samples, "
+          f"{len(folded.splitlines())} distinct stacks")
+
+    # Profiles are short; merge them all for a steadier picture
+    self_time = Counter()
+    for name in os.listdir(profiler.PROFILE_DIR):
+        if name.endswith('.folded'):
+            with open(os.path.join(profiler.PROFILE_DIR, name)) as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    self_time[stack.rsplit(';', 1)[-1]] += int(count)
+    total = sum(self_time.values()) or 1
+    print("Most self time across the kept profiles:")
+    for frame, count in self_time.most_common(8):
+        print(f"  {count / total * 100:5.1f}%  {frame}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Check: SQL statements per API route against the declared query budgets.
+
+Runs the API routes that touch the database, as a signed-in member with
+--entries journal entries (with doodles), oracle readings and discovery
+sessions, and as a guest. It uses QUERY_AUDIT=1, then prints the statements
+each request ran next to the route's @query_budget and the audit's findings:
+
+  N+1         one statement shape repeated QUERY_AUDIT_REPEATS+ times
+  slow        statements over QUERY_AUDIT_SLOW_MS
+  full scan   full-table scans found by EXPLAIN
+
+Exits non-zero when a route goes over its budget or runs a full scan it has
+not accepted with @allow_full_scan(reason). With --strict, N+1 and slow
+findings also fail the check. This makes it usable as a CI step. Budgets are
+declared to hold at any data size, so raising --entries shows whether a
+route's query count grows with the data.
+
+DATABASE_URL defaults to a throwaway SQLite file. Point it at a scratch
+Postgres database to get Postgres plans for the full-scan check.
+
+Usage: python benchmarks/query_budget_check.py [--entries 25] [--strict]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ['QUERY_AUDIT'] = '1'
+os.environ['ADMIN_EMAILS'] = 'query-budget@example.com'
+
+EMAIL = 'query-budget@example.com'
+PASSWORD = 'query-budget-1'
+DOODLE = 'data:image/png;base64,' + 'A' * 2048
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entries', type=int, default=25)
+    parser.add_argument('--strict', action='store_true', help='fail on N+1 and slow-query findings too')
+    args = parser.parse_args()
+
+    import app as app_module
+    import query_audit
+    from models import DiscoverySession, JournalEntry, OracleReading, User
+
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        user = User(id='query-budget', email=EMAIL, first_name='Query', last_name='Budget')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        for i in range(args.entries):
+            db.session.add(JournalEntry(user_id=user.id, affirmation=f'entry {i}', doodle_image=DOODLE))
+            db.session.add(OracleReading(user_id=user.id, cards_drawn='["sun"]', card_messages='["shine"]'))
+            db.session.add(DiscoverySession(user_id=user.id, category_counts='{}', layers_data='[]'))
+        db.session.commit()
+
+    member = app.test_client()
+    guest = app.test_client()
+
+    def created_id(response, key='id'):
+        return response.get_json()[key]
+
+    entry_id = reading_id = discovery_id = guest_discovery_id = None
+    calls = [
+        (guest, 'POST', '/api/auth/register', {'email': 'new-member@example.com', 'password': 'new-member-1'}),
+        (guest, 'POST', '/api/auth/login', {'email': 'nobody@example.com', 'password': 'wrong-password'}),
+        (member, 'POST', '/api/auth/login', {'email': EMAIL, 'password': PASSWORD}),
+        (member, 'GET', '/api/auth/check', None),
+        (member, 'GET', '/api/bootstrap', None),
+        (member, 'GET', '/api/profile', None),
+        (member, 'GET', '/api/journal/entries', None),
+        (member, 'GET', '/api/journal/entries?fields=id,affirmation,created_at', None),
+        (member, 'POST', '/api/journal/entries', {'affirmation': 'budgeted'}),
+        (member, 'POST', '/api/journal/save-doodle', {'image': DOODLE, 'note': 'doodle'}),
+        (member, 'POST', '/api/markings/save', {'image': DOODLE}),
+        (member, 'DELETE', lambda: f'/api/journal/entries/{entry_id}', None),
+        (member, 'POST', '/api/oracle/readings', {'cards_drawn': ['moon'], 'card_messages': ['rest']}),
+        (member, 'GET', '/api/oracle/readings', None),
+        (member, 'PUT', lambda: f'/api/oracle/readings/{reading_id}', {'reflection': 'calm'}),
+        (member, 'POST', '/api/discovery/sessions', {'blessing_text': 'peace', 'is_completed': True}),
+        (member, 'GET', '/api/discovery/sessions', None),
+        (member, 'GET', '/api/discovery/sessions/latest', None),
+        (member, 'PUT', lambda: f'/api/discovery/sessions/{discovery_id}', {'session_notes': 'noted'}),
+        (member, 'GET', '/api/stripe/subscription', None),
+        (member, 'GET', '/api/guide/usage', None),
+        (member, 'GET', '/api/decoder/usage', None),
+        (member, 'POST', '/api/decoder/track-use', {}),
+        (member, 'GET', '/api/bookings', None),
+        (guest, 'POST', '/api/booking', {'name': 'Guest', 'email': 'guest@example.com', 'session_type': 'healing'}),
+        (guest, 'GET', '/api/auth/check', None),
+        (guest, 'GET', '/api/bootstrap', None),
+        (guest, 'POST', '/api/decoder/track-use', {}),
+        (guest, 'GET', '/api/decoder/usage', None),
+        (guest, 'POST', '/api/discovery/sessions', {'blessing_text': 'guest peace'}),
+        (guest, 'GET', '/api/discovery/sessions', None),
+        (guest, 'PUT', lambda: f'/api/discovery/sessions/{guest_discovery_id}', {'session_notes': 'guest note'}),
+        (guest, 'GET', '/api/guide/usage', None),
+        (member, 'POST', '/api/auth/logout', None),
+    ]
+
+    rows = []
+    for client, method, path, body in calls:
+        if callable(path):
+            path = path()
+        before = len(query_audit.reports)
+        response = client.open(path, method=method, json=body)
+        assert len(query_audit.reports) > before, f'{method} {path} was not audited'
+        report = query_audit.reports[-1]
+        rows.append(report)
+        if method == 'POST' and path == '/api/journal/entries':
+            entry_id = created_id(response)
+        elif method == 'POST' and path == '/api/oracle/readings':
+            reading_id = created_id(response)
+        elif method == 'POST' and path == '/api/discovery/sessions':
+            if client is member:
+                discovery_id = created_id(response)
+            else:
+                guest_discovery_id = created_id(response)
+
+    over = []
+    scanned = []
+    flagged = []
+    print(f"{'route':<52} {'status':>6} {'stmts':>5} {'budget':>6}  findings")
+    for r in rows:
+        findings = [f"N+1 x{x['count']}" for x in r['repeated']]
+        findings += [f"slow {x['ms']:.0f}ms" for x in r['slow']]
+        allowed = f" (allowed: {r['full_scan_allowed']})" if r['full_scan_allowed'] else ''
+        findings += [f"full scan: {', '.join(x['plan'])}{allowed}" for x in r['full_scans']]
+        budget = '-' if r['budget'] is None else r['budget']
+        mark = ' OVER' if r['over_budget'] else ''
+        print(f"{r['method'] + ' ' + r['endpoint']:<52} {r['status']:>6} {r['statements']:>5} {budget:>6}{mark}  "
+              f"{'; '.join(findings)}")
+        if r['over_budget']:
+            over.append(r)
+        if r['full_scans'] and not r['full_scan_allowed']:
+            scanned.append(r)
+        if r['repeated'] or r['slow']:
+            flagged.append(r)
+
+    unbudgeted = sorted({f"{r['method']} {r['endpoint']}" for r in rows if r['budget'] is None})
+    if unbudgeted:
+        print(f"No declared budget: {', '.join(unbudgeted)}")
+    if over or scanned or (args.strict and flagged):
+        sys.exit(f"{len(over)} requests over budget, {len(scanned)} with full scans not allowed, "
+                 f"{len(flagged)} with N+1 or slow findings")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for the atomic quota engine.
+
+Fires many simultaneous decoder uses at one free member and one guest, and
+simultaneous Guide messages at one premium member with a token budget, each
+from its own thread and database connection. Exits non-zero if any limit is
+exceeded or any counter loses an increment.
+
+Usage: python benchmarks/quota_stress.py [--threads 50] [--rounds 5]
+
+DATABASE_URL defaults to a throwaway SQLite file, which serialises writers;
+point it at a scratch Postgres database to exercise real row-level
+concurrency.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+
+def hammer(app, db, threads, work):
+    """Run work() once per thread, all released at the same moment"""
+    barrier = threading.Barrier(threads)
+    results = []
+    lock = threading.Lock()
+
+    def run():
+        with app.app_context():
+            barrier.wait()
+            try:
+                outcome = work()
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                outcome = ('error', str(e))
+            finally:
+                db.session.remove()
+        with lock:
+            results.append(outcome)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    import app as app_module
+    from models import User, GuestTotalUsage, TIER_PREMIUM
+    from quota import (consume_user_decoder_use, consume_guest_decoder_use,
+                       consume_guide_message, add_guide_tokens, DECODER_FREE_LIMIT)
+
+    app, db = app_module.app, app_module.db
+    failures = []
+
+    for round_number in range(1, args.rounds + 1):
+        with app.app_context():
+            free_user = User(id=str(uuid.uuid4()), email=f'{uuid.uuid4().hex}@bench.local')
+            premium_user = User(id=str(uuid.uuid4()), email=f'{uuid.uuid4().hex}@bench.local',
+                                subscription_tier=TIER_PREMIUM)
+            db.session.add_all([free_user, premium_user])
+            db.session.commit()
+            free_id, premium_id = free_user.id, premium_user.id
+        guest_id = str(uuid.uuid4())
+
+        def free_use():
+            return consume_user_decoder_use(db, db.session.get(User, free_id))[0]
+
+        def guest_use():
+            return consume_guest_decoder_use(db, guest_id)[0]
+
+        # Budget of 10 messages' worth of tokens; each message spends 100
+        def guide_message():
+            user = db.session.get(User, premium_id)
+            allowed, _ = consume_guide_message(db, user, daily_token_budget=1000)
+            if allowed:
+                add_guide_tokens(db, user, 100)
+            return allowed
+
+        checks = [
+            ('free member decoder', free_use, DECODER_FREE_LIMIT),
+            ('guest decoder', guest_use, DECODER_FREE_LIMIT),
+            ('premium guide budget', guide_message, None),
+        ]
+        for label, work, limit in checks:
+            results = hammer(app, db, args.threads, work)
+            errors = [r for r in results if isinstance(r, tuple)]
+            allowed = sum(1 for r in results if r is True)
+            ok = not errors and (allowed == limit if limit is not None else allowed >= 1)
+            print(f"round {round_number}: {label:<22} allowed {allowed:>3}/{args.threads}"
+                  f"{'' if ok else '  <-- FAILED'}{f' errors={errors[:1]}' if errors else ''}")
+            if not ok:
+                failures.append((round_number, label))
+
+        with app.app_context():
+            free_user = db.session.get(User, free_id)
+            guest = db.session.query(GuestTotalUsage).filter_by(session_id=guest_id).one()
+            premium_user = db.session.get(User, premium_id)
+            if free_user.decoder_total_uses != DECODER_FREE_LIMIT:
+                failures.append((round_number, f'free counter {free_user.decoder_total_uses}'))
+            if guest.decoder_total_uses != DECODER_FREE_LIMIT:
+                failures.append((round_number, f'guest counter {guest.decoder_total_uses}'))
+            if premium_user.guide_tokens_today != premium_user.guide_messages_today * 100:
+                failures.append((round_number, 'guide tokens lost an increment'))
+
+    if failures:
+        print(f"FAILED: {failures}")
+        sys.exit(1)
+    print("All limits held.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+# Start a local Postgres primary and a streaming read replica for
+# benchmarks/replica_routing_check.py.
+#
+# Usage: benchmarks/replica_pair.sh start|stop [DIR]
+#
+# Needs the Postgres server binaries (initdb, pg_ctl, pg_basebackup) on PATH.
+# Ports come from PRIMARY_PORT (5441) and REPLICA_PORT (5442), and the data
+# directories are placed under DIR (default /tmp/soulart-replica-pair).
+# To see the fallback against a really stopped replica while the app is
+# serving, run: pg_ctl -D DIR/replica stop
+set -euo pipefail
+
+ACTION="${1:-start}"
+DIR="${2:-/tmp/soulart-replica-pair}"
+PRIMARY_PORT="${PRIMARY_PORT:-5441}"
+REPLICA_PORT="${REPLICA_PORT:-5442}"
+
+case "$ACTION" in
+  start)
+    mkdir -p "$DIR"
+    if [ ! -d "$DIR/primary" ]; then
+      initdb -D "$DIR/primary" -U postgres --auth=trust >/dev/null
+      cat >> "$DIR/primary/postgresql.conf" <<EOF
+port = $PRIMARY_PORT
+listen_addresses = '127.0.0.1'
+unix_socket_directories = '$DIR'
+wal_level = replica
+max_wal_senders = 4
+hot_standby = on
+EOF
+      echo "host replication postgres 127.0.0.1/32 trust" >> "$DIR/primary/pg_hba.conf"
+    fi
+    pg_ctl -D "$DIR/primary" -l "$DIR/primary.log" -w start >/dev/null
+    psql -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres -tc "SELECT 1 FROM pg_database WHERE datname = 'soulart'" \
+      | grep -q 1 || createdb -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres soulart
+
+    if [ ! -d "$DIR/replica" ]; then
+      # -R writes standby.signal and primary_conninfo
+      pg_basebackup -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres -D "$DIR/replica" -R -X stream >/dev/null
+      echo "port = $REPLICA_PORT" >> "$DIR/replica/postgresql.conf"
+    fi
+    pg_ctl -D "$DIR/replica" -l "$DIR/replica.log" -w start >/dev/null
+
+    echo "export DATABASE_URL=postgresql://postgres@127.0.0.1:$PRIMARY_PORT/soulart"
+    echo "export DATABASE_REPLICA_URL=postgresql://postgres@127.0.0.1:$REPLICA_PORT/soulart"
+    ;;
+  stop)
+    pg_ctl -D "$DIR/replica" -w stop >/dev/null 2>&1 || true
+    pg_ctl -D "$DIR/primary" -w stop >/dev/null 2>&1 || true
+    ;;
+  *)
+    echo "usage: $0 start|stop [DIR]" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Check: read/write routing between a primary and a read replica.
+
+Runs against two database nodes and counts the statements each one receives
+(SQLAlchemy engine events) while it verifies that:
+
+  1. replica_reads() GET handlers query the replica and nothing else
+  2. writes go to the primary, and for REPLICA_STICKY_SECONDS afterwards the
+     writer's reads also go to the primary, so they see their own write
+  3. once the window passes, reads go back to the replica
+  4. with the replica down, reads fall back to the primary (still 200) and
+     the replica is not retried until REPLICA_RETRY_SECONDS have passed
+  5. after that, reads return to the replica
+
+By default the two nodes are local SQLite files. The "replica" is a copy of
+the primary taken at sync points, so it lags like a real replica does. To use
+two local Postgres instances with streaming replication instead, start them
+with benchmarks/replica_pair.sh and export the DATABASE_URL and
+DATABASE_REPLICA_URL it prints. The replica is taken down by pointing the
+replica bind at an unreachable address.
+
+Usage: python benchmarks/replica_routing_check.py
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_workdir = tempfile.mkdtemp()
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(_workdir, 'primary.db'))
+os.environ.setdefault('DATABASE_REPLICA_URL', 'sqlite:///' + os.path.join(_workdir, 'replica.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ.setdefault('REPLICA_STICKY_SECONDS', '1')
+os.environ.setdefault('REPLICA_RETRY_SECONDS', '1')
+
+EMAIL = 'replica-check@example.com'
+PASSWORD = 'replica-check-1'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args()
+
+    from sqlalchemy import create_engine, event
+    import app as app_module
+    import db_routing
+    from models import User
+
+    app, db = app_module.app, app_module.db
+    sqlite = os.environ['DATABASE_URL'].startswith('sqlite')
+
+    with app.app_context():
+        primary = db.engine
+        replica = db.engines[db_routing.REPLICA_BIND]
+        user = User(id='replica-check', email=EMAIL, first_name='Replica')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        db.session.remove()
+
+    def sync_replica():
+        """Bring the replica up to date with the primary"""
+        if sqlite:
+            replica.dispose()
+            shutil.copyfile(primary.url.database, replica.url.database)
+        else:
+            time.sleep(0.5)
+
+    counts = {}
+
+    def counter(name):
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            counts[name] = counts.get(name, 0) + 1
+        return on_execute
+
+    event.listen(primary, 'before_cursor_execute', counter('primary'))
+    event.listen(replica, 'before_cursor_execute', counter('replica'))
+
+    def get(client, path):
+        counts.clear()
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code, response.get_data(as_text=True))
+        return response.json, dict(counts)
+
+    failures = []
+
+    def check(label, ok, detail):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {detail}")
+        if not ok:
+            failures.append(label)
+
+    client = app.test_client()
+    response = client.post('/api/auth/login', json={'email': EMAIL, 'password': PASSWORD})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    sync_replica()
+    time.sleep(db_routing.STICKY_SECONDS + 0.1)
+
+    entries, used = get(client, '/api/journal/entries')
+    check('reads use the replica', used.get('replica') and not used.get('primary'), used)
+
+    counts.clear()
+    response = client.post('/api/journal/entries', json={'affirmation': 'read your writes'})
+    entry_id = response.json['id']
+    check('writes use the primary', response.status_code == 201 and counts.get('primary') and not counts.get('replica'),
+          dict(counts))
+
+    entries, used = get(client, '/api/journal/entries')
+    seen = any(e['id'] == entry_id for e in entries)
+    check('reads right after a write stay on the primary', seen and not used.get('replica'),
+          f"{used}, new entry visible: {seen}")
+
+    time.sleep(db_routing.STICKY_SECONDS + 0.1)
+    entries, used = get(client, '/api/journal/entries')
+    seen = any(e['id'] == entry_id for e in entries)
+    check('reads return to the replica after the window', used.get('replica') and not used.get('primary'),
+          f"{used}, new entry visible on the (lagging) replica: {seen}")
+    sync_replica()
+
+    with app.app_context():
+        engines = db.engines
+        if sqlite:
+            unreachable = create_engine('sqlite:///' + os.path.join(_workdir, 'missing', 'replica.db'))
+        else:
+            unreachable = create_engine(replica.url.set(host='127.0.0.1', port=1))
+        engines[db_routing.REPLICA_BIND] = unreachable
+        # Watch it for failures, as the app does its real replica engine
+        db_routing.install(db)
+    failures_before = db_routing.stats['replica_failures']
+
+    profile, used = get(client, '/api/profile')
+    check('replica down: reads fall back to the primary', used.get('primary') and not used.get('replica'),
+          f"{used}, fallbacks {db_routing.stats['fallbacks']}")
+    get(client, '/api/oracle/readings')
+    check('replica down: not retried inside the retry window',
+          db_routing.stats['replica_failures'] == failures_before + 1,
+          f"replica failures {db_routing.stats['replica_failures'] - failures_before}")
+
+    with app.app_context():
+        db.engines[db_routing.REPLICA_BIND] = replica
+    time.sleep(db_routing.RETRY_SECONDS + 0.1)
+    entries, used = get(client, '/api/journal/entries')
+    check('replica back: reads return to it', used.get('replica') and not used.get('primary'), used)
+
+    print(db_routing.routing_stats())
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark: cost of request instrumentation when nobody is scraping.
+
+Times the instrumentation hooks directly: the per-request start/finish pair,
+and the per-statement engine event pair. These are the only work added to a
+request between scrapes. It then compares end-to-end test-client requests
+with the hooks installed and removed (best of three alternating rounds), and finally times one /metrics render.
+
+Usage: python benchmarks/request_metrics_overhead.py [--iterations 200000] [--requests 3000]
+
+DATABASE_URL defaults to a throwaway SQLite file.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ['REQUEST_METRICS'] = '1'
+
+
+def per_call_us(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=3000)
+    args = parser.parse_args()
+
+    import app as app_module
+    import request_metrics
+
+    app, db = app_module.app, app_module.db
+    response = app.response_class('{}', mimetype='application/json')
+
+    with app.test_request_context('/api/journal/entries'):
+        from flask import request
+        request.url_rule = next(r for r in app.url_map.iter_rules() if r.rule == '/api/journal/entries')
+
+        def one_request():
+            request_metrics._start_request()
+            request_metrics._finish_request(response)
+
+        hooks_us = per_call_us(one_request, args.iterations)
+
+        class Conn:
+            info = {}
+
+        conn = Conn()
+
+        def one_statement():
+            request_metrics._before_cursor_execute(conn, None, '', None, None, False)
+            request_metrics._after_cursor_execute(conn, None, '', None, None, False)
+
+        request_metrics._start_request()
+        statement_us = per_call_us(one_statement, args.iterations)
+    print(f"request hooks (start + finish):  {hooks_us:6.2f} us per request")
+    print(f"SQL events (before + after):     {statement_us:6.2f} us per statement")
+
+    client = app.test_client()
+
+    def timed_requests():
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            client.get('/api/auth/check')
+        return (time.perf_counter() - started) / args.requests * 1e6
+
+    def install_hooks(on):
+        before, after = app.before_request_funcs[None], app.after_request_funcs[None]
+        if on and request_metrics._start_request not in before:
+            before.insert(0, request_metrics._start_request)
+            after.insert(0, request_metrics._finish_request)
+        elif not on and request_metrics._start_request in before:
+            before.remove(request_metrics._start_request)
+            after.remove(request_metrics._finish_request)
+
+    timed_requests()
+    with_hooks, without_hooks = [], []
+    for _ in range(3):
+        install_hooks(True)
+        with_hooks.append(timed_requests())
+        install_hooks(False)
+        without_hooks.append(timed_requests())
+    with_hooks, without_hooks = min(with_hooks), min(without_hooks)
+    print(f"GET /api/auth/check end to end:  {with_hooks:6.1f} us with, {without_hooks:6.1f} us without "
+          f"(difference {with_hooks - without_hooks:+.1f} us; best of 3)")
+
+    with app.app_context():
+        started = time.perf_counter()
+        body = request_metrics.render(app_module.db_pool.gauges(db.engines))
+    print(f"one /metrics render:             {(time.perf_counter() - started) * 1000:6.2f} ms "
+          f"({len(body.splitlines())} lines)")
+
+
+if __name__ == '__main__':
+    main()
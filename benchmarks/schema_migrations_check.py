@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Round-trip check for schema migrations and the hot-query indexes.
+
+Starts from a database in the shape an older release left behind (every
+migration rolled back, so the new columns and indexes are missing), seeds
+rows, applies all migrations, verifies them and EXPLAINs each hot query to
+confirm it uses its index. Then it rolls everything back and applies it
+again. Exits non-zero on any failure.
+
+Usage: python benchmarks/schema_migrations_check.py [--rows 2000]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to exercise CREATE INDEX CONCURRENTLY and the real planner.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    args = parser.parse_args()
+
+    import app as app_module
+    import schema_migrations
+    from sqlalchemy import text
+
+    app, db = app_module.app, app_module.db
+    problems = []
+
+    with app.app_context():
+        engine = db.engine
+        schema_migrations.upgrade(engine, echo=lambda message: None)
+        schema_migrations.rollback(engine, 'base')
+        missing = [version for version, _, ok, _ in schema_migrations.verify(engine) if ok]
+        if missing:
+            problems.append(f'rollback left {missing} in place')
+
+        with engine.begin() as conn:
+            user_ids = [str(uuid.uuid4()) for _ in range(max(1, args.rows // 20))]
+            conn.execute(text("INSERT INTO users (id, email, subscription_tier, is_member, decoder_total_uses, "
+                              "guide_messages_today, decoder_uses_today, stripe_customer_id, created_at, updated_at) "
+                              "VALUES (:id, :email, 'free', false, 0, 0, 0, :customer, "
+                              "CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"),
+                         [{'id': uid, 'email': f'{uid}@bench.local', 'customer': f'cus_{uid[:14]}'}
+                          for uid in user_ids])
+            conn.execute(text("INSERT INTO journal_entries (user_id, affirmation, created_at) "
+                              "VALUES (:user_id, 'a', CURRENT_TIMESTAMP)"),
+                         [{'user_id': user_ids[i % len(user_ids)]} for i in range(args.rows)])
+
+        applied = schema_migrations.upgrade(engine)
+        if len(applied) != len(schema_migrations.MIGRATIONS):
+            problems.append(f'expected every migration to apply, got {applied}')
+
+        for cycle in ('first apply', 're-apply'):
+            for version, is_applied, ok, detail in schema_migrations.verify(engine):
+                print(f'{cycle}: {version:<45} {detail}')
+                if not (is_applied and ok):
+                    problems.append(f'{cycle}: {version} {detail}')
+            for name, index, used, plan in schema_migrations.explain_hot_queries(engine):
+                print(f"{cycle}: {name:<30} {'uses' if used else 'DOES NOT USE'} {index}")
+                if not used:
+                    problems.append(f'{cycle}: {name} does not use {index}:\n{plan}')
+            if cycle == 'first apply':
+                schema_migrations.rollback(engine, 'base')
+                schema_migrations.upgrade(engine)
+
+    if problems:
+        print('\nFAIL:\n' + '\n'.join(problems))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
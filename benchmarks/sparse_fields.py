@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Payload size and response time of the list APIs with and without ?fields=.
+
+Seeds one member with journal entries (some with doodle images), oracle
+readings and discovery sessions, then requests each list endpoint in full
+and with the sparse field set a lite/mobile list view needs, reporting bytes
+per response and median request time (query, serialisation and JSON).
+
+Usage: python benchmarks/sparse_fields.py [--rows 200] [--repeat 20]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to include realistic column I/O.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+CASES = [
+    ('/api/journal/entries', 'id,created_at,affirmation,emotion_selected'),
+    ('/api/oracle/readings', 'id,created_at,reflection'),
+    ('/api/discovery/sessions', 'id,started_at,total_categories,total_shadow_count'),
+]
+
+
+def seed(db, rows):
+    from models import User, JournalEntry, OracleReading, DiscoverySession
+
+    email = f'{uuid.uuid4().hex}@bench.local'
+    user = User(id=str(uuid.uuid4()), email=email)
+    user.set_password('benchmark')
+    db.session.add(user)
+    doodle = 'data:image/png;base64,' + 'A' * 20000
+    text = 'A gentle reflection on what came up today. ' * 10
+    for i in range(rows):
+        db.session.add(JournalEntry(
+            user_id=user.id, affirmation=f'Affirmation {i}', general_reflection=text,
+            feelings=text, what_came_up=text, next_steps=text, emotion_selected='Joy',
+            doodle_image=doodle if i % 5 == 0 else None
+        ))
+        db.session.add(OracleReading(
+            user_id=user.id,
+            cards_drawn=json.dumps([f'Card {n}' for n in range(3)]),
+            card_messages=json.dumps([text] * 3),
+            reflection='Noted.'
+        ))
+        db.session.add(DiscoverySession(
+            user_id=user.id,
+            category_counts=json.dumps({f'category_{n}': n for n in range(12)}),
+            layers_data=json.dumps([{'layer': n, 'notes': text} for n in range(5)]),
+            total_categories=12, total_shadow_count=66
+        ))
+    db.session.commit()
+    return email
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    import app as app_module
+    app, db = app_module.app, app_module.db
+
+    with app.app_context():
+        email = seed(db, args.rows)
+
+    client = app.test_client()
+    client.post('/api/auth/login', json={'email': email, 'password': 'benchmark'})
+
+    def measure(url):
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            response = client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        return len(response.get_data()), statistics.median(timings)
+
+    print(f"{'endpoint':<26} {'variant':<7} {'bytes':>10} {'median ms':>10}")
+    for path, fields in CASES:
+        full_bytes, full_ms = measure(path)
+        sparse_bytes, sparse_ms = measure(f'{path}?fields={fields}')
+        print(f"{path:<26} {'full':<7} {full_bytes:>10} {full_ms:>10.2f}")
+        print(f"{path:<26} {'sparse':<7} {sparse_bytes:>10} {sparse_ms:>10.2f}   "
+              f"({100 * (1 - sparse_bytes / full_bytes):.0f}% smaller, "
+              f"{full_ms / sparse_ms:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
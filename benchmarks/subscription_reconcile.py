@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the nightly subscription reconciliation job.
+
+Runs reconcile_subscriptions against a local Stripe stand-in that serves
+paginated subscription listings (100 per page, customers expanded), with a
+configurable share of users whose stored subscription has drifted. Checks
+that every drifted user is corrected.
+
+Usage: python benchmarks/subscription_reconcile.py [--customers 100000] [--drift 0.05] [--page-latency-ms 0]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to benchmark the production setup.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+
+class LocalStripe:
+    """Serves Subscription.list pages from memory the way the SDK's
+    auto-pagination would request them"""
+
+    def __init__(self, subscriptions, page_latency):
+        self.subscriptions = subscriptions
+        self.page_latency = page_latency
+        self.pages = 0
+        stand_in = self
+
+        class Subscription:
+            @staticmethod
+            def list(limit=100, **kwargs):
+                return stand_in._pages(limit)
+
+        self.Subscription = Subscription
+
+    def _pages(self, limit):
+        stand_in = self
+
+        class Listing:
+            def auto_paging_iter(self):
+                for start in range(0, len(stand_in.subscriptions), limit):
+                    stand_in.pages += 1
+                    if stand_in.page_latency:
+                        time.sleep(stand_in.page_latency)
+                    yield from stand_in.subscriptions[start:start + limit]
+
+        return Listing()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--drift', type=float, default=0.05, help='fraction of users out of sync')
+    parser.add_argument('--page-latency-ms', type=float, default=0, help='simulated Stripe latency per page')
+    args = parser.parse_args()
+
+    import app as app_module
+    from models import User
+    from sqlalchemy import insert, func
+    from subscription_reconcile import reconcile_subscriptions
+
+    app, db = app_module.app, app_module.db
+    rng = random.Random(42)
+    period_end = int((datetime.utcnow() + timedelta(days=20)).timestamp())
+    price = {'id': 'price_bench', 'product': 'prod_bench', 'metadata': {'tier': 'premium'}}
+
+    subscriptions = []
+    rows = []
+    drifted = 0
+    for i in range(args.customers):
+        customer_id = f'cus_bench_{i}'
+        status = 'active' if i % 4 else 'canceled'
+        subscriptions.append({
+            'id': f'sub_bench_{i}',
+            'status': status,
+            'current_period_end': period_end,
+            'customer': {'id': customer_id, 'metadata': {'app': 'soulart_temple'}},
+            'items': {'data': [{'price': price}]}
+        })
+        in_sync = rng.random() >= args.drift
+        drifted += not in_sync
+        active = status == 'active'
+        rows.append({
+            'id': str(uuid.uuid4()),
+            'email': f'{customer_id}@bench.local',
+            'stripe_customer_id': customer_id,
+            'subscription_tier': ('premium' if active else 'free') if in_sync else ('free' if active else 'premium'),
+            'stripe_subscription_id': (f'sub_bench_{i}' if active else None) if in_sync else None,
+            'subscription_expires_at': datetime.fromtimestamp(period_end) if active and in_sync else None,
+            'is_member': active == in_sync,
+            'decoder_total_uses': 0,
+            'guide_messages_today': 0,
+            'guide_tokens_today': 0,
+            'decoder_uses_today': 0
+        })
+
+    with app.app_context():
+        db.session.query(User).filter(User.email.like('%@bench.local')).delete(synchronize_session=False)
+        for start in range(0, len(rows), 5000):
+            db.session.execute(insert(User), rows[start:start + 5000])
+        db.session.commit()
+
+        stand_in = LocalStripe(subscriptions, args.page_latency_ms / 1000)
+        started = time.perf_counter()
+        report = reconcile_subscriptions(db, stand_in)
+        elapsed = time.perf_counter() - started
+
+        second = reconcile_subscriptions(db, LocalStripe(subscriptions, 0), dry_run=True)
+        dialect = db.engine.dialect.name
+
+    print(f"Database: {dialect}")
+    print(f"Customers: {args.customers}, drifted: {drifted}, pages fetched: {stand_in.pages}")
+    print(f"Changed {report['users_changed']} users {report['summary']} in {elapsed:.2f}s "
+          f"(Stripe fetch {report['fetch_seconds']:.2f}s)")
+    print(f"Second pass differences: {second['users_changed']}")
+    assert report['users_changed'] == drifted
+    assert second['users_changed'] == 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Commit-rate benchmark for write-behind usage counting.
+
+Drives /api/decoder/track-use for paid members from several threads, first
+with every increment committed immediately and then with USAGE_WRITE_BEHIND
+buffering, counting database COMMITs through a SQLAlchemy engine event. After
+a final flush it checks that no increment was lost.
+
+The Guide's metering is measured the same way. Each thread records
+completions for premium members through record_guide_usage, as
+/api/guide/chat does after the OpenAI call. The check then confirms that
+every GuideUsageEvent row and daily rollup message arrived.
+
+Usage: python benchmarks/usage_write_behind.py [--threads 8] [--requests 250] [--users 20]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to benchmark the production setup.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=250, help='requests per thread')
+    parser.add_argument('--users', type=int, default=20)
+    args = parser.parse_args()
+
+    import app as app_module
+    import usage_buffer
+    from guide_metering import record_guide_usage
+    from models import GuideUsageDaily, GuideUsageEvent, User, TIER_BASIC, TIER_PREMIUM
+    from quota import buffers_usage
+    from sqlalchemy import event, func
+
+    app, db = app_module.app, app_module.db
+
+    with app.app_context():
+        emails = [f'{uuid.uuid4().hex}@bench.local' for _ in range(args.users)]
+        for email in emails:
+            user = User(id=str(uuid.uuid4()), email=email, subscription_tier=TIER_BASIC)
+            user.set_password('benchmark')
+            db.session.add(user)
+        premium_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+        for user_id in premium_ids:
+            db.session.add(User(id=user_id, email=f'{user_id}@bench.local', subscription_tier=TIER_PREMIUM))
+        db.session.commit()
+        engine = db.engine
+
+    commits = [0]
+    event.listen(engine, 'commit', lambda conn: commits.__setitem__(0, commits[0] + 1))
+
+    def total_uses():
+        with app.app_context():
+            return db.session.query(func.sum(User.decoder_total_uses)).filter(User.email.in_(emails)).scalar() or 0
+
+    def run(label):
+        clients = []
+        for i in range(args.threads):
+            client = app.test_client()
+            client.post('/api/auth/login', json={'email': emails[i % len(emails)], 'password': 'benchmark'})
+            clients.append(client)
+
+        before_uses = total_uses()
+        commits[0] = 0
+        errors = []
+
+        def worker(client):
+            for _ in range(args.requests):
+                response = client.post('/api/decoder/track-use')
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        request_commits = commits[0]
+
+        usage_buffer._flush_in_app_context(app, db)
+        recorded = total_uses() - before_uses
+        sent = args.threads * args.requests
+        print(f"{label:<14} {sent} requests in {elapsed:.2f}s ({sent / elapsed:.0f} req/s), "
+              f"{request_commits} commits ({request_commits / elapsed:.0f}/s), "
+              f"recorded {recorded}/{sent}{' LOST INCREMENTS' if recorded != sent else ''}"
+              f"{f' errors={len(errors)}' if errors else ''}")
+        return request_commits / elapsed
+
+    def guide_totals():
+        with app.app_context():
+            events = db.session.query(func.count(GuideUsageEvent.id)).filter(
+                GuideUsageEvent.user_id.in_(premium_ids)).scalar()
+            messages = db.session.query(func.sum(GuideUsageDaily.message_count)).filter(
+                GuideUsageDaily.user_id.in_(premium_ids)).scalar()
+            return events or 0, messages or 0
+
+    def run_guide(label):
+        usage = {'prompt_tokens': 400, 'completion_tokens': 300, 'cached_tokens': 0}
+        before_events, before_messages = guide_totals()
+        commits[0] = 0
+
+        def worker(i):
+            with app.app_context():
+                user = db.session.get(User, premium_ids[i % len(premium_ids)])
+                for _ in range(args.requests):
+                    record_guide_usage(db, user, 'gpt-4o-mini', usage, 900)
+                    if not buffers_usage(user):
+                        db.session.commit()
+                db.session.remove()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        request_commits = commits[0]
+
+        usage_buffer._flush_in_app_context(app, db)
+        events, messages = guide_totals()
+        sent = args.threads * args.requests
+        lost = events - before_events != sent or messages - before_messages != sent
+        print(f"{label:<14} {sent} Guide completions in {elapsed:.2f}s, {request_commits} commits, "
+              f"recorded {events - before_events} events / {messages - before_messages} rollup messages"
+              f"{' LOST INCREMENTS' if lost else ''}")
+        return request_commits / elapsed
+
+    usage_buffer.WRITE_BEHIND_ENABLED = False
+    immediate = run('immediate')
+    guide_immediate = run_guide('immediate')
+    usage_buffer.WRITE_BEHIND_ENABLED = True
+    usage_buffer.start_flusher(app, db)
+    buffered = run('write-behind')
+    guide_buffered = run_guide('write-behind')
+    print(f"Commit rate reduced by {100 * (1 - buffered / immediate):.1f}% for decoder uses, "
+          f"{100 * (1 - guide_buffered / guide_immediate):.1f}% for Guide metering "
+          f"({usage_buffer.buffer.flushes} flushes, {usage_buffer.buffer.rows_flushed} rows)")
+
+
+if __name__ == '__main__':
+    main()
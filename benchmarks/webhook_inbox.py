@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the Stripe webhook inbox.
+
+Replays a set of recorded Stripe events through /api/stripe/webhook,
+measuring acknowledgement latency, then drains the inbox and measures
+processing throughput. Redeliveries are included to exercise deduplication.
+
+Events come from a JSONL file of recorded events (one Stripe event per line)
+or are synthesised in the same shape when no file is given.
+
+Afterwards a backoff case checks that events waiting for a retry do not
+starve the rest of the inbox. More than BATCH_SIZE of the oldest pending
+events are put in backoff, and fresh events are added behind them. One of
+the fresh events belongs to a customer that is backing off. Every other
+fresh event must be processed in the next drain, and the blocked customer's
+event must stay pending.
+
+Usage: python benchmarks/webhook_inbox.py [--events recorded.jsonl] [--count 5000]
+
+DATABASE_URL defaults to a throwaway SQLite file; point it at a scratch
+Postgres database to benchmark the production setup.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('REPL_ID', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ['STRIPE_WEBHOOK_WORKER'] = '0'
+os.environ['STRIPE_CATALOG_RECONCILE_SECONDS'] = '0'
+os.environ.pop('STRIPE_WEBHOOK_SECRET', None)
+
+
+def synthesise_events(count, customers):
+    events = []
+    created = int(time.time()) - count
+    types = ['customer.subscription.updated', 'invoice.payment_succeeded', 'customer.subscription.created']
+    for i in range(count):
+        customer = customers[i % len(customers)]
+        event_type = types[i % len(types)]
+        if event_type.startswith('customer.subscription'):
+            obj = {
+                'object': 'subscription',
+                'id': f'sub_{customer}',
+                'customer': customer,
+                'status': 'active',
+                'current_period_end': created + 30 * 86400,
+                'items': {'data': [{'price': {'id': 'price_bench_premium', 'product': 'prod_bench_premium'}}]}
+            }
+        else:
+            obj = {'object': 'invoice', 'id': f'in_{i}', 'customer': customer, 'subscription': f'sub_{customer}'}
+        events.append({
+            'id': f'evt_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': event_type,
+            'created': created + i,
+            'data': {'object': obj}
+        })
+    return events
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def backoff_case(app_module, db, fresh=50):
+    """Returns (processed, fresh events, blocked event still pending)"""
+    import webhook_inbox
+    from models import StripeWebhookEvent, WEBHOOK_PENDING
+
+    backing_off = webhook_inbox.BATCH_SIZE + 50
+    retry_at = datetime.utcnow() + timedelta(hours=1)
+    db.session.query(StripeWebhookEvent).delete()
+    for i in range(backing_off):
+        db.session.add(StripeWebhookEvent(
+            id=f'evt_backoff_{i}', event_type='invoice.payment_failed', customer_id=f'cus_backoff_{i}',
+            payload=json.dumps({'type': 'invoice.payment_failed', 'data': {'object': {}}}),
+            stripe_created=i, attempts=1, last_error='simulated', next_attempt_at=retry_at
+        ))
+    # Newer events: one behind a backing-off customer, the rest for other customers
+    for i in range(fresh + 1):
+        customer = 'cus_backoff_0' if i == fresh else f'cus_fresh_{i}'
+        db.session.add(StripeWebhookEvent(
+            id=f'evt_fresh_{i}', event_type='invoice.payment_succeeded', customer_id=customer,
+            payload=json.dumps({'type': 'invoice.payment_succeeded', 'data': {'object': {'customer': customer}}}),
+            stripe_created=backing_off + i
+        ))
+    db.session.commit()
+
+    processed, _ = app_module.drain_until_idle(db, lambda event_type, obj: None)
+    blocked = db.session.get(StripeWebhookEvent, f'evt_fresh_{fresh}')
+    return processed, fresh, blocked.status == WEBHOOK_PENDING
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', help='JSONL file of recorded Stripe events')
+    parser.add_argument('--count', type=int, default=5000, help='events to synthesise')
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--duplicates', type=float, default=0.1, help='fraction of events redelivered')
+    args = parser.parse_args()
+
+    import app as app_module
+    from models import User, StripeWebhookEvent
+
+    class LocalStripe:
+        """Stand-in for the Stripe SDK so processing makes no network calls"""
+        class Product:
+            @staticmethod
+            def retrieve(product_id):
+                return {'id': product_id, 'metadata': {'tier': 'premium'}}
+
+    app_module.get_stripe_client = lambda: LocalStripe
+
+    app, db = app_module.app, app_module.db
+
+    if args.events:
+        with open(args.events) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        customers = sorted({app_module.event_customer_id(e) for e in events} - {None})
+    else:
+        customers = [f'cus_bench_{i}' for i in range(args.customers)]
+        events = synthesise_events(args.count, customers)
+
+    with app.app_context():
+        db.session.query(StripeWebhookEvent).delete()
+        for customer in customers:
+            if not db.session.query(User).filter_by(stripe_customer_id=customer).first():
+                db.session.add(User(id=str(uuid.uuid4()), email=f'{customer}@bench.local', stripe_customer_id=customer))
+        db.session.commit()
+
+    redeliveries = events[:int(len(events) * args.duplicates)]
+    client = app.test_client()
+    ack_ms = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        for event in events + redeliveries:
+            t0 = time.perf_counter()
+            response = client.post('/api/stripe/webhook', data=json.dumps(event),
+                                   headers={'Stripe-Signature': 'benchmark'})
+            ack_ms.append((time.perf_counter() - t0) * 1000)
+            assert response.status_code == 200, response.get_json()
+        ingest_seconds = time.perf_counter() - started
+
+        with app.app_context():
+            started = time.perf_counter()
+            processed, failed = app_module.drain_until_idle(db, app_module.dispatch_stripe_event)
+            drain_seconds = time.perf_counter() - started
+            stats = app_module.inbox_stats(db)
+            dialect = db.engine.dialect.name
+            backoff_processed, backoff_fresh, blocked_pending = backoff_case(app_module, db)
+
+    print(f"Database: {dialect}")
+    print(f"Delivered {len(events) + len(redeliveries)} requests ({len(redeliveries)} redeliveries) in {ingest_seconds:.2f}s")
+    print(f"  ack latency p50={percentile(ack_ms, 50):.2f}ms p99={percentile(ack_ms, 99):.2f}ms max={max(ack_ms):.2f}ms")
+    print(f"  ingest throughput {len(ack_ms) / ingest_seconds:.0f} req/s")
+    print(f"Drained {processed} events ({failed} failed) in {drain_seconds:.2f}s")
+    print(f"  processing throughput {processed / drain_seconds:.0f} events/s")
+    print(f"Inbox: {stats}")
+    print(f"Backoff case: {backoff_processed}/{backoff_fresh} fresh events processed behind "
+          f"more than a batch of backing-off events; blocked customer's event "
+          f"{'still pending' if blocked_pending else 'PROCESSED OUT OF ORDER'}")
+    if backoff_processed != backoff_fresh or not blocked_pending:
+        sys.exit("Backoff case failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fetched connection is served before it must be refreshed
+CREDENTIAL_TTL_SECONDS = int(os.environ.get('CONNECTOR_CREDENTIAL_TTL', '300'))
+# Within this many seconds of expiry a background refresh is started while
+# the cached value keeps being served
+REFRESH_AHEAD_SECONDS = int(os.environ.get('CONNECTOR_REFRESH_AHEAD', '60'))
+# After a failed refresh, keep serving the last good value for this long
+# before trying again
+FAILURE_BACKOFF_SECONDS = 15
+# (connect, read) timeouts for the connectors API
+REQUEST_TIMEOUT = (3.05, 10)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Shared pooled HTTP session for calls to the Replit connectors API"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                http = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                http.mount('https://', adapter)
+                http.mount('http://', adapter)
+                _http_session = http
+    return _http_session
+
+
+def get_replit_token():
+    x_replit_token = os.environ.get('REPL_IDENTITY')
+    if x_replit_token:
+        return 'repl ' + x_replit_token
+    x_replit_token = os.environ.get('WEB_REPL_RENEWAL')
+    if x_replit_token:
+        return 'depl ' + x_replit_token
+    return None
+
+
+def get_target_environment():
+    is_production = os.environ.get('REPLIT_DEPLOYMENT') == '1'
+    return 'production' if is_production else 'development'
+
+
+def fetch_connection(connector_name, environment=None):
+    """Fetch a connector's connection (with secrets) from the connectors API"""
+    hostname = os.environ.get('REPLIT_CONNECTORS_HOSTNAME')
+    x_replit_token = get_replit_token()
+
+    if not x_replit_token or not hostname:
+        raise Exception('Replit connection credentials not found')
+
+    params = {
+        'include_secrets': 'true',
+        'connector_names': connector_name
+    }
+    if environment:
+        params['environment'] = environment
+
+    with tracing.span('replit_connectors', f'connection/{connector_name}') as span:
+        response = get_http_session().get(
+            f'https://{hostname}/api/v2/connection',
+            params=params,
+            headers={
+                'Accept': 'application/json',
+                'X_REPLIT_TOKEN': x_replit_token
+            },
+            timeout=REQUEST_TIMEOUT
+        )
+        span.status = response.status_code
+    response.raise_for_status()
+
+    items = response.json().get('items', [])
+    if not items:
+        raise Exception(f'{connector_name} connection not found')
+    return items[0]
+
+
+def _parse_expiry(value):
+    """Seconds since epoch for an expires_at value, or None"""
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class CachedCredential:
+    """In-process cache of one connector's secrets.
+
+    Serves the cached value until it is close to expiry, then refreshes it in
+    the background (only one refresh in flight at a time). If a refresh fails
+    the last good value keeps being served and the error is recorded.
+    """
+
+    def __init__(self, connector_name, parse, environment=None, ttl=CREDENTIAL_TTL_SECONDS,
+                 refresh_ahead=REFRESH_AHEAD_SECONDS):
+        self.connector_name = connector_name
+        self.parse = parse
+        self.environment = environment
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._value = None
+        self._fetched_at = None
+        self._expires_at = None
+        self._retry_after = 0.0
+        self._refresh_lock = threading.Lock()
+        self.fetch_count = 0
+        self.failure_count = 0
+        self.total_fetch_ms = 0.0
+        self.last_fetch_ms = None
+        self.last_error = None
+
+    def get(self):
+        now = time.time()
+        if self._value is not None:
+            if now < self._expires_at - self.refresh_ahead or now < self._retry_after:
+                return self._value
+            if now < self._expires_at:
+                self._refresh_in_background()
+                return self._value
+
+        # Missing or expired: refresh inline, letting concurrent callers wait
+        # for the single in-flight fetch instead of issuing their own
+        with self._refresh_lock:
+            now = time.time()
+            if self._value is not None and (now < self._expires_at or now < self._retry_after):
+                return self._value
+            try:
+                return self._refresh()
+            except Exception:
+                if self._value is not None:
+                    return self._value
+                raise
+
+    def _refresh_in_background(self):
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._refresh()
+            except Exception:
+                pass
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, name=f'{self.connector_name}-credential-refresh', daemon=True).start()
+
+    def _refresh(self):
+        started = time.perf_counter()
+        try:
+            connection = fetch_connection(self.connector_name, self.environment)
+            value = self.parse(connection)
+        except Exception as e:
+            self.failure_count += 1
+            self.last_error = str(e)
+            self._retry_after = time.time() + FAILURE_BACKOFF_SECONDS
+            logger.error("Credential refresh failed for %s: %s", self.connector_name, e,
+                         extra={'event': 'connector.refresh_failed', 'connector': self.connector_name})
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.fetch_count += 1
+            self.total_fetch_ms += elapsed_ms
+            self.last_fetch_ms = elapsed_ms
+
+        now = time.time()
+        expires_at = now + self.ttl
+        token_expiry = _parse_expiry(connection.get('settings', {}).get('expires_at'))
+        if token_expiry:
+            expires_at = min(expires_at, token_expiry)
+        self._value = value
+        self._fetched_at = now
+        self._expires_at = expires_at
+        self.last_error = None
+        return value
+
+    def invalidate(self):
+        self._value = None
+
+    def metrics(self):
+        now = time.time()
+        return {
+            'connector': self.connector_name,
+            'environment': self.environment,
+            'cached': self._value is not None,
+            'cache_age_seconds': round(now - self._fetched_at, 3) if self._fetched_at else None,
+            'expires_in_seconds': round(self._expires_at - now, 3) if self._expires_at else None,
+            'fetch_count': self.fetch_count,
+            'failure_count': self.failure_count,
+            'last_fetch_ms': round(self.last_fetch_ms, 3) if self.last_fetch_ms is not None else None,
+            'avg_fetch_ms': round(self.total_fetch_ms / self.fetch_count, 3) if self.fetch_count else None,
+            'last_error': self.last_error
+        }
+
+
+_credentials = {}
+_credentials_lock = threading.Lock()
+
+
+def get_cached_credential(connector_name, parse, environment=None):
+    """Return the shared CachedCredential for a connector/environment pair"""
+    key = (connector_name, environment)
+    credential = _credentials.get(key)
+    if credential is None:
+        with _credentials_lock:
+            credential = _credentials.get(key)
+            if credential is None:
+                credential = CachedCredential(connector_name, parse, environment)
+                _credentials[key] = credential
+    return credential
+
+
+def get_credential_metrics():
+    return [credential.metrics() for credential in list(_credentials.values())]
+
+
+def reset_after_fork():
+    """Drop the pooled HTTP session and any locks inherited from the parent
+    process. Cached credentials are kept; they are safe to share."""
+    global _http_session, _http_session_lock, _credentials_lock
+    _http_session = None
+    _http_session_lock = threading.Lock()
+    _credentials_lock = threading.Lock()
+    for credential in _credentials.values():
+        credential._refresh_lock = threading.Lock()
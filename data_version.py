@@ -0,0 +1,77 @@
+import hashlib
+from itertools import chain
+
+from flask import current_app, jsonify, request
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+
+from models import User, JournalEntry, OracleReading, DiscoverySession
+
+# Writes to these bump the owning user's data_version
+VERSIONED_MODELS = (JournalEntry, OracleReading, DiscoverySession)
+
+# Bump when the JSON shape of a versioned endpoint changes, so clients holding
+# an ETag for the old shape get a full response
+ETAG_FORMAT = 1
+
+users_table = User.__table__
+
+
+def _changed_owners(session):
+    owners = set()
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, VERSIONED_MODELS) and obj.user_id:
+            owners.add(obj.user_id)
+    for obj in session.dirty:
+        if isinstance(obj, VERSIONED_MODELS) and obj.user_id and session.is_modified(obj):
+            owners.add(obj.user_id)
+    return owners
+
+
+def _bump_data_versions(session, flush_context):
+    owners = session.info.pop('data_version_owners', None)
+    if not owners:
+        return
+    session.connection().execute(
+        update(users_table)
+        .where(users_table.c.id.in_(owners))
+        .values(data_version=users_table.c.data_version + 1)
+    )
+
+
+def _collect_owners(session, flush_context, instances):
+    owners = _changed_owners(session)
+    if owners:
+        session.info.setdefault('data_version_owners', set()).update(owners)
+
+
+def install():
+    """Bump users.data_version in the same transaction as any flush that
+    adds, changes or deletes a journal entry, oracle reading or discovery
+    session belonging to that user."""
+    if not event.contains(Session, 'before_flush', _collect_owners):
+        event.listen(Session, 'before_flush', _collect_owners)
+        event.listen(Session, 'after_flush', _bump_data_versions)
+
+
+def data_etag(resource, user, *parts):
+    """Strong ETag for one user's view of a resource at their current data
+    version. The query string is included so each variant gets its own tag."""
+    key = ':'.join(str(part) for part in (
+        ETAG_FORMAT, resource, user.id, user.data_version or 0, *parts,
+        request.query_string.decode('latin-1')
+    ))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def versioned_json(resource, user, build, *parts):
+    """Answer If-None-Match with 304 from the user's data version alone;
+    otherwise call build() and send its JSON with the ETag."""
+    etag = data_etag(resource, user, *parts)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,258 @@
+"""Database connection pool management.
+
+Pool sizing comes from the environment. Liveness is handled without a ping on
+every checkout. TCP keepalives catch dead peers. pool_recycle retires old
+connections, and a connection is pinged only when it has sat idle in the pool
+for longer than PING_IDLE_SECONDS. Postgres gets a statement_timeout chosen by
+request class, and checkout wait time plus pool gauges are kept for the
+metrics endpoints.
+"""
+import os
+import threading
+import time
+import weakref
+from collections import deque
+
+from flask import has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+# Seconds a request waits for a free connection before failing
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '300'))
+# Connections idle longer than this are pinged before reuse (0 pings every checkout)
+PING_IDLE_SECONDS = float(os.environ.get('DB_PING_IDLE_SECONDS', '30'))
+
+# Server-side statement timeouts per request class, in ms (0 = no limit)
+STATEMENT_TIMEOUTS_MS = {
+    'api': int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '5000')),
+    'webhook': int(os.environ.get('DB_STATEMENT_TIMEOUT_WEBHOOK_MS', '10000')),
+    'admin': int(os.environ.get('DB_STATEMENT_TIMEOUT_ADMIN_MS', '30000')),
+    'background': int(os.environ.get('DB_STATEMENT_TIMEOUT_BACKGROUND_MS', '0')),
+}
+
+# Recent checkout waits kept for percentiles
+WAIT_SAMPLES = 2048
+
+
+def _is_memory_sqlite(url):
+    return url.startswith('sqlite') and (url in ('sqlite://', 'sqlite:///') or ':memory:' in url)
+
+
+def engine_options(database_url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database"""
+    database_url = database_url or ''
+    if _is_memory_sqlite(database_url):
+        return {}
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        # Reuse the most recently returned connection so idle ones age out
+        'pool_use_lifo': True,
+    }
+    if database_url.startswith('postgres'):
+        options['connect_args'] = {
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+        }
+    return options
+
+
+class PoolMetrics:
+    """Checkout wait times, timeouts and stale-connection pings for one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits_ms = deque(maxlen=WAIT_SAMPLES)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.stale_pings = 0
+        self.stale_disconnects = 0
+
+    def record_wait(self, wait_ms, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self._waits_ms.append(wait_ms)
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def wait_percentiles(self):
+        with self._lock:
+            waits = sorted(self._waits_ms)
+        if not waits:
+            return {'p50': None, 'p95': None, 'p99': None}
+        pick = lambda q: round(waits[min(len(waits) - 1, int(q * len(waits)))], 3)
+        return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+    def reset(self):
+        with self._lock:
+            self._waits_ms.clear()
+            self.checkouts = self.timeouts = self.stale_pings = self.stale_disconnects = 0
+            self.total_wait_ms = self.max_wait_ms = 0.0
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    # Log under sqlalchemy.* like QueuePool, so pool chatter stays at the
+    # sqlalchemy loggers' WARNING level instead of the root INFO level
+    _sqla_logger_namespace = 'sqlalchemy.pool.impl.QueuePool'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_wait((time.perf_counter() - started) * 1000, timed_out=True)
+            raise
+        self.metrics.record_wait((time.perf_counter() - started) * 1000)
+        return connection
+
+
+def pool_metrics(engine):
+    """PoolMetrics for the engine's current pool (a fresh one after dispose)"""
+    metrics = getattr(engine.pool, 'metrics', None)
+    if metrics is None:
+        metrics = engine.pool.metrics = PoolMetrics()
+    return metrics
+
+
+def request_class():
+    """Which statement timeout applies to the current unit of work"""
+    if not has_request_context():
+        return 'background'
+    path = request.path
+    if path.startswith('/api/admin/'):
+        return 'admin'
+    if path == '/api/stripe/webhook':
+        return 'webhook'
+    return 'api'
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    if connection_record is not None:
+        connection_record.info['checked_in_at'] = time.monotonic()
+
+
+def _ping_if_stale(metrics, dbapi_connection, connection_record):
+    """Ping only connections that sat idle long enough to have gone stale;
+    a failed ping makes the pool retry with a fresh connection"""
+    checked_in_at = connection_record.info.get('checked_in_at')
+    if checked_in_at is None or time.monotonic() - checked_in_at < PING_IDLE_SECONDS:
+        return
+    metrics.stale_pings += 1
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+        dbapi_connection.rollback()
+    except Exception:
+        metrics.stale_disconnects += 1
+        raise exc.DisconnectionError('stale pooled connection')
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+def _apply_statement_timeout(dbapi_connection, connection_record, connection_proxy):
+    """Set statement_timeout for this request class on checkout, only when
+    the pooled connection's current setting differs (so usually no extra
+    round trip). Committed at once so a later rollback cannot undo it."""
+    timeout_ms = STATEMENT_TIMEOUTS_MS.get(request_class(), 0)
+    if connection_record.info.get('statement_timeout_ms') == timeout_ms:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f'SET statement_timeout = {int(timeout_ms)}')
+        dbapi_connection.commit()
+    finally:
+        cursor.close()
+    connection_record.info['statement_timeout_ms'] = timeout_ms
+
+
+_installed = weakref.WeakSet()
+
+
+def install(engine):
+    """Attach liveness handling and, on Postgres, statement timeouts"""
+    if engine in _installed:
+        return
+    _installed.add(engine)
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        _ping_if_stale(pool_metrics(engine), dbapi_connection, connection_record)
+
+    event.listen(engine, 'checkin', _on_checkin)
+    event.listen(engine, 'checkout', on_checkout)
+    if engine.dialect.name == 'postgresql':
+        event.listen(engine, 'checkout', _apply_statement_timeout)
+
+
+def pool_stats(engine):
+    """Current pool gauges plus checkout wait statistics"""
+    pool = engine.pool
+    metrics = pool_metrics(engine)
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'timeout_seconds': pool.timeout(),
+        })
+    stats.update({
+        'checkouts': metrics.checkouts,
+        'checkout_timeouts': metrics.timeouts,
+        'checkout_wait_ms': {
+            'avg': round(metrics.total_wait_ms / metrics.checkouts, 3) if metrics.checkouts else None,
+            'max': round(metrics.max_wait_ms, 3),
+            **metrics.wait_percentiles()
+        },
+        'stale_pings': metrics.stale_pings,
+        'stale_disconnects': metrics.stale_disconnects,
+        'statement_timeouts_ms': STATEMENT_TIMEOUTS_MS,
+    })
+    return stats
+
+
+def gauges(engines):
+    """Pool gauges for request_metrics.render(), one series per bind"""
+    pid = os.getpid()
+    samples = {
+        'soulart_db_pool_checked_out': ('Connections currently checked out.', []),
+        'soulart_db_pool_overflow': ('Connections open beyond pool_size.', []),
+        'soulart_db_pool_size': ('Configured pool_size.', []),
+        'soulart_db_pool_checkout_timeouts': ('Checkouts that timed out since the pool was created.', []),
+        'soulart_db_pool_checkout_wait_p95_seconds': ('95th percentile checkout wait, recent checkouts.', []),
+    }
+    for bind, engine in engines.items():
+        stats = pool_stats(engine)
+        if 'size' not in stats:
+            continue
+        labels = {'bind': bind or 'primary', 'pid': pid}
+        samples['soulart_db_pool_checked_out'][1].append((labels, stats['checked_out']))
+        samples['soulart_db_pool_overflow'][1].append((labels, stats['overflow']))
+        samples['soulart_db_pool_size'][1].append((labels, stats['size']))
+        samples['soulart_db_pool_checkout_timeouts'][1].append((labels, stats['checkout_timeouts']))
+        p95 = stats['checkout_wait_ms']['p95']
+        samples['soulart_db_pool_checkout_wait_p95_seconds'][1].append((labels, (p95 or 0) / 1000))
+    return [(name, help_text, values) for name, (help_text, values) in samples.items()]
@@ -0,0 +1,208 @@
+"""Read/write routing between the primary database and a read replica.
+
+Handlers wrapped in replica_reads() send their SELECTs to the 'replica' bind
+(DATABASE_REPLICA_URL). Everything else goes to the primary: flushes, DML,
+any request without the decorator, and background work outside a request.
+A visitor who has written within the last STICKY_SECONDS reads from the
+primary too, so replica lag never hides their own writes. When the replica
+can't be reached, reads fall back to the primary and the replica is not
+retried for RETRY_SECONDS. Reachability is checked at most every
+CHECK_SECONDS; a read that fails on the replica in between is run again on
+the primary.
+"""
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc
+
+logger = logging.getLogger(__name__)
+
+REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_BIND = 'replica'
+# Seconds after a write during which that visitor reads from the primary
+STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '10'))
+# Seconds to keep reads on the primary after the replica fails
+RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', '30'))
+# Seconds a successful replica connection check is trusted for. In between,
+# a failing query marks the replica down through the handle_error hook.
+CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '5'))
+
+STICKY_KEY = '_db_primary_until'
+
+_lock = threading.Lock()
+_replica_down_until = 0.0
+_replica_checked_at = None
+# replica_reads counts statements sent to the replica; replica_sessions the
+# sessions that used it; replica_checks the connection checks made
+stats = {'replica_reads': 0, 'replica_sessions': 0, 'replica_checks': 0, 'sticky_primary_reads': 0,
+         'fallbacks': 0, 'replica_failures': 0}
+
+
+def _count(key):
+    with _lock:
+        stats[key] += 1
+
+
+def enabled():
+    return bool(REPLICA_URL)
+
+
+def mark_replica_down(reason):
+    global _replica_down_until
+    with _lock:
+        first = _replica_down_until <= time.monotonic()
+        _replica_down_until = time.monotonic() + RETRY_SECONDS
+        stats['replica_failures'] += 1
+    if first:
+        logger.warning("Read replica unavailable, using the primary for %.0fs: %s", RETRY_SECONDS, reason,
+                       extra={'event': 'db.replica_down'})
+
+
+def _replica_check_due():
+    return _replica_checked_at is None or time.monotonic() - _replica_checked_at >= CHECK_SECONDS
+
+
+def _check_replica(engine):
+    """Open and close a replica connection, at most once per CHECK_SECONDS
+    per process. Returns False (and marks the replica down) when it fails."""
+    global _replica_checked_at
+    if not _replica_check_due():
+        return True
+    _count('replica_checks')
+    try:
+        engine.connect().close()
+    except exc.DBAPIError as e:
+        mark_replica_down(e.orig)
+        return False
+    with _lock:
+        _replica_checked_at = time.monotonic()
+    return True
+
+
+def replica_available():
+    return enabled() and time.monotonic() >= _replica_down_until
+
+
+def routing_stats():
+    return {
+        'replica_configured': enabled(),
+        'replica_available': replica_available(),
+        'sticky_seconds': STICKY_SECONDS,
+        **stats
+    }
+
+
+class RoutingSession(Session):
+    """db.session class that sends read-only statements of replica_reads()
+    handlers to the replica bind"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._reads_from_replica(clause):
+            replica = self._replica_engine()
+            if replica is not None:
+                _count('replica_reads')
+                return replica
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+    def _reads_from_replica(self, clause):
+        if self._flushing or self.info.get('wrote'):
+            return False
+        if clause is not None and getattr(clause, 'is_dml', False):
+            return False
+        return has_request_context() and g.get('read_replica', False)
+
+    def _replica_engine(self):
+        """The replica engine, or None (meaning: use the primary) when it
+        failed its connection check"""
+        if not replica_available():
+            return None
+        engine = self._db.engines.get(REPLICA_BIND)
+        if engine is None:
+            return None
+        if not self.info.get('replica_checked'):
+            if not _check_replica(engine):
+                _count('fallbacks')
+                return None
+            self.info['replica_checked'] = True
+            _count('replica_sessions')
+        return engine
+
+
+def _note_write(session, flush_context=None):
+    session.info['wrote'] = True
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _note_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _note_write(orm_execute_state.session)
+
+
+def _on_replica_error(context):
+    # No connection yet means connecting failed
+    if context.is_disconnect or context.connection is None:
+        mark_replica_down(context.original_exception)
+        if has_request_context():
+            g.replica_failed = True
+
+
+def bind_config(engine_options):
+    """SQLALCHEMY_BINDS entry for the replica, or {} when none is configured"""
+    if not enabled():
+        return {}
+    return {REPLICA_BIND: {'url': REPLICA_URL, **engine_options(REPLICA_URL)}}
+
+
+def install(db):
+    """Track writes for stickiness and watch the replica for failures.
+    Call inside an app context."""
+    if not event.contains(Session, 'after_flush', _note_write):
+        event.listen(Session, 'after_flush', _note_write)
+        event.listen(Session, 'do_orm_execute', _note_dml)
+    replica = db.engines.get(REPLICA_BIND)
+    if replica is not None and not event.contains(replica, 'handle_error', _on_replica_error):
+        event.listen(replica, 'handle_error', _on_replica_error)
+
+
+def replica_reads(f):
+    """Route a read-only handler's queries to the replica, unless this
+    visitor wrote recently (read-your-writes). If the replica fails during
+    the handler, it runs again on the primary."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not enabled():
+            return f(*args, **kwargs)
+        if session.get(STICKY_KEY, 0) > time.time():
+            _count('sticky_primary_reads')
+            return f(*args, **kwargs)
+        g.read_replica = True
+        try:
+            result = f(*args, **kwargs)
+        except exc.DBAPIError:
+            if not g.get('replica_failed'):
+                raise
+            result = None
+        if not g.pop('replica_failed', False):
+            return result
+        # Handlers catch their own errors, so the failure may only show as
+        # their 500 response; they only read, so running them again is safe
+        g.read_replica = False
+        current_app.extensions['sqlalchemy'].session.rollback()
+        _count('fallbacks')
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def remember_writes(response):
+    """after_request hook: keep a visitor who just wrote on the primary for
+    STICKY_SECONDS"""
+    if enabled() and g.get('db_wrote'):
+        session[STICKY_KEY] = time.time() + STICKY_SECONDS
+    return response
@@ -0,0 +1,124 @@
+import os
+import time
+from datetime import datetime
+
+from flask import current_app, g, request, session
+from flask_login import current_user
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from models import User
+
+COOKIE_NAME = 'soulart_entitlements'
+# Lifetime of an entitlements token. Tier changes made outside the user's own
+# requests (Stripe webhooks, reconciliation) reach the cookie within this
+# window, so gates that grant paid access check the users row instead.
+TTL_SECONDS = int(os.environ.get('ENTITLEMENTS_TTL_SECONDS', '300'))
+
+
+class Entitlements:
+    """The logged-in user as described by a valid entitlements cookie.
+
+    Carries just enough for auth checks and tier gates, and quacks like a
+    User for them, so those paths never load the users row.
+    """
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, claims, issued_at):
+        self.claims = claims
+        self.issued_at = issued_at
+        self.id = claims['i']
+        self.email = claims.get('e')
+        self.first_name = claims.get('f')
+        self.last_name = claims.get('l')
+        self.name = claims.get('n')
+        self.profile_image_url = claims.get('p')
+        self.subscription_tier = claims.get('t') or 'free'
+        expires = claims.get('x')
+        self.subscription_expires_at = datetime.utcfromtimestamp(expires) if expires else None
+
+    def get_id(self):
+        return self.id
+
+    has_active_subscription = User.has_active_subscription
+
+
+def display_name(user):
+    name = f"{user.first_name or ''} {user.last_name or ''}".strip()
+    return name or (user.email or '').split('@')[0]
+
+
+def claims_for(user):
+    """Compact token claims for a User row"""
+    expires = user.subscription_expires_at
+    return {
+        'i': user.id,
+        'e': user.email,
+        'f': user.first_name,
+        'l': user.last_name,
+        'n': display_name(user),
+        'p': user.profile_image_url,
+        't': user.subscription_tier or 'free',
+        'x': int((expires - datetime(1970, 1, 1)).total_seconds()) if expires else None
+    }
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='soulart-entitlements')
+
+
+def load_entitlements():
+    """Entitlements from the request's cookie, or None when it is missing,
+    expired, tampered with or belongs to a different login session."""
+    if 'entitlements' in g:
+        return g.entitlements
+    entitlements = None
+    token = request.cookies.get(COOKIE_NAME)
+    if token:
+        try:
+            claims, issued_at = _serializer().loads(token, max_age=TTL_SECONDS, return_timestamp=True)
+        except BadSignature:
+            claims = None
+        # Bound to the Flask-Login session, so it stops working at logout
+        if claims and session.get('_user_id') == claims.get('i'):
+            entitlements = Entitlements(claims, issued_at)
+    g.entitlements = entitlements
+    return entitlements
+
+
+def entitled_user():
+    """The current user for auth checks and tier gates: the cookie's
+    entitlements when valid, otherwise the database-backed current_user."""
+    return load_entitlements() or current_user
+
+
+def refresh_entitlements_cookie(response):
+    """after_request hook: whenever this request loaded the user anyway,
+    reissue the cookie if its claims changed or it is past half its life;
+    drop it once the user is logged out."""
+    # Flask-Login sets this only if something touched current_user
+    user = g.get('_login_user')
+    if user is None:
+        return response
+
+    if not user.is_authenticated:
+        if COOKIE_NAME in request.cookies:
+            response.delete_cookie(COOKIE_NAME)
+        return response
+
+    claims = claims_for(user)
+    current = load_entitlements()
+    if (current is not None and current.claims == claims
+            and time.time() - current.issued_at.timestamp() < TTL_SECONDS / 2):
+        return response
+
+    response.set_cookie(
+        COOKIE_NAME,
+        _serializer().dumps(claims),
+        max_age=TTL_SECONDS,
+        httponly=True,
+        secure=current_app.config.get('SESSION_COOKIE_SECURE', False),
+        samesite='Lax'
+    )
+    return response
@@ -0,0 +1,258 @@
+import os
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, delete, func, select, text
+
+from models import GuestUsage, GuestTotalUsage, DiscoverySession
+
+# Days to keep each kind of guest data (0 disables that purge)
+GUEST_USAGE_RETENTION_DAYS = int(os.environ.get('GUEST_USAGE_RETENTION_DAYS', '30'))
+GUEST_TOTAL_USAGE_RETENTION_DAYS = int(os.environ.get('GUEST_TOTAL_USAGE_RETENTION_DAYS', '180'))
+GUEST_DISCOVERY_RETENTION_DAYS = int(os.environ.get('GUEST_DISCOVERY_RETENTION_DAYS', '90'))
+
+# Rows per DELETE / commit, and the pause between batches, so each
+# transaction holds its row locks only briefly
+BATCH_SIZE = int(os.environ.get('GUEST_RETENTION_BATCH_SIZE', '1000'))
+BATCH_PAUSE_SECONDS = float(os.environ.get('GUEST_RETENTION_BATCH_PAUSE', '0.05'))
+
+# Monthly partitions of guest_usage created ahead of time
+PARTITION_MONTHS_AHEAD = 3
+
+PURGED_TABLES = ('guest_usage', 'guest_total_usage', 'discovery_sessions')
+
+
+def _is_postgres(db):
+    return db.engine.dialect.name == 'postgresql'
+
+
+def purge_in_batches(db, table, key, condition, batch_size=BATCH_SIZE, pause=BATCH_PAUSE_SECONDS):
+    """Delete rows matching `condition` a batch at a time, committing after
+    each batch. Returns the number of rows removed.
+
+    Each batch resumes after the last key of the previous one (keyset
+    pagination on `key`, the primary key), so rows that were checked once are
+    never rescanned and the whole purge is a single pass over the table.
+    """
+    removed = 0
+    last_key = None
+    while True:
+        query = select(key).where(condition).order_by(key).limit(batch_size)
+        if last_key is not None:
+            query = query.where(key > last_key)
+        ids = db.session.execute(query).scalars().all()
+        if not ids:
+            break
+        last_key = ids[-1]
+        result = db.session.execute(delete(table).where(key.in_(ids)))
+        db.session.commit()
+        removed += result.rowcount
+        if len(ids) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return removed
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _partition_name(month):
+    return f'guest_usage_p{month:%Y_%m}'
+
+
+def is_guest_usage_partitioned(db):
+    if not _is_postgres(db):
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = 'guest_usage' AND pg_table_is_visible(c.oid)"
+    )).scalar() is not None
+
+
+def _guest_usage_partitions(db):
+    """Monthly partitions of guest_usage as {first day of month: name}"""
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'guest_usage' AND pg_table_is_visible(p.oid)"
+    )).scalars().all()
+    partitions = {}
+    for name in names:
+        try:
+            partitions[datetime.strptime(name, 'guest_usage_p%Y_%m').date()] = name
+        except ValueError:
+            continue
+    return partitions
+
+
+def ensure_guest_usage_partitions(db, months_ahead=PARTITION_MONTHS_AHEAD, start=None, end=None, commit=True):
+    """Create any missing monthly partitions from `start` (default: this
+    month) through `months_ahead` months from now, or through `end` if that
+    is later. Returns the names created."""
+    existing = _guest_usage_partitions(db)
+    month = _month_start(start or date.today())
+    last = _month_start(date.today())
+    for _ in range(months_ahead):
+        last = _next_month(last)
+    if end and _month_start(end) > last:
+        last = _month_start(end)
+
+    created = []
+    while month <= last:
+        if month not in existing:
+            name = _partition_name(month)
+            db.session.execute(text(
+                f"CREATE TABLE {name} PARTITION OF guest_usage "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+            ))
+            created.append(name)
+        month = _next_month(month)
+    if commit:
+        db.session.commit()
+    return created
+
+
+def partition_guest_usage(db, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Convert guest_usage into a table range-partitioned by month on
+    usage_date (Postgres only), so old months can be dropped outright.
+
+    Runs in one transaction holding an exclusive lock on guest_usage for the
+    duration of the copy. Returns the number of rows copied.
+    """
+    if not _is_postgres(db):
+        raise RuntimeError('guest_usage partitioning requires PostgreSQL')
+    if is_guest_usage_partitioned(db):
+        return 0
+
+    statements = [
+        "LOCK TABLE guest_usage IN ACCESS EXCLUSIVE MODE",
+        "ALTER SEQUENCE guest_usage_id_seq OWNED BY NONE",
+        "ALTER TABLE guest_usage RENAME TO guest_usage_unpartitioned",
+        "ALTER TABLE guest_usage_unpartitioned RENAME CONSTRAINT guest_usage_pkey TO guest_usage_unpartitioned_pkey",
+        "ALTER TABLE guest_usage_unpartitioned RENAME CONSTRAINT uq_session_date TO uq_session_date_unpartitioned",
+        "ALTER INDEX IF EXISTS ix_guest_usage_session_id RENAME TO ix_guest_usage_unpartitioned_session_id",
+        # The partition key has to be part of every unique constraint
+        """CREATE TABLE guest_usage (
+            id INTEGER NOT NULL DEFAULT nextval('guest_usage_id_seq'),
+            session_id VARCHAR NOT NULL,
+            usage_date DATE NOT NULL,
+            guide_messages INTEGER NOT NULL DEFAULT 0,
+            decoder_uses INTEGER NOT NULL DEFAULT 0,
+            decoder_total_uses INTEGER NOT NULL DEFAULT 0,
+            CONSTRAINT guest_usage_pkey PRIMARY KEY (id, usage_date),
+            CONSTRAINT uq_session_date UNIQUE (session_id, usage_date)
+        ) PARTITION BY RANGE (usage_date)""",
+        "CREATE INDEX ix_guest_usage_session_id ON guest_usage (session_id)",
+        "ALTER SEQUENCE guest_usage_id_seq OWNED BY guest_usage.id",
+    ]
+    try:
+        for statement in statements:
+            db.session.execute(text(statement))
+
+        oldest, newest = db.session.execute(text(
+            "SELECT min(usage_date), max(usage_date) FROM guest_usage_unpartitioned"
+        )).first()
+        ensure_guest_usage_partitions(db, months_ahead, start=oldest, end=newest, commit=False)
+        copied = db.session.execute(text(
+            "INSERT INTO guest_usage (id, session_id, usage_date, guide_messages, decoder_uses, decoder_total_uses) "
+            "SELECT id, session_id, usage_date, guide_messages, decoder_uses, decoder_total_uses "
+            "FROM guest_usage_unpartitioned"
+        )).rowcount
+        db.session.execute(text("DROP TABLE guest_usage_unpartitioned"))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return copied
+
+
+def _drop_expired_partitions(db, cutoff):
+    """Drop whole monthly partitions that end on or before `cutoff`"""
+    dropped = []
+    for month, name in sorted(_guest_usage_partitions(db).items()):
+        if _next_month(month) <= cutoff:
+            db.session.execute(text(f"DROP TABLE {name}"))
+            db.session.commit()
+            dropped.append(name)
+    return dropped
+
+
+def table_sizes(db, tables=PURGED_TABLES):
+    """Heap and index bytes per table (Postgres only; empty elsewhere)"""
+    if not _is_postgres(db):
+        return {}
+    sizes = {}
+    for table in tables:
+        row = db.session.execute(text(
+            "SELECT pg_table_size(c.oid), pg_indexes_size(c.oid), "
+            "coalesce(s.n_dead_tup, 0) "
+            "FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+            "WHERE c.relname = :table AND pg_table_is_visible(c.oid)"
+        ), {'table': table}).first()
+        if row:
+            table_bytes, index_bytes, dead_rows = row
+            if table == 'guest_usage' and is_guest_usage_partitioned(db):
+                table_bytes, index_bytes = db.session.execute(text(
+                    "SELECT coalesce(sum(pg_table_size(relid)), 0), coalesce(sum(pg_indexes_size(relid)), 0) "
+                    "FROM pg_partition_tree('guest_usage')"
+                )).first()
+            sizes[table] = {'table_bytes': int(table_bytes), 'index_bytes': int(index_bytes),
+                            'dead_rows': int(dead_rows)}
+    db.session.commit()
+    return sizes
+
+
+def vacuum_tables(db, tables=PURGED_TABLES, reindex=False):
+    """VACUUM (and optionally REINDEX CONCURRENTLY) the purged tables.
+    Both must run outside a transaction block."""
+    if not _is_postgres(db):
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for table in tables:
+            conn.execute(text(f"VACUUM (ANALYZE) {table}"))
+            if reindex and not (table == 'guest_usage' and is_guest_usage_partitioned(db)):
+                conn.execute(text(f"REINDEX TABLE CONCURRENTLY {table}"))
+
+
+def purge_guest_data(db, now=None, batch_size=BATCH_SIZE, pause=BATCH_PAUSE_SECONDS):
+    """Remove guest rows past their retention period. Returns rows removed per
+    table (and the guest_usage partitions dropped, if partitioned)."""
+    now = now or datetime.utcnow()
+    report = {'removed': {}, 'partitions_dropped': []}
+
+    if GUEST_USAGE_RETENTION_DAYS:
+        cutoff = now.date() - timedelta(days=GUEST_USAGE_RETENTION_DAYS)
+        if is_guest_usage_partitioned(db):
+            report['partitions_dropped'] = _drop_expired_partitions(db, cutoff)
+            ensure_guest_usage_partitions(db)
+        report['removed']['guest_usage'] = purge_in_batches(
+            db, GuestUsage, GuestUsage.id, GuestUsage.usage_date < cutoff, batch_size, pause
+        )
+
+    if GUEST_TOTAL_USAGE_RETENTION_DAYS:
+        cutoff = now - timedelta(days=GUEST_TOTAL_USAGE_RETENTION_DAYS)
+        last_seen = func.coalesce(GuestTotalUsage.last_used_at, GuestTotalUsage.created_at)
+        report['removed']['guest_total_usage'] = purge_in_batches(
+            db, GuestTotalUsage, GuestTotalUsage.id, last_seen < cutoff, batch_size, pause
+        )
+
+    if GUEST_DISCOVERY_RETENTION_DAYS:
+        cutoff = now - timedelta(days=GUEST_DISCOVERY_RETENTION_DAYS)
+        last_seen = func.coalesce(DiscoverySession.completed_at, DiscoverySession.started_at)
+        report['removed']['discovery_sessions'] = purge_in_batches(
+            db, DiscoverySession, DiscoverySession.id,
+            and_(DiscoverySession.user_id.is_(None),
+                 DiscoverySession.session_id.isnot(None),
+                 last_seen < cutoff),
+            batch_size, pause
+        )
+
+    return report
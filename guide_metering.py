@@ -0,0 +1,165 @@
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func
+
+from models import GuideUsageEvent, GuideUsageDaily
+from quota import add_guide_tokens, buffers_usage, insert_for
+import usage_buffer as write_behind
+
+# Prices in US dollars per 1M tokens: (input, cached input, output).
+# Unknown models fall back to the default Guide model's pricing.
+MODEL_PRICING = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-5': (1.25, 0.125, 10.00),
+    'gpt-5-mini': (0.25, 0.025, 2.00),
+}
+DEFAULT_PRICING_MODEL = 'gpt-4o-mini'
+
+
+def get_daily_token_budget():
+    """Optional per-user daily token budget for the AI Guide (unset = unlimited)"""
+    value = os.environ.get('GUIDE_DAILY_TOKEN_BUDGET')
+    if not value:
+        return None
+    try:
+        budget = int(value)
+    except ValueError:
+        return None
+    return budget if budget > 0 else None
+
+
+def usage_from_completion(response):
+    """Pull token counts out of the `usage` block of a chat completion"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) if details else 0
+
+    return {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'cached_tokens': cached_tokens or 0
+    }
+
+
+def estimate_cost_micros(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Estimated cost of one completion in millionths of a US dollar"""
+    input_price, cached_price, output_price = MODEL_PRICING.get(
+        model, MODEL_PRICING[DEFAULT_PRICING_MODEL]
+    )
+    uncached_tokens = max(0, prompt_tokens - cached_tokens)
+    # Price per 1M tokens in dollars is the same number as micro-dollars per token
+    cost = (uncached_tokens * input_price
+            + cached_tokens * cached_price
+            + completion_tokens * output_price)
+    return int(round(cost))
+
+
+def upsert_daily_usage(db, rows):
+    """Add rollup increments (dicts of GuideUsageDaily columns, at most one
+    per user and day) to the daily aggregates in one statement, so
+    concurrent writers add up instead of racing on uq_guide_usage_user_date"""
+    insert = insert_for(db)
+    statement = insert(GuideUsageDaily).values(rows)
+    added = statement.excluded
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[GuideUsageDaily.user_id, GuideUsageDaily.usage_date],
+        set_={
+            'subscription_tier': added.subscription_tier,
+            'message_count': GuideUsageDaily.message_count + added.message_count,
+            'prompt_tokens': GuideUsageDaily.prompt_tokens + added.prompt_tokens,
+            'completion_tokens': GuideUsageDaily.completion_tokens + added.completion_tokens,
+            'cached_tokens': GuideUsageDaily.cached_tokens + added.cached_tokens,
+            'latency_ms_total': GuideUsageDaily.latency_ms_total + added.latency_ms_total,
+            'cost_usd_micros': GuideUsageDaily.cost_usd_micros + added.cost_usd_micros
+        }
+    ))
+
+
+def record_guide_usage(db, user, model, usage, latency_ms):
+    """Append a metering event, roll it into today's aggregate and bump the
+    user's token counter. The caller commits unless buffers_usage(user) is
+    true, in which case all three go to the write-behind buffer."""
+    prompt_tokens = usage['prompt_tokens']
+    completion_tokens = usage['completion_tokens']
+    cached_tokens = usage['cached_tokens']
+    cost = estimate_cost_micros(model, prompt_tokens, completion_tokens, cached_tokens)
+
+    event = {
+        'user_id': user.id,
+        'subscription_tier': user.subscription_tier,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': cached_tokens,
+        'latency_ms': latency_ms,
+        'cost_usd_micros': cost,
+        'created_at': datetime.utcnow()
+    }
+    daily = {
+        'user_id': user.id,
+        'usage_date': date.today(),
+        'subscription_tier': user.subscription_tier,
+        'message_count': 1,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': cached_tokens,
+        'latency_ms_total': latency_ms,
+        'cost_usd_micros': cost
+    }
+    if buffers_usage(user):
+        write_behind.buffer.add_guide_metering(event, daily)
+    else:
+        db.session.add(GuideUsageEvent(**event))
+        upsert_daily_usage(db, [daily])
+
+    add_guide_tokens(db, user, prompt_tokens + completion_tokens)
+    return cost
+
+
+def tier_spend_report(db, days=30):
+    """Token usage and spend per subscription tier over the last `days` days.
+    A user's day is counted under the last tier recorded in its rollup row."""
+    since = date.today() - timedelta(days=days - 1)
+    rows = db.session.query(
+        GuideUsageDaily.subscription_tier,
+        func.count(func.distinct(GuideUsageDaily.user_id)),
+        func.sum(GuideUsageDaily.message_count),
+        func.sum(GuideUsageDaily.prompt_tokens),
+        func.sum(GuideUsageDaily.completion_tokens),
+        func.sum(GuideUsageDaily.cached_tokens),
+        func.sum(GuideUsageDaily.cost_usd_micros)
+    ).filter(
+        GuideUsageDaily.usage_date >= since
+    ).group_by(GuideUsageDaily.subscription_tier).all()
+
+    report = []
+    for tier, users, messages, prompt, completion, cached, cost in rows:
+        report.append({
+            'subscription_tier': tier,
+            'users': users,
+            'messages': int(messages or 0),
+            'prompt_tokens': int(prompt or 0),
+            'completion_tokens': int(completion or 0),
+            'cached_tokens': int(cached or 0),
+            'cost_usd': (cost or 0) / 1_000_000
+        })
+    return {
+        'since': since.isoformat(),
+        'days': days,
+        'tiers': sorted(report, key=lambda r: r['cost_usd'], reverse=True)
+    }
+
+
+def user_daily_usage(db, user_id, days=30):
+    """Daily aggregates for one user, newest first"""
+    since = date.today() - timedelta(days=days - 1)
+    rows = db.session.query(GuideUsageDaily).filter(
+        GuideUsageDaily.user_id == user_id,
+        GuideUsageDaily.usage_date >= since
+    ).order_by(GuideUsageDaily.usage_date.desc()).all()
+    return [row.to_dict() for row in rows]
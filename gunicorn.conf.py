@@ -0,0 +1,68 @@
+"""Gunicorn settings for the deployment (gunicorn -c gunicorn.conf.py app:app).
+
+By default the app is preloaded: imported once in the master, warmed, and
+forked into the workers, so the workers share those pages copy-on-write
+instead of each importing the app on its own. Anything that must not cross
+a fork is created per worker instead. The master never opens threads, and it
+closes its DB connections before forking. post_fork gives each worker its own
+DB pool, HTTP clients and background threads. With METRICS_DIR set, an
+exiting worker saves its final metrics snapshot, and the master folds it
+into the retired total (request_metrics.retire_snapshot).
+
+GUNICORN_PRELOAD=0 switches back to importing the app in every worker.
+"""
+import gc
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+reuse_port = True
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+# Read by startup.py when app.py is imported
+os.environ['GUNICORN_PRELOAD'] = '1' if preload_app else '0'
+
+
+def on_starting(server):
+    import request_metrics
+    request_metrics.retire_dead_snapshots()
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app
+    app.warm_shared_state()
+    # Move everything allocated so far out of the collector's generations, so
+    # collections in the workers do not write to (and un-share) those pages
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    worker.spawn_started = time.perf_counter()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.reset_after_fork()
+
+
+def post_worker_init(worker):
+    elapsed_ms = (time.perf_counter() - worker.spawn_started) * 1000
+    worker.log.info(f"Worker {worker.pid} ready in {elapsed_ms:.1f} ms")
+
+
+def worker_exit(server, worker):
+    import request_metrics
+    if request_metrics.ENABLED and request_metrics.METRICS_DIR:
+        request_metrics.write_snapshot()
+
+
+def child_exit(server, worker):
+    import request_metrics
+    request_metrics.retire_snapshot(worker.pid)
@@ -1,15 +1,56 @@
 from datetime import datetime, date
-from sqlalchemy import Integer, String, Text, DateTime, ForeignKey, UniqueConstraint, Boolean, Date
-from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
+from sqlalchemy import Integer, String, Text, DateTime, ForeignKey, UniqueConstraint, Boolean, Date, Index
+from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship, load_only
 from flask_login import UserMixin
 from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from typing import Optional
+import json
 import uuid
 
 class Base(DeclarativeBase):
     pass
 
+
+class SparseFieldsMixin:
+    """Lets list APIs return a subset of to_dict() via ?fields=a,b,c.
+    
+    API_FIELDS are the keys to_dict() returns, each backed by the column of
+    the same name. JSON_FIELDS maps JSON-encoded text columns to the factory
+    for their empty value; they are only decoded when requested.
+    """
+    API_FIELDS = ()
+    JSON_FIELDS = {}
+    
+    @classmethod
+    def parse_fields(cls, raw):
+        """Field names from a ?fields= value, or None for all fields.
+        Raises ValueError for unknown or missing names."""
+        if raw is None:
+            return None
+        fields = list(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+        unknown = [name for name in fields if name not in cls.API_FIELDS]
+        if unknown or not fields:
+            problem = f"Unknown fields: {', '.join(unknown)}" if unknown else 'No fields requested'
+            raise ValueError(f"{problem}. Allowed: {', '.join(cls.API_FIELDS)}")
+        return fields
+    
+    @classmethod
+    def load_only_fields(cls, fields):
+        """Query option that loads only the columns behind `fields` (plus the key)"""
+        return load_only(*[getattr(cls, name) for name in fields])
+    
+    def sparse_dict(self, fields):
+        data = {}
+        for name in fields:
+            value = getattr(self, name)
+            if name in self.JSON_FIELDS:
+                value = json.loads(value) if value else self.JSON_FIELDS[name]()
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            data[name] = value
+        return data
+
 # Membership tiers:
 # 'free' - signed up but no paid subscription (doodle, journal, education access)
 # 'basic' - £4.99/month (everything except AI Guide)
@@ -45,7 +86,7 @@ class User(UserMixin, Base):
     
     # New tiered membership fields
     subscription_tier: Mapped[str] = mapped_column(String(20), default='free', nullable=False)
-    stripe_customer_id: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    stripe_customer_id: Mapped[Optional[str]] = mapped_column(String(100), nullable=True, index=True)
     stripe_subscription_id: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
     subscription_expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     
@@ -55,17 +96,27 @@ class User(UserMixin, Base):
     # Guide tracking remains daily for premium users
     guide_messages_today: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     guide_last_message_date: Mapped[Optional[date]] = mapped_column(Date, nullable=True)
+    # Tokens consumed by the AI Guide today - lets the quota check enforce a
+    # token budget from the already-loaded user row. Existing databases get it
+    # from migration 0001_users_guide_tokens_today (flask schema apply)
+    guide_tokens_today: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
     
     # Legacy fields - kept for migration compatibility
     decoder_uses_today: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     decoder_last_use_date: Mapped[Optional[date]] = mapped_column(Date, nullable=True)
     
+    # Bumped whenever this user's journal, oracle or discovery data changes;
+    # read APIs derive their ETags from it (see data_version.py). Existing
+    # databases get it from migration 0003_users_data_version
+    data_version: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False)
+    
     journal_entries = relationship('JournalEntry', back_populates='user', cascade='all, delete-orphan')
     
     def reset_daily_limits_if_needed(self):
         today = date.today()
         if self.guide_last_message_date != today:
             self.guide_messages_today = 0
+            self.guide_tokens_today = 0
             self.guide_last_message_date = today
     
     def has_active_subscription(self):
@@ -76,10 +127,23 @@ class User(UserMixin, Base):
             return self.subscription_expires_at > datetime.utcnow()
         return False
     
-    def can_use_guide(self):
-        """Only premium tier (£6.99/month) can use AI Guide"""
+    def get_guide_tokens_today(self):
+        """Tokens used today, treating a stale counter from a previous day as zero"""
+        if self.guide_last_message_date != date.today():
+            return 0
+        return self.guide_tokens_today or 0
+    
+    def can_use_guide(self, daily_token_budget=None):
+        """Only premium tier (£6.99/month) can use AI Guide.
+        
+        With a daily token budget the remaining value is the number of tokens
+        left today; without one premium access is unlimited (999).
+        """
         if self.subscription_tier == TIER_PREMIUM and self.has_active_subscription():
-            return True, 999
+            if not daily_token_budget:
+                return True, 999
+            remaining = max(0, daily_token_budget - self.get_guide_tokens_today())
+            return remaining > 0, remaining
         # No access for non-premium users
         return False, 0
     
@@ -104,14 +168,6 @@ class User(UserMixin, Base):
         """Doodle access for all signed-up members (free tier and above)"""
         return True
     
-    def increment_guide_usage(self):
-        self.reset_daily_limits_if_needed()
-        self.guide_messages_today += 1
-    
-    def increment_decoder_usage(self):
-        """Increment total decoder uses (not daily anymore)"""
-        self.decoder_total_uses += 1
-    
     def get_tier_display_name(self):
         """Get human-readable tier name"""
         tier_names = {
@@ -145,7 +201,7 @@ class OAuth(OAuthConsumerMixin, Base):
         name='uq_user_browser_session_key_provider',
     ),)
 
-class JournalEntry(Base):
+class JournalEntry(SparseFieldsMixin, Base):
     __tablename__ = 'journal_entries'
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -165,7 +221,16 @@ class JournalEntry(Base):
     
     user = relationship('User', back_populates='journal_entries')
     
-    def to_dict(self):
+    # Existing databases get new indexes from schema_migrations.py
+    __table_args__ = (Index('ix_journal_entries_user_created', 'user_id', 'created_at'),)
+    
+    API_FIELDS = ('id', 'affirmation', 'general_reflection', 'feelings', 'emotions_released',
+                  'what_came_up', 'next_steps', 'emotion_selected', 'frequency_tag',
+                  'vibration_word', 'prompt_used', 'doodle_image', 'created_at')
+    
+    def to_dict(self, fields=None):
+        if fields:
+            return self.sparse_dict(fields)
         return {
             'id': self.id,
             'affirmation': self.affirmation,
@@ -209,6 +274,9 @@ class GuestTotalUsage(Base):
     session_id: Mapped[str] = mapped_column(String, nullable=False, unique=True, index=True)
     decoder_total_uses: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    # Bumped on every recorded use; retention purges by this (or created_at).
+    # Existing databases get it from migration 0002_guest_total_usage_last_used_at
+    last_used_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
 
 class BookingRequest(Base):
@@ -223,7 +291,8 @@ class BookingRequest(Base):
     preferred_day: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
     preferred_time: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
     status: Mapped[str] = mapped_column(String(50), default='pending', nullable=False)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    # Index added to existing databases by migration 0009
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     
     def to_dict(self):
         return {
@@ -240,7 +309,7 @@ class BookingRequest(Base):
         }
 
 
-class OracleReading(Base):
+class OracleReading(SparseFieldsMixin, Base):
     """Save oracle card readings for users"""
     __tablename__ = 'oracle_readings'
     
@@ -253,8 +322,14 @@ class OracleReading(Base):
     
     user = relationship('User', backref='oracle_readings')
     
-    def to_dict(self):
-        import json
+    __table_args__ = (Index('ix_oracle_readings_user_created', 'user_id', 'created_at'),)
+    
+    API_FIELDS = ('id', 'cards_drawn', 'card_messages', 'reflection', 'created_at')
+    JSON_FIELDS = {'cards_drawn': list, 'card_messages': list}
+    
+    def to_dict(self, fields=None):
+        if fields:
+            return self.sparse_dict(fields)
         return {
             'id': self.id,
             'cards_drawn': json.loads(self.cards_drawn) if self.cards_drawn else [],
@@ -264,7 +339,7 @@ class OracleReading(Base):
         }
 
 
-class DiscoverySession(Base):
+class DiscoverySession(SparseFieldsMixin, Base):
     """Track user discovery sessions for shadow emotion category exploration"""
     __tablename__ = 'discovery_sessions'
     
@@ -289,8 +364,16 @@ class DiscoverySession(Base):
     
     user = relationship('User', backref='discovery_sessions')
     
-    def to_dict(self):
-        import json
+    __table_args__ = (Index('ix_discovery_sessions_user_started', 'user_id', 'started_at'),)
+    
+    API_FIELDS = ('id', 'user_id', 'blessing_text', 'category_counts', 'layers_data',
+                  'session_notes', 'total_categories', 'total_shadow_count', 'triggered_tool',
+                  'is_completed', 'started_at', 'completed_at')
+    JSON_FIELDS = {'category_counts': dict, 'layers_data': list}
+    
+    def to_dict(self, fields=None):
+        if fields:
+            return self.sparse_dict(fields)
         return {
             'id': self.id,
             'user_id': self.user_id,
@@ -305,3 +388,130 @@ class DiscoverySession(Base):
             'started_at': self.started_at.isoformat() if self.started_at else None,
             'completed_at': self.completed_at.isoformat() if self.completed_at else None
         }
+
+
+class GuideUsageEvent(Base):
+    """Append-only record of every AI Guide completion and the tokens it used"""
+    __tablename__ = 'guide_usage_events'
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), nullable=False, index=True)
+    subscription_tier: Mapped[str] = mapped_column(String(20), nullable=False)
+    model: Mapped[str] = mapped_column(String(100), nullable=False)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    completion_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    latency_ms: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    # Estimated cost in millionths of a US dollar (OpenAI bills in USD)
+    cost_usd_micros: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class GuideUsageDaily(Base):
+    """Per-user daily rollup of GuideUsageEvent rows, used for spend reports.
+
+    One row per user and day: subscription_tier is the tier at the user's
+    last Guide message that day, so a mid-day plan change counts the whole
+    day under the new tier. GuideUsageEvent keeps the tier of every message.
+    """
+    __tablename__ = 'guide_usage_daily'
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[str] = mapped_column(String, ForeignKey('users.id'), nullable=False)
+    usage_date: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    subscription_tier: Mapped[str] = mapped_column(String(20), nullable=False)
+    message_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    prompt_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    completion_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    cached_tokens: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    latency_ms_total: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    cost_usd_micros: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    
+    __table_args__ = (UniqueConstraint(
+        'user_id',
+        'usage_date',
+        name='uq_guide_usage_user_date',
+    ),)
+    
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'usage_date': self.usage_date.isoformat() if self.usage_date else None,
+            'subscription_tier': self.subscription_tier,
+            'message_count': self.message_count,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'cached_tokens': self.cached_tokens,
+            'latency_ms_total': self.latency_ms_total,
+            'cost_usd': self.cost_usd_micros / 1_000_000
+        }
+
+
+class StripeProduct(Base):
+    """Local copy of a Stripe product, kept in sync by webhooks and reconciliation"""
+    __tablename__ = 'stripe_products'
+    
+    id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    name: Mapped[str] = mapped_column(String(200), nullable=False)
+    description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    tier: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+    app: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    active: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+class StripePrice(Base):
+    """Local copy of a Stripe price. product_id is not a foreign key because
+    price events can arrive before the product event."""
+    __tablename__ = 'stripe_prices'
+    
+    id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    product_id: Mapped[str] = mapped_column(String(100), nullable=False, index=True)
+    unit_amount: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    currency: Mapped[str] = mapped_column(String(10), nullable=False)
+    interval: Mapped[str] = mapped_column(String(20), default='month', nullable=False)
+    interval_count: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
+    plan_type: Mapped[str] = mapped_column(String(50), default='monthly', nullable=False)
+    tier: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+    active: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+
+WEBHOOK_PENDING = 'pending'
+WEBHOOK_PROCESSED = 'processed'
+WEBHOOK_DEAD = 'dead'
+
+class StripeWebhookEvent(Base):
+    """Inbox of verified Stripe webhook events, keyed by Stripe event id so
+    redeliveries are stored once and processed once"""
+    __tablename__ = 'stripe_webhook_inbox'
+    
+    id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    event_type: Mapped[str] = mapped_column(String(100), nullable=False)
+    customer_id: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), default=WEBHOOK_PENDING, nullable=False, index=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # Stripe's event.created (epoch seconds) - events are applied in this order per customer
+    stripe_created: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    received_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    processed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    # Lets drain_inbox's "earlier event of this customer still backing off"
+    # check probe per customer instead of scanning the pending set
+    __table_args__ = (Index('ix_stripe_webhook_inbox_customer_status_next', 'customer_id', 'status', 'next_attempt_at'),)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'event_type': self.event_type,
+            'customer_id': self.customer_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'received_at': self.received_at.isoformat() if self.received_at else None,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'processed_at': self.processed_at.isoformat() if self.processed_at else None
+        }
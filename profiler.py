@@ -0,0 +1,243 @@
+"""On-demand sampling profiler for live requests.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, or when
+it is picked at random at PROFILE_SAMPLE_RATE. While it runs, one shared
+sampler thread reads the request thread's stack every PROFILE_INTERVAL_MS
+through sys._current_frames(). The profiled code itself is never
+instrumented. When the request ends, the sampler thread writes the stacks to
+PROFILE_DIR in collapsed format ("frame;frame;frame count" per line). That
+file can be fed straight to flamegraph.pl or speedscope, and a .json file
+next to it holds the request details. Only the newest PROFILE_MAX_FILES
+profiles are kept.
+
+With neither PROFILE_TOKEN nor PROFILE_SAMPLE_RATE set, no hooks are
+installed and no thread is started.
+"""
+import glob
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from flask import request
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+INTERVAL_SECONDS = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'soulart-profiles')
+MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '50'))
+
+HEADER = 'X-Profile'
+_PROFILE_NAME = re.compile(r'^[0-9]+-[A-Za-z0-9._-]+\.folded$')
+
+_lock = threading.Lock()
+_active = {}
+# Finished profiles waiting for the sampler thread to write them
+_finished = []
+_wake = threading.Event()
+_sampler = None
+_local = threading.local()
+# Frame labels per code object, so a sample is mostly dict lookups
+_labels = {}
+
+
+def enabled():
+    return bool(PROFILE_TOKEN) or SAMPLE_RATE > 0
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename
+        marker = path.rfind('site-packages' + os.sep)
+        path = path[marker + 14:] if marker >= 0 else os.path.basename(path)
+        label = _labels[code] = f'{code.co_name} ({path}:{code.co_firstlineno})'
+    return label
+
+
+class Profile:
+    __slots__ = ('ident', 'method', 'path', 'endpoint', 'request_id', 'reason', 'started_at', 'started', 'stacks',
+                 'samples')
+
+    def __init__(self, reason):
+        self.ident = threading.get_ident()
+        self.method = request.method
+        self.path = request.path
+        self.endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.request_id = tracing.current_request_id() or os.urandom(8).hex()
+        self.reason = reason
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stacks = {}
+        self.samples = 0
+
+    def sample(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(_label(frame.f_code))
+            frame = frame.f_back
+        key = ';'.join(reversed(labels))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+
+def _run_sampler():
+    while True:
+        if _finished:
+            _save_finished()
+        if not _active:
+            _wake.clear()
+            if not (_active or _finished):
+                _wake.wait()
+            continue
+        frames = sys._current_frames()
+        with _lock:
+            for profile in _active.values():
+                frame = frames.get(profile.ident)
+                if frame is not None:
+                    profile.sample(frame)
+        del frames
+        time.sleep(INTERVAL_SECONDS)
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None or not _sampler.is_alive():
+        with _lock:
+            if _sampler is None or not _sampler.is_alive():
+                # A thread inherited through fork is not alive; start a new one
+                _sampler = threading.Thread(target=_run_sampler, name='request-profiler', daemon=True)
+                _sampler.start()
+
+
+def _requested():
+    """Why this request should be profiled, or None"""
+    header = request.headers.get(HEADER)
+    if header and PROFILE_TOKEN and hmac.compare_digest(header.encode(), PROFILE_TOKEN.encode()):
+        return 'header'
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def _start_request():
+    reason = _requested()
+    if reason is None:
+        return
+    profile = Profile(reason)
+    _local.profile = profile
+    _ensure_sampler()
+    with _lock:
+        _active[profile.ident] = profile
+    _wake.set()
+
+
+def _finish_request(response):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        response.headers['X-Profile-Id'] = _profile_name(profile)
+    return response
+
+
+def _teardown_request(exc):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return
+    _local.profile = None
+    duration = time.perf_counter() - profile.started
+    with _lock:
+        _active.pop(profile.ident, None)
+        # Written by the sampler thread, off the request path
+        _finished.append((profile, duration))
+    _wake.set()
+
+
+def _save_finished():
+    with _lock:
+        finished = _finished[:]
+        del _finished[:]
+    for profile, duration in finished:
+        try:
+            _save(profile, duration)
+        except OSError as e:
+            logger.error("Could not save profile for %s %s: %s", profile.method, profile.path, e,
+                         extra={'event': 'profiler.save_failed'})
+    _prune()
+
+
+def _profile_name(profile):
+    return f'{int(profile.started_at * 1000)}-{profile.request_id}.folded'
+
+
+def _save(profile, duration):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, _profile_name(profile))
+    with open(path, 'w') as f:
+        for stack, count in sorted(profile.stacks.items()):
+            f.write(f'{stack} {count}\n')
+    with open(path[:-len('.folded')] + '.json', 'w') as f:
+        json.dump({
+            'method': profile.method,
+            'path': profile.path,
+            'endpoint': profile.endpoint,
+            'request_id': profile.request_id,
+            'reason': profile.reason,
+            'pid': os.getpid(),
+            'started_at': profile.started_at,
+            'duration_ms': round(duration * 1000, 3),
+            'samples': profile.samples,
+            'interval_ms': INTERVAL_SECONDS * 1000
+        }, f)
+
+
+def _prune():
+    """Keep the newest MAX_FILES profiles"""
+    profiles = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.folded')))
+    for path in profiles[:-MAX_FILES] if MAX_FILES > 0 else profiles:
+        for stale in (path, path[:-len('.folded')] + '.json'):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def install(app):
+    """Register the request hooks when profiling is configured"""
+    if not enabled():
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+
+
+def list_profiles(endpoint=None, limit=50):
+    """Saved profiles, newest first"""
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(PROFILE_DIR, '*.folded')), reverse=True):
+        try:
+            with open(path[:-len('.folded')] + '.json') as f:
+                details = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if endpoint and details.get('endpoint') != endpoint:
+            continue
+        details['name'] = os.path.basename(path)
+        details['size_bytes'] = os.path.getsize(path)
+        profiles.append(details)
+        if len(profiles) >= limit:
+            break
+    return profiles
+
+
+def valid_name(name):
+    return bool(_PROFILE_NAME.match(name))
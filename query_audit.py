@@ -0,0 +1,231 @@
+"""Query auditing for development and CI (QUERY_AUDIT=1).
+
+Every statement a request runs is recorded with its duration and its shape,
+meaning the SQL with literals and IN-lists folded. At the end of the request
+the audit flags:
+- repeated shapes: the same statement QUERY_AUDIT_REPEATS or more times,
+  which usually means a lazy load inside a loop (N+1)
+- statements slower than QUERY_AUDIT_SLOW_MS
+- full-table scans: the first time a SELECT shape is seen, it is EXPLAINed
+  (at QUERY_AUDIT_EXPLAIN_RATE) on a separate connection
+- routes over the budget declared with @query_budget(n)
+
+A route whose full scan is intended (a small table read whole) declares it
+with @allow_full_scan(reason); its scans are still reported but not flagged.
+
+Findings are logged, kept for /api/admin/query-audit, and counted in the
+X-Query-Count response header. With QUERY_AUDIT unset, nothing is installed.
+"""
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from flask import current_app, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('QUERY_AUDIT', '0') != '0'
+SLOW_MS = float(os.environ.get('QUERY_AUDIT_SLOW_MS', '100'))
+REPEAT_THRESHOLD = int(os.environ.get('QUERY_AUDIT_REPEATS', '5'))
+EXPLAIN_RATE = float(os.environ.get('QUERY_AUDIT_EXPLAIN_RATE', '1'))
+REPORT_SIZE = 500
+
+_SPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+_IN_LIST = re.compile(r'\(\s*' + _PARAM + r'(?:\s*,\s*' + _PARAM + r')+\s*\)')
+
+reports = deque(maxlen=REPORT_SIZE)
+# SELECT shape -> full scans its plan contains ([] when none or not explained)
+_plans = {}
+_plans_lock = threading.Lock()
+_local = threading.local()
+
+
+def query_budget(limit):
+    """Declare the most statements a route may run; exceeding it is flagged
+    by the audit and fails benchmarks/query_budget_check.py"""
+    def decorator(f):
+        f.query_budget = limit
+        return f
+
+    return decorator
+
+
+def allow_full_scan(reason):
+    """Accept full-table scans on a route; `reason` says why the scan is
+    fine and is shown next to it in reports"""
+    def decorator(f):
+        f.full_scan_allowed = reason
+        return f
+
+    return decorator
+
+
+def shape(statement):
+    """The statement with whitespace, literals and IN-lists normalised, so
+    repeats of one query compare equal"""
+    text = _SPACE.sub(' ', statement).strip()
+    text = _STRING.sub('?', text)
+    text = _NUMBER.sub('?', text)
+    return _IN_LIST.sub('(?...)', text)
+
+
+class Audit:
+    __slots__ = ('statements', 'explain', 'explaining', 'started')
+
+    def __init__(self):
+        self.statements = []
+        # First sighting of each SELECT shape: (engine, statement, parameters)
+        self.explain = {}
+        self.explaining = False
+        self.started = time.perf_counter()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    audit = getattr(_local, 'audit', None)
+    if audit is not None and not audit.explaining:
+        conn.info.setdefault('audit_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    audit = getattr(_local, 'audit', None)
+    stack = conn.info.get('audit_started')
+    if audit is None or audit.explaining or not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    key = shape(statement)
+    audit.statements.append((key, elapsed))
+    if key not in _plans and key not in audit.explain and not executemany \
+            and statement.lstrip()[:6].upper() == 'SELECT' and random.random() < EXPLAIN_RATE:
+        audit.explain[key] = (conn.engine, statement, parameters)
+
+
+def _full_scans(engine, statement, parameters):
+    """Full-table scans in the statement's plan"""
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            # Test tables are tiny and would be seq-scanned anyway; a Seq Scan
+            # left with this off means no index can serve the statement
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+            found, nodes = [], [plan[0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                if node.get('Node Type') == 'Seq Scan':
+                    found.append(f"Seq Scan on {node.get('Relation Name')}")
+                nodes.extend(node.get('Plans', []))
+            return found
+        if engine.dialect.name == 'sqlite':
+            rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            # "SCAN journal_entries" reads the whole table; "SEARCH ..." and
+            # "SCAN ... USING INDEX" (walking an index in order, as for ORDER BY ... LIMIT) use an index
+            return [row[-1] for row in rows
+                    if row[-1].startswith('SCAN ') and not row[-1].startswith(('SCAN CONSTANT', 'SCAN (subquery'))
+                    and ' USING INDEX ' not in row[-1] and ' USING COVERING INDEX ' not in row[-1]]
+    return []
+
+
+def _explain(audit):
+    audit.explaining = True
+    try:
+        for key, (engine, statement, parameters) in audit.explain.items():
+            try:
+                scans = _full_scans(engine, statement, parameters)
+            except Exception as e:
+                logger.warning("Query audit could not EXPLAIN %s: %s", key[:80], e,
+                               extra={'event': 'query_audit.explain_failed'})
+                scans = []
+            with _plans_lock:
+                _plans[key] = scans
+    finally:
+        audit.explaining = False
+
+
+def _start_request():
+    _local.audit = Audit()
+
+
+def _finish_request(response):
+    audit = getattr(_local, 'audit', None)
+    if audit is not None:
+        response.headers['X-Query-Count'] = str(len(audit.statements))
+        _local.status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    audit = getattr(_local, 'audit', None)
+    if audit is None:
+        return
+    _local.audit = None
+    status = getattr(_local, 'status', None) if exc is None else 500
+    _local.status = None
+    _explain(audit)
+
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    full_scan_allowed = getattr(view, 'full_scan_allowed', None)
+    counts = Counter(key for key, _ in audit.statements)
+    seen = set()
+    full_scans = []
+    for key, _ in audit.statements:
+        if _plans.get(key) and key not in seen:
+            seen.add(key)
+            full_scans.append({'shape': key, 'plan': _plans[key]})
+    report = {
+        'method': request.method,
+        'endpoint': request.url_rule.rule if request.url_rule is not None else 'unmatched',
+        'status': status,
+        'statements': len(audit.statements),
+        'sql_ms': round(sum(elapsed for _, elapsed in audit.statements) * 1000, 3),
+        'budget': budget,
+        'over_budget': budget is not None and len(audit.statements) > budget,
+        'repeated': [{'shape': key, 'count': n} for key, n in counts.most_common() if n >= REPEAT_THRESHOLD],
+        'slow': [{'shape': key, 'ms': round(elapsed * 1000, 3)}
+                 for key, elapsed in audit.statements if elapsed * 1000 >= SLOW_MS],
+        'full_scans': full_scans,
+        'full_scan_allowed': full_scan_allowed
+    }
+    reports.append(report)
+
+    problems = []
+    if report['over_budget']:
+        problems.append(f"{report['statements']} statements, budget {budget}")
+    problems += [f"repeated x{r['count']}: {r['shape'][:120]}" for r in report['repeated']]
+    problems += [f"slow {s['ms']:.0f} ms: {s['shape'][:120]}" for s in report['slow']]
+    if not full_scan_allowed:
+        problems += [f"full scan ({', '.join(s['plan'])}): {s['shape'][:120]}" for s in full_scans]
+    if problems:
+        logger.warning("Query audit %s %s: %s", report['method'], report['endpoint'], '; '.join(problems),
+                       extra={'event': 'query_audit.finding', 'statements': report['statements'],
+                              'budget': budget})
+
+
+def install(app, engines):
+    """Register the request hooks and statement events when QUERY_AUDIT is set"""
+    if not ENABLED:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def summary():
+    """Worst recorded request per route"""
+    worst = {}
+    for report in list(reports):
+        key = (report['method'], report['endpoint'])
+        if key not in worst or report['statements'] > worst[key]['statements']:
+            worst[key] = report
+    return [worst[key] for key in sorted(worst)]
@@ -0,0 +1,177 @@
+from datetime import datetime, date
+
+from sqlalchemy import and_, case, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import User, GuestTotalUsage, TIER_BASIC, TIER_PREMIUM
+import usage_buffer as write_behind
+
+# Total decoder uses for free members and guests
+DECODER_FREE_LIMIT = 3
+
+
+def buffers_usage(user):
+    """True when this user's increments go to the write-behind buffer instead
+    of the database (only members whose counters are unlimited)"""
+    return (write_behind.WRITE_BEHIND_ENABLED
+            and user.subscription_tier in (TIER_BASIC, TIER_PREMIUM)
+            and user.has_active_subscription())
+
+
+def pending_guide_tokens(user):
+    """Guide tokens used today, including increments not yet flushed"""
+    return user.get_guide_tokens_today() + write_behind.buffer.pending_guide_tokens(user.id)
+
+
+def guide_allowance(user, daily_token_budget=None):
+    """User.can_use_guide, counting Guide tokens not yet flushed from the
+    write-behind buffer. Returns (can_send, remaining)."""
+    if user.subscription_tier != TIER_PREMIUM or not user.has_active_subscription():
+        return False, 0
+    if not daily_token_budget:
+        return True, 999
+    remaining = max(0, daily_token_budget - pending_guide_tokens(user))
+    return remaining > 0, remaining
+
+
+def _has_active_subscription(tiers):
+    """SQL version of User.has_active_subscription for the given tiers"""
+    return and_(
+        User.subscription_tier.in_(tiers),
+        or_(User.subscription_expires_at.is_(None), User.subscription_expires_at > datetime.utcnow())
+    )
+
+
+def insert_for(db):
+    """Dialect insert() supporting ON CONFLICT ... DO UPDATE"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert
+    return sqlite.insert
+
+
+def consume_user_decoder_use(db, user, limit=DECODER_FREE_LIMIT):
+    """Check and count one decoder use in a single conditional UPDATE.
+
+    Paid members are always allowed; free members only while under the
+    limit. Returns (allowed, decoder_total_uses). The caller commits unless
+    buffers_usage(user) is true.
+    """
+    if buffers_usage(user):
+        write_behind.buffer.add_decoder_use(user.id)
+        return True, user.decoder_total_uses + write_behind.buffer.pending_decoder_uses(user.id)
+
+    new_total = db.session.execute(
+        update(User)
+        .where(
+            User.id == user.id,
+            or_(User.decoder_total_uses < limit, _has_active_subscription([TIER_BASIC, TIER_PREMIUM]))
+        )
+        .values(decoder_total_uses=User.decoder_total_uses + 1)
+        .returning(User.decoder_total_uses)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if new_total is None:
+        return False, user.decoder_total_uses
+    set_committed_value(user, 'decoder_total_uses', new_total)
+    return True, new_total
+
+
+def consume_guest_decoder_use(db, session_id, limit=DECODER_FREE_LIMIT):
+    """Check and count one guest decoder use in a single upsert.
+
+    The row is created on the first use; the conflict branch only increments
+    while under the limit. Returns (allowed, decoder_total_uses). The caller
+    commits.
+    """
+    insert = insert_for(db)
+    now = datetime.utcnow()
+    statement = insert(GuestTotalUsage).values(
+        session_id=session_id,
+        decoder_total_uses=1,
+        created_at=now,
+        last_used_at=now
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[GuestTotalUsage.session_id],
+        set_={'decoder_total_uses': GuestTotalUsage.decoder_total_uses + 1, 'last_used_at': now},
+        where=GuestTotalUsage.decoder_total_uses < limit
+    ).returning(GuestTotalUsage.decoder_total_uses)
+
+    new_total = db.session.execute(statement).scalar()
+    if new_total is None:
+        return False, limit
+    return True, new_total
+
+
+def guest_decoder_uses(db, session_id):
+    """Guest decoder uses so far, without creating a row (missing row = 0)"""
+    total = db.session.query(GuestTotalUsage.decoder_total_uses).filter_by(
+        session_id=session_id
+    ).scalar()
+    return total or 0
+
+
+def consume_guide_message(db, user, daily_token_budget=None):
+    """Check premium access, apply the daily reset and count one Guide message
+    in a single conditional UPDATE.
+
+    With a token budget the message is refused once today's tokens reach it.
+    Returns (allowed, guide_messages_today). The caller commits unless
+    buffers_usage(user) is true.
+    """
+    if buffers_usage(user):
+        if not guide_allowance(user, daily_token_budget)[0]:
+            return False, user.guide_messages_today
+        write_behind.buffer.add_guide(user.id, messages=1)
+        return True, user.guide_messages_today + 1
+
+    today = date.today()
+    is_today = User.guide_last_message_date == today
+    tokens_today = case((is_today, User.guide_tokens_today), else_=0)
+
+    conditions = [User.id == user.id, _has_active_subscription([TIER_PREMIUM])]
+    if daily_token_budget:
+        conditions.append(tokens_today < daily_token_budget)
+
+    row = db.session.execute(
+        update(User)
+        .where(*conditions)
+        .values(
+            guide_messages_today=case((is_today, User.guide_messages_today + 1), else_=1),
+            guide_tokens_today=tokens_today,
+            guide_last_message_date=today
+        )
+        .returning(User.guide_messages_today, User.guide_tokens_today)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        return False, user.guide_messages_today
+    set_committed_value(user, 'guide_messages_today', row[0])
+    set_committed_value(user, 'guide_tokens_today', row[1])
+    set_committed_value(user, 'guide_last_message_date', today)
+    return True, row[0]
+
+
+def add_guide_tokens(db, user, tokens):
+    """Atomically add tokens to today's Guide counter. The caller commits."""
+    if buffers_usage(user):
+        write_behind.buffer.add_guide(user.id, tokens=tokens)
+        return pending_guide_tokens(user)
+
+    today = date.today()
+    is_today = User.guide_last_message_date == today
+    new_total = db.session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(
+            guide_tokens_today=case((is_today, User.guide_tokens_today), else_=0) + tokens,
+            guide_last_message_date=today
+        )
+        .returning(User.guide_tokens_today)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+    if new_total is not None:
+        set_committed_value(user, 'guide_tokens_today', new_total)
+        set_committed_value(user, 'guide_last_message_date', today)
+    return new_total
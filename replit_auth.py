@@ -57,7 +57,7 @@ class UserSessionStorage(BaseStorage):
         self.db.session.commit()
 
 
-def make_replit_blueprint(db, User, OAuth):
+def make_replit_blueprint(db, User, OAuth, on_user_saved=None):
     try:
         repl_id = os.environ['REPL_ID']
     except KeyError:
@@ -125,6 +125,8 @@ def make_replit_blueprint(db, User, OAuth):
         user.profile_image_url = user_claims.get('profile_image_url')
         merged_user = db.session.merge(user)
         db.session.commit()
+        if on_user_saved:
+            on_user_saved(merged_user)
         return merged_user
 
     @oauth_authorized.connect_via(replit_bp)
@@ -0,0 +1,440 @@
+"""Per-endpoint request instrumentation in Prometheus text format.
+
+Each request records its latency, response size and status code, plus the
+number of SQL statements it ran and the time they took (via engine events),
+under its route template. Recording is a few dict lookups and list
+increments under one lock; formatting only happens when /metrics is scraped.
+
+Metrics are per process. Under gunicorn, set METRICS_DIR to a directory
+shared by the workers. Each worker then writes a snapshot there every
+METRICS_SNAPSHOT_SECONDS, and a scrape of any worker reports the sum across
+all of them. When a worker exits, the gunicorn master folds its last
+snapshot into a retired total and deletes its file, so the directory holds
+one file per live worker and the counters still never go backwards.
+"""
+import glob
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('REQUEST_METRICS', '1') != '0'
+# Bearer token for scrapers (admins can also read /metrics with their session)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+SNAPSHOT_SECONDS = float(os.environ.get('METRICS_SNAPSHOT_SECONDS', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+DEPENDENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class EndpointStats:
+    __slots__ = ('latency', 'size', 'queries', 'sql_seconds', 'statuses')
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.sql_seconds = 0.0
+        self.statuses = defaultdict(int)
+
+
+class DependencyStats:
+    __slots__ = ('latency', 'outcomes', 'retries')
+
+    def __init__(self):
+        self.latency = Histogram(DEPENDENCY_BUCKETS)
+        self.outcomes = defaultdict(int)
+        self.retries = 0
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.dependencies = {}
+        self.background_statements = 0
+        self.background_sql_seconds = 0.0
+
+    def record(self, method, endpoint, status, seconds, size, statements, sql_seconds):
+        key = (method, endpoint)
+        with self._lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.latency.observe(seconds)
+            if size is not None:
+                stats.size.observe(size)
+            stats.queries.observe(statements)
+            stats.sql_seconds += sql_seconds
+            stats.statuses[status] += 1
+
+    def record_dependency(self, dependency, operation, outcome, seconds, retries):
+        key = (dependency, operation)
+        with self._lock:
+            stats = self.dependencies.get(key)
+            if stats is None:
+                stats = self.dependencies[key] = DependencyStats()
+            stats.latency.observe(seconds)
+            stats.outcomes[outcome] += 1
+            stats.retries += retries
+
+    def record_background_sql(self, seconds):
+        with self._lock:
+            self.background_statements += 1
+            self.background_sql_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'endpoints': [
+                    {'method': method, 'endpoint': endpoint,
+                     'latency': s.latency.snapshot(), 'size': s.size.snapshot(),
+                     'queries': s.queries.snapshot(), 'sql_seconds': s.sql_seconds,
+                     'statuses': {str(code): n for code, n in s.statuses.items()}}
+                    for (method, endpoint), s in self.endpoints.items()
+                ],
+                'dependencies': [
+                    {'dependency': dependency, 'operation': operation, 'latency': s.latency.snapshot(),
+                     'outcomes': dict(s.outcomes), 'retries': s.retries}
+                    for (dependency, operation), s in self.dependencies.items()
+                ],
+                'background_statements': self.background_statements,
+                'background_sql_seconds': self.background_sql_seconds,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.dependencies = {}
+            self.background_statements = 0
+            self.background_sql_seconds = 0.0
+
+
+metrics = RequestMetrics()
+_local = threading.local()
+
+
+# --- collection -------------------------------------------------------------
+
+def _start_request():
+    # Resolve the request proxy once; each proxy access costs about a microsecond
+    req = request._get_current_object()
+    rule = req.url_rule
+    _local.method = req.method
+    _local.endpoint = rule.rule if rule is not None else 'unmatched'
+    _local.statements = 0
+    _local.sql_seconds = 0.0
+    _local.recorded = False
+    _local.started = time.perf_counter()
+
+
+def _response_size(response):
+    body = response.response
+    if isinstance(body, list):
+        return sum(len(chunk) for chunk in body)
+    # Files and streams: the header, when the size is known up front
+    return response.content_length
+
+
+def _finish_request(response):
+    local = _local
+    started = getattr(local, 'started', None)
+    if started is not None and not local.recorded:
+        local.recorded = True
+        metrics.record(local.method, local.endpoint, response.status_code, time.perf_counter() - started,
+                       _response_size(response), local.statements, local.sql_seconds)
+    return response
+
+
+def _teardown_request(exc):
+    """Requests that raised never reach after_request; count them as 500s"""
+    local = _local
+    started = getattr(local, 'started', None)
+    if started is not None and not local.recorded:
+        local.recorded = True
+        metrics.record(local.method, local.endpoint, 500, time.perf_counter() - started,
+                       None, local.statements, local.sql_seconds)
+    local.started = None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('query_started')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    if getattr(_local, 'started', None) is not None:
+        _local.statements += 1
+        _local.sql_seconds += elapsed
+    else:
+        metrics.record_background_sql(elapsed)
+
+
+def install(app, engines):
+    """Register the request hooks first, so latency covers the other hooks,
+    and time every statement on `engines`"""
+    if not ENABLED:
+        return
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    # after_request hooks run in reverse order of registration: this runs last
+    app.after_request_funcs.setdefault(None, []).insert(0, _finish_request)
+    app.teardown_request(_teardown_request)
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# --- exposition -------------------------------------------------------------
+
+def authorized(req):
+    """True if the request carries the METRICS_TOKEN bearer token"""
+    header = req.headers.get('Authorization', '')
+    return bool(METRICS_TOKEN) and header.startswith('Bearer ') and \
+        hmac.compare_digest(header[7:].encode(), METRICS_TOKEN.encode())
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f'request-metrics-{pid}.json')
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot():
+    """Save this process's metrics for the other workers' scrapes"""
+    path = _snapshot_path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def retire_snapshot(pid):
+    """Fold an exited worker's last snapshot into the retired total and
+    delete its file. Called by the gunicorn master only, so the retired file
+    has a single writer."""
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path(pid)
+    snapshot = _read_json(path)
+    if snapshot is not None:
+        retired_path = _snapshot_path('retired')
+        retired = _read_json(retired_path)
+        endpoints, dependencies, background = _merge([retired, snapshot] if retired else [snapshot])
+        # Swapped in right after the worker's file is deleted, so a scrape
+        # in between misses it for a moment rather than counting it twice
+        with open(retired_path + '.tmp', 'w') as f:
+            json.dump({'endpoints': list(endpoints.values()), 'dependencies': list(dependencies.values()),
+                       'background_statements': background[0], 'background_sql_seconds': background[1]}, f)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    if snapshot is not None:
+        os.replace(retired_path + '.tmp', retired_path)
+
+
+def retire_dead_snapshots():
+    """Retire the snapshots of processes that are no longer running, such
+    as the workers of a previous deployment"""
+    if not METRICS_DIR:
+        return
+    for path in glob.glob(os.path.join(METRICS_DIR, 'request-metrics-*.json')):
+        pid = os.path.basename(path)[len('request-metrics-'):-len('.json')]
+        if not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            retire_snapshot(pid)
+        except PermissionError:
+            pass
+
+
+def start_snapshot_writer():
+    if not (ENABLED and METRICS_DIR):
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(SNAPSHOT_SECONDS)
+            try:
+                write_snapshot()
+            except OSError as e:
+                logger.error("Metrics snapshot failed: %s", e, extra={'event': 'metrics.snapshot_failed'})
+
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+
+
+def _all_snapshots():
+    """This process's live metrics plus the latest snapshot of every other
+    worker and the retired total of exited ones"""
+    snapshots = [metrics.snapshot()]
+    if METRICS_DIR:
+        own = _snapshot_path(os.getpid())
+        for path in glob.glob(os.path.join(METRICS_DIR, 'request-metrics-*.json')):
+            if path == own:
+                continue
+            snapshot = _read_json(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+    return snapshots
+
+
+def _add_histogram(h, other):
+    h['counts'] = [a + b for a, b in zip(h['counts'], other['counts'])]
+    h['sum'] += other['sum']
+    h['count'] += other['count']
+
+
+def _add_counts(counts, other):
+    for key, n in other.items():
+        counts[key] = counts.get(key, 0) + n
+
+
+def _merge(snapshots):
+    endpoints = {}
+    dependencies = {}
+    background = [0, 0.0]
+    for snapshot in snapshots:
+        background[0] += snapshot['background_statements']
+        background[1] += snapshot['background_sql_seconds']
+        for e in snapshot['endpoints']:
+            key = (e['method'], e['endpoint'])
+            target = endpoints.get(key)
+            if target is None:
+                endpoints[key] = json.loads(json.dumps(e))
+                continue
+            for name in ('latency', 'size', 'queries'):
+                _add_histogram(target[name], e[name])
+            target['sql_seconds'] += e['sql_seconds']
+            _add_counts(target['statuses'], e['statuses'])
+        for d in snapshot.get('dependencies', ()):
+            key = (d['dependency'], d['operation'])
+            target = dependencies.get(key)
+            if target is None:
+                dependencies[key] = json.loads(json.dumps(d))
+                continue
+            _add_histogram(target['latency'], d['latency'])
+            _add_counts(target['outcomes'], d['outcomes'])
+            target['retries'] += d['retries']
+    return endpoints, dependencies, background
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _histogram_lines(name, buckets, h, labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, h['counts']):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {h["count"]}')
+    lines.append(f'{name}_sum{_labels(**labels)} {h["sum"]:.6f}')
+    lines.append(f'{name}_count{_labels(**labels)} {h["count"]}')
+    return lines
+
+
+def render(gauges=()):
+    """Prometheus text exposition of every endpoint's and dependency's
+    metrics, followed by `gauges`: (name, help, [(labels, value)]) for this
+    process"""
+    endpoints, dependencies, background = _merge(_all_snapshots())
+    endpoints = sorted(endpoints.items())
+    dependencies = sorted(dependencies.items())
+    out = []
+
+    def family(name, kind, help_text):
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} {kind}')
+
+    family('soulart_http_requests_total', 'counter', 'Requests by route, method and status code.')
+    for (method, endpoint), e in endpoints:
+        for code, n in sorted(e['statuses'].items()):
+            out.append(f'soulart_http_requests_total{_labels(method=method, endpoint=endpoint, status=code)} {n}')
+
+    for name, key, buckets, help_text in (
+        ('soulart_http_request_duration_seconds', 'latency', LATENCY_BUCKETS, 'Request latency by route.'),
+        ('soulart_http_response_size_bytes', 'size', SIZE_BUCKETS, 'Response body size by route.'),
+        ('soulart_http_request_sql_statements', 'queries', QUERY_BUCKETS, 'SQL statements per request by route.'),
+    ):
+        family(name, 'histogram', help_text)
+        for (method, endpoint), e in endpoints:
+            out.extend(_histogram_lines(name, buckets, e[key], {'method': method, 'endpoint': endpoint}))
+
+    family('soulart_http_request_sql_seconds_total', 'counter', 'Time spent in SQL statements by route.')
+    for (method, endpoint), e in endpoints:
+        out.append(f'soulart_http_request_sql_seconds_total{_labels(method=method, endpoint=endpoint)} '
+                   f'{e["sql_seconds"]:.6f}')
+
+    family('soulart_background_sql_statements_total', 'counter', 'SQL statements run outside requests.')
+    out.append(f'soulart_background_sql_statements_total {background[0]}')
+    family('soulart_background_sql_seconds_total', 'counter', 'Time in SQL statements run outside requests.')
+    out.append(f'soulart_background_sql_seconds_total {background[1]:.6f}')
+
+    family('soulart_dependency_calls_total', 'counter', 'Outbound calls by dependency, operation and outcome.')
+    for (dependency, operation), d in dependencies:
+        for outcome, n in sorted(d['outcomes'].items()):
+            out.append(f'soulart_dependency_calls_total'
+                       f'{_labels(dependency=dependency, operation=operation, outcome=outcome)} {n}')
+    family('soulart_dependency_duration_seconds', 'histogram', 'Outbound call latency, retries included.')
+    for (dependency, operation), d in dependencies:
+        out.extend(_histogram_lines('soulart_dependency_duration_seconds', DEPENDENCY_BUCKETS, d['latency'],
+                                    {'dependency': dependency, 'operation': operation}))
+    family('soulart_dependency_retries_total', 'counter', 'HTTP retries made by outbound calls.')
+    for (dependency, operation), d in dependencies:
+        out.append(f'soulart_dependency_retries_total{_labels(dependency=dependency, operation=operation)} '
+                   f'{d["retries"]}')
+
+    for name, help_text, samples in gauges:
+        family(name, 'gauge', help_text)
+        for labels, value in samples:
+            out.append(f'{name}{_labels(**labels) if labels else ""} {value}')
+
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,245 @@
+"""Versioned schema migrations.
+
+db.create_all() only creates missing tables, so columns and indexes added to
+existing tables need a revision here. Revisions are applied in list order and
+recorded in schema_migrations. Revisions marked concurrent run outside a
+transaction so Postgres can build indexes with CREATE INDEX CONCURRENTLY
+without blocking writes.
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, Text, func, inspect, select, text
+
+# Postgres advisory lock key so two deploys never migrate at once
+ADVISORY_LOCK_KEY = 7_345_120_041
+
+_metadata = MetaData()
+versions_table = Table(
+    'schema_migrations', _metadata,
+    Column('version', String(100), primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class Migration:
+    def __init__(self, version, description, upgrade, downgrade, verify, concurrent=False):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.downgrade = downgrade
+        self.verify = verify
+        self.concurrent = concurrent
+
+
+def _is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def _has_column(conn, table, column):
+    return column in {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def add_column(version, table, column, ddl):
+    """Revision adding `column` to `table`; a no-op where create_all already made it"""
+    def upgrade(conn):
+        if not _has_column(conn, table, column):
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+    def downgrade(conn):
+        if _has_column(conn, table, column):
+            conn.execute(text(f'ALTER TABLE {table} DROP COLUMN {column}'))
+
+    def verify(conn):
+        present = _has_column(conn, table, column)
+        return present, 'present' if present else 'missing'
+
+    return Migration(version, f'Add {table}.{column}', upgrade, downgrade, verify)
+
+
+def index_state(conn, name):
+    """True if the index exists and is usable, False if Postgres marked it
+    INVALID (an interrupted concurrent build), None if missing"""
+    if _is_postgres(conn):
+        return conn.execute(text(
+            "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+        ), {'name': name}).scalar()
+    found = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"
+    ), {'name': name}).scalar()
+    return True if found else None
+
+
+def create_index(version, name, table, columns):
+    """Revision building an index online (CONCURRENTLY on Postgres)"""
+    def upgrade(conn):
+        if _is_postgres(conn):
+            if index_state(conn, name) is False:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+            conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})'))
+        else:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+
+    def downgrade(conn):
+        concurrently = ' CONCURRENTLY' if _is_postgres(conn) else ''
+        conn.execute(text(f'DROP INDEX{concurrently} IF EXISTS {name}'))
+
+    def verify(conn):
+        state = index_state(conn, name)
+        if state is None:
+            return False, 'missing'
+        if state is False:
+            return False, 'INVALID - roll back this revision and apply it again'
+        return True, 'valid'
+
+    return Migration(version, f'Index {table} ({columns})', upgrade, downgrade, verify, concurrent=True)
+
+
+MIGRATIONS = [
+    add_column('0001_users_guide_tokens_today', 'users', 'guide_tokens_today', 'INTEGER NOT NULL DEFAULT 0'),
+    add_column('0002_guest_total_usage_last_used_at', 'guest_total_usage', 'last_used_at', 'TIMESTAMP'),
+    add_column('0003_users_data_version', 'users', 'data_version', 'INTEGER NOT NULL DEFAULT 0'),
+    create_index('0004_journal_entries_user_created', 'ix_journal_entries_user_created',
+                 'journal_entries', 'user_id, created_at'),
+    create_index('0005_oracle_readings_user_created', 'ix_oracle_readings_user_created',
+                 'oracle_readings', 'user_id, created_at'),
+    create_index('0006_discovery_sessions_user_started', 'ix_discovery_sessions_user_started',
+                 'discovery_sessions', 'user_id, started_at'),
+    create_index('0007_users_stripe_customer_id', 'ix_users_stripe_customer_id',
+                 'users', 'stripe_customer_id'),
+    create_index('0008_stripe_webhook_inbox_customer_status_next', 'ix_stripe_webhook_inbox_customer_status_next',
+                 'stripe_webhook_inbox', 'customer_id, status, next_attempt_at'),
+    create_index('0009_booking_requests_created_at', 'ix_booking_requests_created_at',
+                 'booking_requests', 'created_at'),
+]
+
+# Queries behind the busiest endpoints and the index each should use
+HOT_QUERIES = [
+    ('journal entries by user', 'ix_journal_entries_user_created',
+     "SELECT * FROM journal_entries WHERE user_id = 'x' ORDER BY created_at DESC"),
+    ('oracle readings by user', 'ix_oracle_readings_user_created',
+     "SELECT * FROM oracle_readings WHERE user_id = 'x' ORDER BY created_at DESC LIMIT 20"),
+    ('discovery sessions by user', 'ix_discovery_sessions_user_started',
+     "SELECT * FROM discovery_sessions WHERE user_id = 'x' ORDER BY started_at DESC LIMIT 20"),
+    ('user by Stripe customer', 'ix_users_stripe_customer_id',
+     "SELECT * FROM users WHERE stripe_customer_id = 'cus_x'"),
+    ('latest booking requests', 'ix_booking_requests_created_at',
+     "SELECT * FROM booking_requests ORDER BY created_at DESC LIMIT 100"),
+]
+
+
+def applied_versions(engine):
+    """{version: applied_at} for every recorded revision"""
+    with engine.begin() as conn:
+        versions_table.create(conn, checkfirst=True)
+        rows = conn.execute(select(versions_table.c.version, versions_table.c.applied_at)).all()
+    return {version: applied_at for version, applied_at in rows}
+
+
+class _MigrationLock:
+    """Session-level advisory lock on Postgres; nothing elsewhere"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.conn = None
+
+    def __enter__(self):
+        if self.engine.dialect.name == 'postgresql':
+            self.conn = self.engine.connect()
+            self.conn.execute(select(func.pg_advisory_lock(ADVISORY_LOCK_KEY)))
+            self.conn.commit()
+        return self
+
+    def __exit__(self, *exc):
+        if self.conn is not None:
+            self.conn.execute(select(func.pg_advisory_unlock(ADVISORY_LOCK_KEY)))
+            self.conn.commit()
+            self.conn.close()
+
+
+def _run(engine, migration, step):
+    if migration.concurrent:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            step(conn)
+    else:
+        with engine.begin() as conn:
+            step(conn)
+
+
+def upgrade(engine, target=None, echo=print):
+    """Apply pending revisions in order, up to and including `target`.
+    Returns the versions applied."""
+    if target and target not in {m.version for m in MIGRATIONS}:
+        raise ValueError(f'Unknown migration {target}')
+    applied = []
+    with _MigrationLock(engine):
+        done = applied_versions(engine)
+        for migration in MIGRATIONS:
+            if migration.version not in done:
+                echo(f'Applying {migration.version}: {migration.description}')
+                _run(engine, migration, migration.upgrade)
+                with engine.begin() as conn:
+                    conn.execute(versions_table.insert().values(
+                        version=migration.version,
+                        description=migration.description,
+                        applied_at=datetime.utcnow()
+                    ))
+                applied.append(migration.version)
+            if migration.version == target:
+                break
+    return applied
+
+
+def rollback(engine, target=None, echo=print):
+    """Revert applied revisions newer than `target` (default: only the latest;
+    'base' reverts everything), newest first. Returns the versions reverted."""
+    versions = [m.version for m in MIGRATIONS]
+    if target and target != 'base' and target not in versions:
+        raise ValueError(f'Unknown migration {target}')
+    reverted = []
+    with _MigrationLock(engine):
+        done = applied_versions(engine)
+        candidates = [m for m in reversed(MIGRATIONS) if m.version in done]
+        if target is None:
+            candidates = candidates[:1]
+        elif target != 'base':
+            candidates = [m for m in candidates if versions.index(m.version) > versions.index(target)]
+        for migration in candidates:
+            echo(f'Reverting {migration.version}: {migration.description}')
+            _run(engine, migration, migration.downgrade)
+            with engine.begin() as conn:
+                conn.execute(versions_table.delete().where(versions_table.c.version == migration.version))
+            reverted.append(migration.version)
+    return reverted
+
+
+def verify(engine):
+    """Check every applied revision against the live schema.
+    Returns [(version, applied, ok, detail)]."""
+    done = applied_versions(engine)
+    results = []
+    with engine.connect() as conn:
+        for migration in MIGRATIONS:
+            ok, detail = migration.verify(conn)
+            results.append((migration.version, migration.version in done, ok, detail))
+    return results
+
+
+def explain_hot_queries(engine):
+    """EXPLAIN each hot query and report whether its index is used.
+    Returns [(name, index, used, plan)]."""
+    results = []
+    with engine.connect() as conn:
+        postgres = _is_postgres(conn)
+        if postgres:
+            # Tiny tables would be seq-scanned anyway; ask whether the index can be used
+            conn.execute(text('SET LOCAL enable_seqscan = off'))
+        for name, index, query in HOT_QUERIES:
+            if postgres:
+                plan = '\n'.join(row[0] for row in conn.execute(text(f'EXPLAIN {query}')))
+            else:
+                plan = '\n'.join(str(row[-1]) for row in conn.execute(text(f'EXPLAIN QUERY PLAN {query}')))
+            results.append((name, index, index in plan, plan))
+        conn.rollback()
+    return results
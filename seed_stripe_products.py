@@ -2,6 +2,8 @@
 """
 Seed script to create Stripe products and prices for SoulArt Temple membership tiers.
 Run this script once to set up the subscription products in Stripe.
+It also records every price and product in the app's local price-to-tier
+index so subscription webhooks can resolve tiers without calling Stripe.
 
 Usage: python seed_stripe_products.py
 """
@@ -14,6 +16,16 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from stripe_client import get_stripe_client, PRICING_TIERS
 
+
+def index_products_and_prices(stripe):
+    """Mirror the SoulArt products and prices into the local tier index"""
+    from app import app, db
+    from stripe_catalog import sync_catalog
+    
+    with app.app_context():
+        products, prices = sync_catalog(db, stripe)
+    print(f"Indexed {products} products and {prices} prices in the local tier index.")
+
 def create_products_and_prices():
     stripe = get_stripe_client()
     
@@ -29,6 +41,7 @@ def create_products_and_prices():
         response = input("\nDo you want to skip creating new products? (y/n): ")
         if response.lower() == 'y':
             print("Skipping product creation.")
+            index_products_and_prices(stripe)
             return
     
     created_items = []
@@ -137,6 +150,8 @@ def create_products_and_prices():
     print("-" * 60)
     print("\nThese IDs are stored in Stripe and will be fetched dynamically.")
     print("You can also find them in your Stripe Dashboard > Products.")
+    
+    index_products_and_prices(stripe)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+"""Startup timeline for app.py.
+
+Imported before anything else in app.py so the offsets cover every import
+and init phase. With LAZY_INIT=1 the app defers what it can (SDK imports,
+clients, schema creation, background workers) until first use, so an
+autoscale instance can answer its first request sooner.
+"""
+import os
+import threading
+import time
+
+# Defer heavy imports, clients, schema management and background workers
+LAZY_INIT = os.environ.get('LAZY_INIT') == '1'
+# Set by gunicorn.conf.py when the app is imported once in the master and
+# forked into workers: threads, pools and clients are then created per worker
+# after the fork instead of at import
+PRELOAD = os.environ.get('GUNICORN_PRELOAD') == '1'
+
+_started = time.perf_counter()
+_phases = []
+_once_lock = threading.Lock()
+_done = set()
+
+
+def mark(phase):
+    """Record that `phase` finished, as milliseconds since startup began"""
+    _phases.append((phase, round((time.perf_counter() - _started) * 1000, 1)))
+
+
+def timeline():
+    """[{phase, at_ms, took_ms}] in the order the phases finished"""
+    report = []
+    previous = 0.0
+    for phase, at_ms in _phases:
+        report.append({'phase': phase, 'at_ms': at_ms, 'took_ms': round(at_ms - previous, 1)})
+        previous = at_ms
+    return report
+
+
+def summary():
+    return ', '.join(f"{p['phase']} {p['took_ms']}ms" for p in timeline())
+
+
+def run_once(name, func):
+    """Call func() the first time `name` is seen in this process; later calls
+    return immediately. Returns True if this call ran it."""
+    if name in _done:
+        return False
+    with _once_lock:
+        if name in _done:
+            return False
+        _done.add(name)
+    func()
+    return True
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from models import StripeProduct, StripePrice
+from stripe_client import PRICING_TIERS
+
+logger = logging.getLogger(__name__)
+
+APP_METADATA = 'soulart_temple'
+
+# How long a worker serves its in-memory snapshot before re-reading the local
+# tables (picks up webhook updates handled by other workers)
+SNAPSHOT_TTL_SECONDS = int(os.environ.get('STRIPE_CATALOG_SNAPSHOT_TTL', '60'))
+# How often to reconcile the local tables against Stripe (0 disables)
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('STRIPE_CATALOG_RECONCILE_SECONDS', '3600'))
+
+_snapshot = None
+_snapshot_loaded_at = 0.0
+_snapshot_lock = threading.Lock()
+_reconciler_started = False
+
+
+def stripe_field(obj, key, default=None):
+    """Read a field from a StripeObject or a plain dict (unverified webhooks)"""
+    if obj is None:
+        return default
+    try:
+        value = obj[key]
+    except (KeyError, TypeError):
+        return default
+    return default if value is None else value
+
+
+def upsert_product(db, product):
+    """Insert or update the local copy of a Stripe product. The caller commits."""
+    metadata = stripe_field(product, 'metadata', {})
+    row = db.session.get(StripeProduct, product['id'])
+    if not row:
+        row = StripeProduct(id=product['id'])
+        db.session.add(row)
+    row.name = stripe_field(product, 'name', '')
+    row.description = stripe_field(product, 'description')
+    row.tier = stripe_field(metadata, 'tier')
+    row.app = stripe_field(metadata, 'app')
+    row.active = bool(stripe_field(product, 'active', True))
+    row.updated_at = datetime.utcnow()
+    return row
+
+
+def upsert_price(db, price):
+    """Insert or update the local copy of a Stripe price. The caller commits."""
+    metadata = stripe_field(price, 'metadata', {})
+    recurring = stripe_field(price, 'recurring', {})
+    product_id = stripe_field(price, 'product')
+    if not isinstance(product_id, str):
+        product_id = product_id['id']
+    row = db.session.get(StripePrice, price['id'])
+    if not row:
+        row = StripePrice(id=price['id'])
+        db.session.add(row)
+    row.product_id = product_id
+    row.unit_amount = stripe_field(price, 'unit_amount')
+    row.currency = stripe_field(price, 'currency', 'gbp')
+    row.interval = stripe_field(recurring, 'interval', 'month')
+    row.interval_count = stripe_field(recurring, 'interval_count', 1)
+    row.plan_type = stripe_field(metadata, 'plan_type', 'monthly')
+    row.tier = stripe_field(metadata, 'tier')
+    row.active = bool(stripe_field(price, 'active', True))
+    row.updated_at = datetime.utcnow()
+    return row
+
+
+def deactivate(db, model, object_id):
+    row = db.session.get(model, object_id)
+    if row:
+        row.active = False
+        row.updated_at = datetime.utcnow()
+
+
+def _tier_from_pricing_tiers(price):
+    """Match a price's amount and billing interval against PRICING_TIERS"""
+    recurring = stripe_field(price, 'recurring', {})
+    unit_amount = stripe_field(price, 'unit_amount')
+    if unit_amount is None:
+        return None
+    for plan in PRICING_TIERS.values():
+        if (plan['price'] == unit_amount
+                and plan['currency'] == stripe_field(price, 'currency', 'gbp')
+                and plan['interval'] == stripe_field(recurring, 'interval', 'month')
+                and plan['interval_count'] == stripe_field(recurring, 'interval_count', 1)):
+            return plan['tier']
+    return None
+
+
+def resolve_tier(db, price):
+    """Resolve the membership tier for a subscription item's price without
+    calling Stripe. Checks the price's own metadata, then the local
+    price/product index, then PRICING_TIERS. Returns None on a miss."""
+    tier = stripe_field(stripe_field(price, 'metadata', {}), 'tier')
+    if tier:
+        return tier
+
+    price_id = stripe_field(price, 'id')
+    product_id = stripe_field(price, 'product')
+    if isinstance(product_id, dict):
+        product_id = product_id.get('id')
+
+    if price_id:
+        row = db.session.get(StripePrice, price_id)
+        if row:
+            if row.tier:
+                return row.tier
+            product_id = product_id or row.product_id
+
+    if product_id:
+        row = db.session.get(StripeProduct, product_id)
+        if row and row.tier:
+            return row.tier
+
+    return _tier_from_pricing_tiers(price)
+
+
+def handle_catalog_event(db, event_type, data):
+    """Apply a product.* or price.* webhook event to the local catalog"""
+    if event_type.startswith('product.'):
+        if event_type == 'product.deleted':
+            deactivate(db, StripeProduct, data['id'])
+        else:
+            upsert_product(db, data)
+    elif event_type.startswith('price.'):
+        if event_type == 'price.deleted':
+            deactivate(db, StripePrice, data['id'])
+        else:
+            upsert_price(db, data)
+    else:
+        return False
+    db.session.commit()
+    invalidate_snapshot()
+    return True
+
+
+def sync_catalog(db, stripe_client):
+    """Pull every SoulArt product and price from Stripe into the local tables.
+
+    Uses one product search plus one paginated price listing instead of a
+    price listing per product. Local rows Stripe no longer reports as active
+    are deactivated.
+    """
+    products = stripe_client.Product.search(
+        query=f"metadata['app']:'{APP_METADATA}'"
+    ).auto_paging_iter()
+    product_ids = set()
+    for product in products:
+        upsert_product(db, product)
+        product_ids.add(product['id'])
+
+    price_ids = set()
+    for price in stripe_client.Price.list(active=True, limit=100).auto_paging_iter():
+        product_id = stripe_field(price, 'product')
+        if product_id in product_ids:
+            upsert_price(db, price)
+            price_ids.add(price['id'])
+
+    for row in db.session.query(StripeProduct).filter(StripeProduct.active.is_(True)):
+        if row.id not in product_ids:
+            row.active = False
+    for row in db.session.query(StripePrice).filter(StripePrice.active.is_(True)):
+        if row.id not in price_ids:
+            row.active = False
+
+    db.session.commit()
+    invalidate_snapshot()
+    return len(product_ids), len(price_ids)
+
+
+def build_catalog(db):
+    """Build the /api/stripe/products payload from the local tables"""
+    products = db.session.query(StripeProduct).filter(
+        StripeProduct.app == APP_METADATA,
+        StripeProduct.active.is_(True)
+    ).order_by(StripeProduct.name).all()
+    prices = db.session.query(StripePrice).filter(
+        StripePrice.product_id.in_([p.id for p in products]),
+        StripePrice.active.is_(True)
+    ).order_by(StripePrice.unit_amount).all() if products else []
+
+    prices_by_product = {}
+    for price in prices:
+        prices_by_product.setdefault(price.product_id, []).append({
+            'id': price.id,
+            'unit_amount': price.unit_amount,
+            'currency': price.currency,
+            'interval': price.interval,
+            'interval_count': price.interval_count,
+            'plan_type': price.plan_type
+        })
+
+    return {'products': [{
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'tier': product.tier or 'basic',
+        'prices': prices_by_product.get(product.id, [])
+    } for product in products]}
+
+
+def get_catalog_snapshot(db):
+    """Return (etag, payload) for the product catalog without calling Stripe"""
+    global _snapshot, _snapshot_loaded_at
+    snapshot = _snapshot
+    if snapshot and time.monotonic() - _snapshot_loaded_at < SNAPSHOT_TTL_SECONDS:
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is snapshot or _snapshot is None:
+            payload = build_catalog(db)
+            body = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+            etag = hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+            _snapshot = (etag, payload)
+            _snapshot_loaded_at = time.monotonic()
+        return _snapshot
+
+
+def invalidate_snapshot():
+    global _snapshot
+    _snapshot = None
+
+
+def _sync_in_app_context(app, db, get_stripe_client):
+    with app.app_context():
+        try:
+            products, prices = sync_catalog(db, get_stripe_client())
+            logger.info("Stripe catalog synced: %s products, %s prices", products, prices,
+                        extra={'event': 'stripe.catalog_synced', 'products': products, 'prices': prices})
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Stripe catalog sync failed: %s", e, extra={'event': 'stripe.catalog_sync_failed'})
+
+
+def warm_catalog(app, db, get_stripe_client):
+    """Load the snapshot at startup, syncing from Stripe in the background if
+    the local tables are still empty, and start periodic reconciliation."""
+    global _reconciler_started
+    with app.app_context():
+        try:
+            has_products = db.session.query(StripeProduct.id).first() is not None
+            get_catalog_snapshot(db)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Stripe catalog warm-up failed: %s", e, extra={'event': 'stripe.catalog_sync_failed'})
+            has_products = True
+
+    if not has_products:
+        threading.Thread(
+            target=_sync_in_app_context,
+            args=(app, db, get_stripe_client),
+            name='stripe-catalog-sync',
+            daemon=True
+        ).start()
+
+    if RECONCILE_INTERVAL_SECONDS > 0 and not _reconciler_started:
+        _reconciler_started = True
+
+        def reconcile_forever():
+            while True:
+                time.sleep(RECONCILE_INTERVAL_SECONDS)
+                _sync_in_app_context(app, db, get_stripe_client)
+
+        threading.Thread(target=reconcile_forever, name='stripe-catalog-reconcile', daemon=True).start()
@@ -1,56 +1,20 @@
 import os
-import requests
-import stripe
+import re
+import sys
+from urllib.parse import urlsplit
 
-_connection_settings = None
+import tracing
+from connector_credentials import get_cached_credential, get_target_environment
 
-def get_stripe_credentials():
-    """Fetch Stripe credentials from Replit connection API"""
-    global _connection_settings
-    
-    hostname = os.environ.get('REPLIT_CONNECTORS_HOSTNAME')
-    
-    x_replit_token = os.environ.get('REPL_IDENTITY')
-    if x_replit_token:
-        x_replit_token = 'repl ' + x_replit_token
-    else:
-        x_replit_token = os.environ.get('WEB_REPL_RENEWAL')
-        if x_replit_token:
-            x_replit_token = 'depl ' + x_replit_token
-    
-    if not x_replit_token or not hostname:
-        raise Exception('Replit connection credentials not found')
-    
-    is_production = os.environ.get('REPLIT_DEPLOYMENT') == '1'
-    target_environment = 'production' if is_production else 'development'
-    
-    response = requests.get(
-        f'https://{hostname}/api/v2/connection',
-        params={
-            'include_secrets': 'true',
-            'connector_names': 'stripe',
-            'environment': target_environment
-        },
-        headers={
-            'Accept': 'application/json',
-            'X_REPLIT_TOKEN': x_replit_token
-        }
-    )
-    
-    data = response.json()
-    items = data.get('items', [])
-    
-    if not items:
-        raise Exception(f'Stripe {target_environment} connection not found')
-    
-    _connection_settings = items[0]
-    settings = _connection_settings.get('settings', {})
+
+def _parse_stripe_connection(connection):
+    settings = connection.get('settings', {})
     
     publishable_key = settings.get('publishable')
     secret_key = settings.get('secret')
     
     if not publishable_key or not secret_key:
-        raise Exception(f'Stripe {target_environment} keys not found')
+        raise Exception('Stripe keys not found')
     
     return {
         'publishable_key': publishable_key,
@@ -58,13 +22,68 @@ def get_stripe_credentials():
     }
 
 
+def get_stripe_credentials():
+    """Fetch Stripe credentials from Replit connection API (cached in-process)"""
+    credential = get_cached_credential('stripe', _parse_stripe_connection, get_target_environment())
+    return credential.get()
+
+
+# Object ids in API paths (cus_Nf..., cs_test_a1...), so spans group by route
+_STRIPE_ID = re.compile(r'/[a-z]+_(?=[A-Za-z0-9_]*[A-Z0-9])[A-Za-z0-9_]+')
+_traced_client_class = None
+
+
+def _stripe_operation(method, url):
+    return f"{method.upper()} {_STRIPE_ID.sub('/{id}', urlsplit(url).path)}"
+
+
+def _get_traced_client_class(stripe):
+    """RequestsClient that records each API call as a 'stripe' span, with
+    the SDK's network retries counted"""
+    global _traced_client_class
+    if _traced_client_class is None:
+        class TracedRequestsClient(stripe.RequestsClient):
+            def request_with_retries(self, method, url, headers, post_data=None, max_network_retries=None, **kwargs):
+                with tracing.span('stripe', _stripe_operation(method, url)) as span:
+                    response = super().request_with_retries(
+                        method, url, headers, post_data, max_network_retries, **kwargs
+                    )
+                    span.status = response[1]
+                return response
+
+            def request(self, method, url, headers, post_data=None, **kwargs):
+                tracing.note_attempt()
+                return super().request(method, url, headers, post_data, **kwargs)
+
+        _traced_client_class = TracedRequestsClient
+    return _traced_client_class
+
+
 def get_stripe_client():
     """Get a configured Stripe client"""
+    # Imported here rather than at module level to keep it off the startup path
+    import stripe
     credentials = get_stripe_credentials()
     stripe.api_key = credentials['secret_key']
+    # Retries reuse the request's idempotency key, so writes are safe to retry
+    stripe.max_network_retries = 2
+    # Point the SDK at a local Stripe stand-in (e.g. stripe-mock) for testing
+    api_base = os.environ.get('STRIPE_API_BASE')
+    if api_base:
+        stripe.api_base = api_base
+    traced_client = _get_traced_client_class(stripe)
+    if not isinstance(stripe.default_http_client, traced_client):
+        stripe.default_http_client = traced_client(verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy)
     return stripe
 
 
+def reset_after_fork():
+    """Make the Stripe SDK open its own HTTP connections in a forked worker"""
+    stripe = sys.modules.get('stripe')
+    if stripe is not None:
+        stripe.default_http_client = None
+
+
 def get_stripe_publishable_key():
     """Get the publishable key for frontend use"""
     credentials = get_stripe_credentials()
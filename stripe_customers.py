@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import update
+
+from models import User
+from stripe_catalog import APP_METADATA
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+# user id -> create attempts Stripe rejected with a 4xx in this process
+_rejected_attempts = {}
+_rejected_lock = threading.Lock()
+# (kind, user id, params digest) -> session create attempts Stripe rejected
+_rejected_session_attempts = {}
+# Retries of the same session request inside this window get the same session
+SESSION_KEY_WINDOW_SECONDS = 300
+
+
+def customer_idempotency_key(user_id, email=None, attempt=0):
+    """Key shared by concurrent attempts to create a user's customer, so
+    Stripe returns the same one. Stripe replays a failed request's error to
+    every retry with the same key for 24 hours. The key therefore changes
+    with the email and with each rejected attempt."""
+    email_digest = hashlib.sha256((email or '').strip().lower().encode()).hexdigest()[:12]
+    return f'soulart-customer-{user_id}-{email_digest}-{attempt}'
+
+
+def _rejected(error):
+    """True when Stripe refused the request outright (a 4xx other than a
+    concurrent-request conflict or rate limit), so no customer was created
+    and the next attempt can safely use a new key"""
+    status = getattr(error, 'http_status', None)
+    return status is not None and 400 <= status < 500 and status not in (409, 429)
+
+
+def session_idempotency_key(kind, user_id, params, attempt=0, now=None):
+    """Key for creating a checkout or billing portal session. It is the same
+    for a retried request (same user and parameters, same window), so Stripe
+    returns the session it already created instead of a second one. It
+    changes with the parameters, since Stripe rejects a key reused with
+    different ones, and with each rejected attempt."""
+    params_digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    window = int((now or time.time()) // SESSION_KEY_WINDOW_SECONDS)
+    return f'soulart-{kind}-{user_id}-{params_digest}-{window}-{attempt}'
+
+
+def create_session(kind, user_id, create, idempotency_key=None, **params):
+    """Call a Stripe session create function (`create(**params)`) with
+    session_idempotency_key, or with the client's own Idempotency-Key when
+    it sent one"""
+    if idempotency_key:
+        return create(idempotency_key=idempotency_key, **params)
+    rejected_key = (kind, user_id, json.dumps(params, sort_keys=True, default=str))
+    with _rejected_lock:
+        attempt = _rejected_session_attempts.get(rejected_key, 0)
+    try:
+        session = create(idempotency_key=session_idempotency_key(kind, user_id, params, attempt), **params)
+    except Exception as e:
+        if _rejected(e):
+            with _rejected_lock:
+                _rejected_session_attempts[rejected_key] = max(_rejected_session_attempts.get(rejected_key, 0),
+                                                               attempt + 1)
+        raise
+    with _rejected_lock:
+        _rejected_session_attempts.pop(rejected_key, None)
+    return session
+
+
+def provision_customer(db, user, stripe_client):
+    """Create the Stripe customer for a user if they don't have one yet.
+
+    Safe to run from several places at once: the idempotency key makes Stripe
+    return the same customer, and the conditional UPDATE only fills an empty
+    column. After Stripe rejects an attempt, the next one uses a new key
+    instead of replaying the cached error. Returns the customer id.
+    """
+    if user.stripe_customer_id:
+        return user.stripe_customer_id
+
+    with _rejected_lock:
+        attempt = _rejected_attempts.get(user.id, 0)
+    try:
+        customer = stripe_client.Customer.create(
+            email=user.email,
+            metadata={
+                'user_id': user.id,
+                'app': APP_METADATA
+            },
+            idempotency_key=customer_idempotency_key(user.id, user.email, attempt)
+        )
+    except Exception as e:
+        if _rejected(e):
+            with _rejected_lock:
+                _rejected_attempts[user.id] = max(_rejected_attempts.get(user.id, 0), attempt + 1)
+        raise
+    with _rejected_lock:
+        _rejected_attempts.pop(user.id, None)
+    db.session.execute(
+        update(User)
+        .where(User.id == user.id, User.stripe_customer_id.is_(None))
+        .values(stripe_customer_id=customer.id)
+    )
+    db.session.commit()
+    db.session.refresh(user)
+    return user.stripe_customer_id
+
+
+def _provision_in_app_context(app, db, user_id, get_stripe_client):
+    with app.app_context():
+        try:
+            user = db.session.get(User, user_id)
+            if user and not user.stripe_customer_id:
+                provision_customer(db, user, get_stripe_client())
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Stripe customer provisioning failed for %s: %s", user_id, e,
+                         extra={'event': 'stripe.provisioning_failed', 'user_id': user_id})
+        finally:
+            db.session.remove()
+
+
+def schedule_customer_provisioning(app, db, user_id, get_stripe_client):
+    """Create the user's Stripe customer in the background so checkout
+    only needs to create the session"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='stripe-customer')
+    return _executor.submit(_provision_in_app_context, app, db, user_id, get_stripe_client)
+
+
+def provision_missing_customers(db, stripe_client, limit=None):
+    """Backfill Stripe customers for users who don't have one. Returns (created, failed)."""
+    query = db.session.query(User).filter(
+        User.stripe_customer_id.is_(None),
+        User.email.isnot(None)
+    ).order_by(User.created_at)
+    if limit:
+        query = query.limit(limit)
+
+    created = 0
+    failed = 0
+    for user in query.all():
+        try:
+            provision_customer(db, user, stripe_client)
+            created += 1
+        except Exception as e:
+            db.session.rollback()
+            failed += 1
+            logger.error("Stripe customer provisioning failed for %s: %s", user.id, e,
+                         extra={'event': 'stripe.provisioning_failed', 'user_id': user.id})
+    return created, failed
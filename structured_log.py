@@ -0,0 +1,293 @@
+"""Structured logging that never blocks a request thread on I/O.
+
+Every module logs through the standard library: `logger =
+logging.getLogger(__name__)`. Anything passed in `extra=` becomes a JSON
+field, and `extra={'event': ...}` names the event for sampling. configure()
+puts a QueueHandler on the root logger. The calling thread only does the
+following, then enqueues the record:
+- adds the request id (from tracing) and the time since the request started
+- drops sampled-out events
+- applies the error rate limit
+- renders the message
+
+A listener thread formats each record as one JSON line and writes it to
+stdout. When the queue (LOG_QUEUE_SIZE) is full, records are dropped and
+counted rather than making the caller wait. In gunicorn preload mode the
+master starts no threads. Each worker starts its own listener after fork,
+and the master writes its own records synchronously with drain().
+
+- LOG_FORMAT: json (default) or text, for reading logs locally
+- LOG_LEVEL: INFO by default
+- LOG_SAMPLE_RATES: event=rate pairs, e.g. "http.request=0.05,stripe.webhook=0.5".
+  Warnings and errors are never sampled out.
+- LOG_ERROR_BURST / LOG_ERROR_WINDOW_SECONDS: at most this many ERROR records
+  per window for each message template. The next one to get through reports
+  how many were suppressed.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from flask import request
+
+import startup
+import tracing
+
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+ERROR_BURST = int(os.environ.get('LOG_ERROR_BURST', '5'))
+ERROR_WINDOW_SECONDS = float(os.environ.get('LOG_ERROR_WINDOW_SECONDS', '60'))
+DEFAULT_SAMPLE_RATES = 'http.request=0.1'
+
+# LogRecord attributes that are not user fields
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'event'}
+
+_handler = None
+_listener = None
+_stats_lock = threading.Lock()
+stats = {'dropped': 0, 'sampled_out': 0, 'rate_limited': 0}
+
+
+def _count(key):
+    with _stats_lock:
+        stats[key] += 1
+
+
+def _parse_rates(text):
+    rates = {}
+    for pair in text.split(','):
+        name, _, rate = pair.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_rates(os.environ.get('LOG_SAMPLE_RATES', DEFAULT_SAMPLE_RATES))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, event, message, the
+    request fields and any extra= fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None) or record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} {record.levelname:<7} " \
+               f"{record.getMessage()}"
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            line += f" [{request_id}]"
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            line += f" (+{suppressed} suppressed)"
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class ContextFilter(logging.Filter):
+    """Adds the request id and the time since the request started, in the
+    calling thread, before the record is queued"""
+
+    def filter(self, record):
+        request_id = tracing.current_request_id()
+        if request_id:
+            record.request_id = request_id
+            record.elapsed_ms = tracing.request_elapsed_ms()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps INFO and DEBUG records of a sampled event at its LOG_SAMPLE_RATES rate"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = SAMPLE_RATES.get(getattr(record, 'event', None) or record.name)
+        if rate is None or rate >= 1 or random.random() < rate:
+            if rate is not None and rate < 1:
+                record.sample_rate = rate
+            return True
+        _count('sampled_out')
+        return False
+
+
+class ErrorRateLimitFilter(logging.Filter):
+    """At most ERROR_BURST ERROR records per message template per window"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg).__name__)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= ERROR_WINDOW_SECONDS:
+                suppressed = window[2] if window else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= ERROR_BURST:
+                window[2] += 1
+                _count('rate_limited')
+                return False
+            window[1] += 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full
+    and renders the message and traceback before queueing, so nothing
+    mutable crosses threads"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count('dropped')
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+
+def _output():
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TextFormatter() if LOG_FORMAT == 'text' else JsonFormatter())
+    return stream
+
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(_handler.queue, _output(), respect_handler_level=False)
+    _listener.start()
+
+
+def drain():
+    """Write what is queued so far from the calling thread. Used by the
+    preload master, which has no listener thread: from when_ready and at
+    exit."""
+    if _handler is None or _listener is not None:
+        return
+    output = _output()
+    while True:
+        try:
+            output.handle(_handler.queue.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _stop_listener(timeout=5):
+    """Flush what is queued at exit. stop() enqueues its sentinel without
+    waiting, so first give the listener up to `timeout` seconds to make room"""
+    if _listener is None:
+        drain()
+        return
+    deadline = time.monotonic() + timeout
+    while _handler.queue.full() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    try:
+        _listener.stop()
+    except queue.Full:
+        pass
+
+
+def configure():
+    """Route every logger through the queue pipeline (idempotent)"""
+    global _handler
+    if _handler is not None:
+        return
+    _handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    _handler.addFilter(SamplingFilter())
+    _handler.addFilter(ErrorRateLimitFilter())
+    _handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL)
+    # Werkzeug's access log would duplicate http.request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # A thread running in the gunicorn master while it forks could hand a
+    # worker a lock it holds; the workers start theirs in reset_after_fork
+    if not startup.PRELOAD:
+        _start_listener()
+    atexit.register(_stop_listener)
+
+
+def reset_after_fork():
+    """Preload mode: give the freshly forked worker its own queue, so nothing
+    the master left queued is written twice, and start its listener"""
+    global _listener
+    if _handler is None:
+        return
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _listener = None
+    _start_listener()
+
+
+_access_log = logging.getLogger('http')
+
+
+def _log_request(response):
+    status = response.status_code
+    rule = request.url_rule
+    _access_log.log(
+        logging.WARNING if status >= 500 else logging.INFO,
+        '%s %s %s', request.method, request.path, status,
+        extra={'event': 'http.request', 'method': request.method,
+               'endpoint': rule.rule if rule is not None else 'unmatched', 'status': status}
+    )
+    return response
+
+
+def install(app):
+    """Access log line per request (event http.request, sampled)"""
+    app.after_request(_log_request)
+
+
+def gauges():
+    """Pipeline counters for request_metrics.render()"""
+    labels = {'pid': os.getpid()}
+    return [
+        ('soulart_log_records_dropped', 'Log records dropped because the queue was full, since start.',
+         [(labels, stats['dropped'])]),
+        ('soulart_log_records_sampled_out', 'Log records skipped by LOG_SAMPLE_RATES, since start.',
+         [(labels, stats['sampled_out'])]),
+        ('soulart_log_errors_rate_limited', 'ERROR records suppressed by the rate limit, since start.',
+         [(labels, stats['rate_limited'])]),
+        ('soulart_log_queue_depth', 'Log records waiting to be written.',
+         [(labels, _handler.queue.qsize() if _handler is not None else 0)]),
+    ]
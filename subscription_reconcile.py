@@ -0,0 +1,196 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from models import User, TIER_FREE, TIER_BASIC, TIER_PREMIUM
+from stripe_catalog import APP_METADATA, resolve_tier, stripe_field, upsert_price, upsert_product
+
+logger = logging.getLogger(__name__)
+
+# Rows per batched UPDATE / commit
+CHUNK_SIZE = 1000
+
+ACTIVE_STATUSES = ('active', 'trialing')
+# Left alone, matching handle_subscription_updated: Stripe is still retrying payment
+GRACE_STATUSES = ('past_due', 'unpaid')
+
+
+def _period_end(subscription):
+    """current_period_end moved onto subscription items in newer API versions"""
+    period_end = stripe_field(subscription, 'current_period_end')
+    if period_end is None:
+        items = stripe_field(stripe_field(subscription, 'items', {}), 'data', [])
+        if items:
+            period_end = stripe_field(items[0], 'current_period_end')
+    return datetime.fromtimestamp(period_end) if period_end else None
+
+
+def _subscription_price(subscription):
+    items = stripe_field(stripe_field(subscription, 'items', {}), 'data', [])
+    return stripe_field(items[0], 'price', {}) if items else {}
+
+
+def _tier_from_stripe(db, stripe_client, price, fetched):
+    """Tier for a price the local index does not know: fetch the price and
+    its product from Stripe (once per run) and add them to the index.
+    Returns None when Stripe has no tier for it either."""
+    price_id = stripe_field(price, 'id')
+    if not price_id:
+        return None
+    if price_id not in fetched:
+        try:
+            full_price = stripe_client.Price.retrieve(price_id, expand=['product'])
+            product = stripe_field(full_price, 'product')
+            if isinstance(product, str):
+                product = stripe_client.Product.retrieve(product)
+            upsert_product(db, product)
+            upsert_price(db, full_price)
+            db.session.flush()
+            fetched[price_id] = resolve_tier(db, full_price)
+        except Exception as e:
+            logger.error("Could not resolve the tier of price %s: %s", price_id, e,
+                         extra={'event': 'stripe.reconcile_tier_error'})
+            fetched[price_id] = None
+    return fetched[price_id]
+
+
+def collect_stripe_state(db, stripe_client, page_size=100):
+    """Page through every subscription of a SoulArt customer and return the
+    subscription that should drive each customer's membership.
+
+    Customers are expanded inline so each page is a single request. Active
+    subscriptions win over others; ties go to the latest period end. A tier
+    that cannot be resolved, locally or from Stripe, is left as None.
+    """
+    state = {}
+    fetched = {}
+    subscriptions = stripe_client.Subscription.list(
+        status='all',
+        limit=page_size,
+        expand=['data.customer']
+    ).auto_paging_iter()
+
+    for subscription in subscriptions:
+        customer = stripe_field(subscription, 'customer')
+        if isinstance(customer, str) or customer is None:
+            continue
+        if stripe_field(stripe_field(customer, 'metadata', {}), 'app') != APP_METADATA:
+            continue
+
+        status = stripe_field(subscription, 'status')
+        price = _subscription_price(subscription)
+        tier = resolve_tier(db, price) or _tier_from_stripe(db, stripe_client, price, fetched)
+        candidate = {
+            'subscription_id': stripe_field(subscription, 'id'),
+            'status': status,
+            'tier': {'premium': TIER_PREMIUM, 'basic': TIER_BASIC}.get(tier),
+            'expires_at': _period_end(subscription)
+        }
+
+        customer_id = stripe_field(customer, 'id')
+        current = state.get(customer_id)
+        if current is None or _rank(candidate) > _rank(current):
+            state[customer_id] = candidate
+    return state
+
+
+def _rank(candidate):
+    status = candidate['status']
+    if status in ACTIVE_STATUSES:
+        priority = 2
+    elif status in GRACE_STATUSES:
+        priority = 1
+    else:
+        priority = 0
+    return priority, candidate['expires_at'] or datetime.min
+
+
+def _desired_changes(user, candidate):
+    """Column changes that bring one users row in line with Stripe"""
+    if candidate is None or candidate['status'] not in ACTIVE_STATUSES + GRACE_STATUSES:
+        if user.subscription_tier == TIER_FREE and not user.is_member and user.stripe_subscription_id is None:
+            return {}
+        return {'subscription_tier': TIER_FREE, 'is_member': False, 'stripe_subscription_id': None}
+
+    if candidate['status'] in GRACE_STATUSES:
+        return {}
+
+    desired = {
+        'subscription_tier': candidate['tier'],
+        'is_member': True,
+        'stripe_subscription_id': candidate['subscription_id'],
+        'subscription_expires_at': candidate['expires_at']
+    }
+    return {key: value for key, value in desired.items() if getattr(user, key) != value}
+
+
+def reconcile_subscriptions(db, stripe_client, dry_run=False, chunk_size=CHUNK_SIZE):
+    """Diff every Stripe customer's subscription against the users table and
+    apply corrections with batched UPDATEs. Returns a report dict."""
+    started = datetime.utcnow()
+    state = collect_stripe_state(db, stripe_client)
+    # Prices fetched from Stripe while resolving tiers stay in the index
+    db.session.commit()
+    fetched_at = datetime.utcnow()
+
+    columns = (
+        User.id,
+        User.stripe_customer_id,
+        User.subscription_tier,
+        User.stripe_subscription_id,
+        User.subscription_expires_at,
+        User.is_member
+    )
+    users = db.session.execute(
+        select(*columns).where(User.stripe_customer_id.isnot(None))
+    ).all()
+
+    changes = []
+    summary = {'upgraded': 0, 'downgraded': 0, 'tier_changed': 0, 'expiry_changed': 0, 'other': 0,
+               'unresolved': 0}
+    unresolved = []
+    for user in users:
+        candidate = state.get(user.stripe_customer_id)
+        if candidate and candidate['status'] in ACTIVE_STATUSES and candidate['tier'] is None:
+            # Never guess: a premium member must not be downgraded because
+            # the catalog is stale. Left for the next run.
+            summary['unresolved'] += 1
+            unresolved.append({'id': user.id, 'subscription_id': candidate['subscription_id']})
+            continue
+        diff = _desired_changes(user, candidate)
+        if not diff:
+            continue
+        new_tier = diff.get('subscription_tier', user.subscription_tier)
+        if user.subscription_tier == TIER_FREE and new_tier != TIER_FREE:
+            summary['upgraded'] += 1
+        elif user.subscription_tier != TIER_FREE and new_tier == TIER_FREE:
+            summary['downgraded'] += 1
+        elif new_tier != user.subscription_tier:
+            summary['tier_changed'] += 1
+        elif 'subscription_expires_at' in diff:
+            summary['expiry_changed'] += 1
+        else:
+            summary['other'] += 1
+        changes.append({'id': user.id, 'before_tier': user.subscription_tier, **diff})
+
+    if not dry_run:
+        for i in range(0, len(changes), chunk_size):
+            chunk = changes[i:i + chunk_size]
+            db.session.execute(update(User), [
+                {key: value for key, value in change.items() if key != 'before_tier'}
+                for change in chunk
+            ])
+            db.session.commit()
+
+    return {
+        'dry_run': dry_run,
+        'stripe_customers': len(state),
+        'users_checked': len(users),
+        'users_changed': len(changes),
+        'summary': summary,
+        'changes': changes,
+        'unresolved': unresolved,
+        'fetch_seconds': (fetched_at - started).total_seconds(),
+        'total_seconds': (datetime.utcnow() - started).total_seconds()
+    }
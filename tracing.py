@@ -0,0 +1,197 @@
+"""Timed spans around outbound calls (OpenAI, Stripe, Google Drive, the
+Replit connectors API), linked to the inbound request id.
+
+Every inbound request gets an id, taken from a valid X-Request-ID header or
+generated, and the id is echoed in the response. Each outbound call made
+while serving it is recorded as a span with:
+- dependency, operation and status
+- retries, counted from the HTTP attempts the client actually made
+- duration
+
+Spans go to a ring buffer and to the per-dependency histograms in
+request_metrics. Calls slower than SLOW_CALL_SECONDS are also logged. A
+request that made outbound calls reports their total time per dependency in
+a Server-Timing header.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import request
+
+from request_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SPAN_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '2000'))
+SLOW_CALL_SECONDS = float(os.environ.get('SLOW_CALL_SECONDS', '1.0'))
+SLOW_LOG_SIZE = 200
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{8,64}$')
+
+spans = deque(maxlen=SPAN_BUFFER_SIZE)
+slow_calls = deque(maxlen=SLOW_LOG_SIZE)
+_local = threading.local()
+
+
+class Span:
+    __slots__ = ('dependency', 'operation', 'request_id', 'started_at', 'duration', 'status', 'attempts', 'error')
+
+    def __init__(self, dependency, operation, request_id):
+        self.dependency = dependency
+        self.operation = operation
+        self.request_id = request_id
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.status = None
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def retries(self):
+        return max(self.attempts - 1, 0)
+
+    @property
+    def outcome(self):
+        if self.error or (isinstance(self.status, int) and self.status >= 400):
+            return 'error'
+        return 'ok'
+
+    def to_dict(self):
+        return {
+            'dependency': self.dependency,
+            'operation': self.operation,
+            'request_id': self.request_id,
+            'started_at': datetime.utcfromtimestamp(self.started_at).isoformat() + 'Z',
+            'duration_ms': round(self.duration * 1000, 3),
+            'status': self.status,
+            'outcome': self.outcome,
+            'retries': self.retries,
+            'error': self.error
+        }
+
+
+def current_request_id():
+    return getattr(_local, 'request_id', None)
+
+
+def request_elapsed_ms():
+    """Milliseconds since this thread's request started"""
+    started = getattr(_local, 'request_started', None)
+    return round((time.perf_counter() - started) * 1000, 3) if started is not None else None
+
+
+def start_request():
+    """before_request hook: adopt or create this request's id"""
+    incoming = request.headers.get('X-Request-ID', '')
+    _local.request_id = incoming if _REQUEST_ID.match(incoming) else os.urandom(8).hex()
+    _local.request_started = time.perf_counter()
+    _local.dependency_seconds = None
+
+
+def finish_request(response):
+    """after_request hook: echo the request id and report outbound time"""
+    request_id = getattr(_local, 'request_id', None)
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    totals = getattr(_local, 'dependency_seconds', None)
+    if totals:
+        response.headers.add('Server-Timing', ', '.join(
+            f'{dependency};dur={seconds * 1000:.1f}' for dependency, seconds in totals.items()
+        ))
+    return response
+
+
+def end_request(exc):
+    _local.request_id = None
+    _local.request_started = None
+    _local.dependency_seconds = None
+
+
+def _record(span):
+    spans.append(span)
+    metrics.record_dependency(span.dependency, span.operation, span.outcome, span.duration, span.retries)
+    if span.request_id:
+        totals = getattr(_local, 'dependency_seconds', None)
+        if totals is None:
+            totals = _local.dependency_seconds = {}
+        totals[span.dependency] = totals.get(span.dependency, 0.0) + span.duration
+    if span.duration >= SLOW_CALL_SECONDS:
+        slow_calls.append(span)
+        logger.warning("Slow %s call %s: %.0f ms, status %s, retries %s", span.dependency, span.operation,
+                       span.duration * 1000, span.status, span.retries,
+                       extra={'event': 'dependency.slow_call', 'dependency': span.dependency,
+                              'operation': span.operation, 'duration_ms': round(span.duration * 1000, 3),
+                              'dependency_status': span.status, 'retries': span.retries})
+
+
+@contextmanager
+def span(dependency, operation):
+    """Time one logical outbound call. Set .status on the yielded span; HTTP
+    attempts made inside it are counted through note_attempt()."""
+    current = Span(dependency, operation, current_request_id())
+    parent = getattr(_local, 'span', None)
+    _local.span = current
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = type(e).__name__
+        if current.status is None:
+            current.status = getattr(e, 'status_code', None) or getattr(e, 'http_status', None)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _local.span = parent
+        if current.attempts == 0:
+            current.attempts = 1
+        _record(current)
+
+
+def note_attempt(*args, **kwargs):
+    """Count one HTTP attempt against the innermost open span (usable as an
+    httpx event hook)"""
+    current = getattr(_local, 'span', None)
+    if current is not None:
+        current.attempts += 1
+
+
+def install(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
+
+
+def recent_spans(request_id=None, dependency=None, limit=100):
+    selected = [s for s in list(spans)
+                if (request_id is None or s.request_id == request_id)
+                and (dependency is None or s.dependency == dependency)]
+    return [s.to_dict() for s in selected[-limit:]][::-1]
+
+
+def dependency_summary():
+    """Per dependency and operation over the ring buffer: calls, errors,
+    retries and latency percentiles"""
+    grouped = {}
+    for s in list(spans):
+        grouped.setdefault((s.dependency, s.operation), []).append(s)
+    summary = []
+    for (dependency, operation), group in sorted(grouped.items()):
+        durations = sorted(s.duration * 1000 for s in group)
+        pick = lambda q: round(durations[min(len(durations) - 1, int(q * len(durations)))], 3)
+        summary.append({
+            'dependency': dependency,
+            'operation': operation,
+            'calls': len(group),
+            'errors': sum(1 for s in group if s.outcome == 'error'),
+            'retries': sum(s.retries for s in group),
+            'p50_ms': pick(0.50),
+            'p95_ms': pick(0.95),
+            'max_ms': round(durations[-1], 3)
+        })
+    return summary
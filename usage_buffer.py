@@ -0,0 +1,218 @@
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import date
+
+from sqlalchemy import bindparam, case, insert, or_, update
+
+from models import GuideUsageEvent, User
+
+logger = logging.getLogger(__name__)
+
+# Off by default: every increment is written and committed immediately
+WRITE_BEHIND_ENABLED = os.environ.get('USAGE_WRITE_BEHIND') == '1'
+# Flush at least this often...
+FLUSH_INTERVAL_SECONDS = float(os.environ.get('USAGE_FLUSH_INTERVAL', '2'))
+# ...or as soon as this many users have pending increments
+FLUSH_MAX_PENDING = int(os.environ.get('USAGE_FLUSH_MAX_PENDING', '500'))
+
+users_table = User.__table__
+
+
+class UsageBuffer:
+    """Per-process buffer of usage increments for unlimited counters.
+
+    Only counters that never block a request are buffered (decoder uses of
+    paid members, premium Guide messages and tokens, and the Guide metering
+    events and daily rollups behind them). Limited counters - free member and
+    guest decoder uses - stay on the atomic path in quota.py. Reads that feed
+    enforcement (the Guide token budget) add this process's pending delta to
+    the value on the loaded user row.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decoder = defaultdict(int)
+        # (user_id, day) -> [messages, tokens]
+        self._guide = defaultdict(lambda: [0, 0])
+        # GuideUsageEvent rows, and (user_id, day) -> GuideUsageDaily increments
+        self._metering_events = []
+        self._metering_daily = {}
+        # Guide increments being written by a flush, still counted by reads
+        self._flushing_guide = {}
+        self._wake = threading.Event()
+        self.flushes = 0
+        self.rows_flushed = 0
+        # Guide increments for a day older than the user's counters (see flush)
+        self.stale_guide_increments = 0
+
+    def add_decoder_use(self, user_id, count=1):
+        with self._lock:
+            self._decoder[user_id] += count
+            size = len(self._decoder) + len(self._guide)
+        if size >= FLUSH_MAX_PENDING:
+            self._wake.set()
+
+    def add_guide(self, user_id, messages=0, tokens=0, day=None):
+        with self._lock:
+            pending = self._guide[(user_id, day or date.today())]
+            pending[0] += messages
+            pending[1] += tokens
+            size = len(self._decoder) + len(self._guide)
+        if size >= FLUSH_MAX_PENDING:
+            self._wake.set()
+
+    def add_guide_metering(self, event, daily):
+        """Queue one GuideUsageEvent row and its daily rollup increment
+        (dicts of column values, as guide_metering builds them)"""
+        with self._lock:
+            self._metering_events.append(event)
+            self._merge_daily(daily)
+            size = len(self._decoder) + len(self._guide) + len(self._metering_daily)
+        if size >= FLUSH_MAX_PENDING:
+            self._wake.set()
+
+    def _merge_daily(self, daily):
+        """Called with the lock held"""
+        key = (daily['user_id'], daily['usage_date'])
+        pending = self._metering_daily.get(key)
+        if pending is None:
+            self._metering_daily[key] = dict(daily)
+            return
+        for column, value in daily.items():
+            if column not in ('user_id', 'usage_date', 'subscription_tier'):
+                pending[column] += value
+        pending['subscription_tier'] = daily['subscription_tier']
+
+    def pending_guide_tokens(self, user_id, day=None):
+        key = (user_id, day or date.today())
+        with self._lock:
+            pending = self._guide.get(key)
+            flushing = self._flushing_guide.get(key)
+            return (pending[1] if pending else 0) + (flushing[1] if flushing else 0)
+
+    def pending_decoder_uses(self, user_id):
+        with self._lock:
+            return self._decoder.get(user_id, 0)
+
+    def _swap(self):
+        with self._lock:
+            decoder, self._decoder = self._decoder, defaultdict(int)
+            guide, self._guide = self._guide, defaultdict(lambda: [0, 0])
+            events, self._metering_events = self._metering_events, []
+            daily, self._metering_daily = self._metering_daily, {}
+            self._flushing_guide = guide
+        return decoder, guide, events, daily
+
+    def _restore(self, decoder, guide, events, daily):
+        with self._lock:
+            self._flushing_guide = {}
+            for user_id, count in decoder.items():
+                self._decoder[user_id] += count
+            for key, (messages, tokens) in guide.items():
+                pending = self._guide[key]
+                pending[0] += messages
+                pending[1] += tokens
+            self._metering_events[:0] = events
+            for row in daily.values():
+                self._merge_daily(row)
+
+    def flush(self, db):
+        """Write all pending increments in batched statements and one commit.
+        On failure the increments are put back for the next flush."""
+        decoder, guide, events, daily = self._swap()
+        if not decoder and not guide and not events:
+            return 0
+        try:
+            if decoder:
+                db.session.execute(
+                    update(users_table)
+                    .where(users_table.c.id == bindparam('b_id'))
+                    .values(decoder_total_uses=users_table.c.decoder_total_uses + bindparam('b_count')),
+                    [{'b_id': user_id, 'b_count': count} for user_id, count in decoder.items()]
+                )
+            stale = 0
+            if guide:
+                # The counters hold a single day. An increment buffered before
+                # midnight that reaches a row already counting a later day has
+                # nothing left to add to, so the WHERE skips it; it is still in
+                # the GuideUsageDaily rollup. Skipped rows are counted and logged.
+                is_same_day = users_table.c.guide_last_message_date == bindparam('b_day')
+                result = db.session.execute(
+                    update(users_table)
+                    .where(
+                        users_table.c.id == bindparam('b_id'),
+                        or_(users_table.c.guide_last_message_date.is_(None),
+                            users_table.c.guide_last_message_date <= bindparam('b_day'))
+                    )
+                    .values(
+                        guide_messages_today=case(
+                            (is_same_day, users_table.c.guide_messages_today), else_=0
+                        ) + bindparam('b_messages'),
+                        guide_tokens_today=case(
+                            (is_same_day, users_table.c.guide_tokens_today), else_=0
+                        ) + bindparam('b_tokens'),
+                        guide_last_message_date=bindparam('b_day')
+                    ),
+                    [{'b_id': user_id, 'b_day': day, 'b_messages': messages, 'b_tokens': tokens}
+                     for (user_id, day), (messages, tokens) in guide.items()]
+                )
+                if result.rowcount >= 0:
+                    stale = len(guide) - result.rowcount
+            if events:
+                # Imported here: guide_metering imports quota, which imports this module
+                from guide_metering import upsert_daily_usage
+                db.session.execute(insert(GuideUsageEvent), events)
+                upsert_daily_usage(db, list(daily.values()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._restore(decoder, guide, events, daily)
+            raise
+        with self._lock:
+            self._flushing_guide = {}
+        if stale:
+            self.stale_guide_increments += stale
+            logger.warning("Skipped %s Guide counter increments for an earlier day", stale,
+                           extra={'event': 'usage.stale_guide_increments', 'count': stale})
+        rows = len(decoder) + len(guide) + len(events) + len(daily)
+        self.flushes += 1
+        self.rows_flushed += rows
+        return rows
+
+    def wait_for_flush(self, timeout):
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+
+buffer = UsageBuffer()
+_flusher_started = False
+
+
+def _flush_in_app_context(app, db):
+    with app.app_context():
+        try:
+            buffer.flush(db)
+        except Exception as e:
+            logger.error("Usage buffer flush failed: %s", e, extra={'event': 'usage.flush_failed'})
+        finally:
+            db.session.remove()
+
+
+def start_flusher(app, db):
+    """Start the background flush thread and flush on interpreter exit, so a
+    gracefully stopped worker loses no increments"""
+    global _flusher_started
+    if not WRITE_BEHIND_ENABLED or _flusher_started:
+        return
+    _flusher_started = True
+
+    def run():
+        while True:
+            buffer.wait_for_flush(FLUSH_INTERVAL_SECONDS)
+            _flush_in_app_context(app, db)
+
+    threading.Thread(target=run, name='usage-buffer-flush', daemon=True).start()
+    atexit.register(_flush_in_app_context, app, db)
@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, exists, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from models import StripeWebhookEvent, WEBHOOK_PENDING, WEBHOOK_PROCESSED, WEBHOOK_DEAD
+
+logger = logging.getLogger(__name__)
+
+# Attempts before an event is dead-lettered
+MAX_ATTEMPTS = int(os.environ.get('STRIPE_WEBHOOK_MAX_ATTEMPTS', '8'))
+# Events read per drain pass
+BATCH_SIZE = 200
+# The worker also polls on this interval in case a wake-up was missed
+POLL_INTERVAL_SECONDS = 5
+# Postgres advisory lock so only one worker process drains at a time
+ADVISORY_LOCK_KEY = 727_104_029
+# Days processed events are kept. The id is what dedupes redeliveries, and
+# Stripe stops redelivering an event after three days.
+PROCESSED_RETENTION_DAYS = int(os.environ.get('STRIPE_WEBHOOK_RETENTION_DAYS', '30'))
+# Dead-lettered events are kept longer so they can still be replayed
+DEAD_RETENTION_DAYS = int(os.environ.get('STRIPE_WEBHOOK_DEAD_RETENTION_DAYS', '90'))
+# How often the worker purges old events
+PURGE_INTERVAL_SECONDS = 3600
+
+_wake = threading.Event()
+_worker_started = False
+
+
+def parse_event(payload, sig_header, webhook_secret):
+    """Verify the signature (when a secret is configured) and decode the event"""
+    if webhook_secret:
+        import stripe
+        stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
+    return json.loads(payload)
+
+
+def event_customer_id(event):
+    """Customer an event belongs to; events are applied in order per customer"""
+    obj = event.get('data', {}).get('object') or {}
+    customer = obj.get('customer')
+    if isinstance(customer, dict):
+        customer = customer.get('id')
+    if not customer and obj.get('object') == 'customer':
+        customer = obj.get('id')
+    return customer
+
+
+def enqueue_event(db, event, payload):
+    """Store a verified event in the inbox. Returns False for a redelivery."""
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    db.session.add(StripeWebhookEvent(
+        id=event['id'],
+        event_type=event.get('type', ''),
+        customer_id=event_customer_id(event),
+        payload=payload,
+        stripe_created=event.get('created') or 0
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    wake_worker()
+    return True
+
+
+def retry_delay(attempts):
+    """Exponential back-off: 10s, 20s, 40s ... capped at one hour"""
+    return timedelta(seconds=min(10 * 2 ** (attempts - 1), 3600))
+
+
+def drain_inbox(db, dispatch, limit=BATCH_SIZE):
+    """Process due pending events, oldest first.
+
+    An event is skipped while an earlier event for the same customer is still
+    waiting for a retry, so each customer's events are applied in order. The
+    event is marked processed in the same transaction as the handler's own
+    writes, so a crash mid-way leaves it pending rather than half-applied.
+    Returns (processed, failed).
+    """
+    now = datetime.utcnow()
+    # Due events only, and none queued behind an earlier event of the same
+    # customer that is still backing off. Filtering in SQL rather than in the
+    # loop keeps a batch's worth of backing-off events from hiding newer ones.
+    earlier = aliased(StripeWebhookEvent)
+    waiting_behind_retry = exists().where(
+        earlier.customer_id == StripeWebhookEvent.customer_id,
+        earlier.status == WEBHOOK_PENDING,
+        earlier.next_attempt_at > now,
+        or_(
+            earlier.stripe_created < StripeWebhookEvent.stripe_created,
+            and_(earlier.stripe_created == StripeWebhookEvent.stripe_created,
+                 earlier.received_at < StripeWebhookEvent.received_at)
+        )
+    )
+    rows = db.session.query(StripeWebhookEvent).filter(
+        StripeWebhookEvent.status == WEBHOOK_PENDING,
+        StripeWebhookEvent.next_attempt_at <= now,
+        ~waiting_behind_retry
+    ).order_by(
+        StripeWebhookEvent.stripe_created,
+        StripeWebhookEvent.received_at
+    ).limit(limit).all()
+
+    blocked = set()
+    processed = 0
+    failed = 0
+    for row in rows:
+        event_id = row.id
+        customer_id = row.customer_id
+        # An earlier event of this customer failed in this pass
+        if customer_id and customer_id in blocked:
+            continue
+
+        event = json.loads(row.payload)
+        row.status = WEBHOOK_PROCESSED
+        row.processed_at = datetime.utcnow()
+        row.attempts += 1
+        try:
+            dispatch(event.get('type', ''), event.get('data', {}).get('object') or {})
+            db.session.commit()
+            processed += 1
+        except Exception as e:
+            db.session.rollback()
+            row = db.session.get(StripeWebhookEvent, event_id)
+            row.attempts += 1
+            row.last_error = str(e)[:2000]
+            if row.attempts >= MAX_ATTEMPTS:
+                row.status = WEBHOOK_DEAD
+                logger.error("Webhook event %s dead-lettered after %s attempts: %s", event_id, row.attempts, e,
+                             extra={'event': 'stripe.webhook_dead_lettered', 'stripe_event_id': event_id})
+            else:
+                row.next_attempt_at = now + retry_delay(row.attempts)
+                if customer_id:
+                    blocked.add(customer_id)
+            db.session.commit()
+            failed += 1
+    return processed, failed
+
+
+def _try_advisory_lock(db):
+    """Returns (connection or None, acquired)"""
+    if db.engine.dialect.name != 'postgresql':
+        return None, True
+    conn = db.engine.connect()
+    acquired = conn.execute(select(func.pg_try_advisory_lock(ADVISORY_LOCK_KEY))).scalar()
+    conn.commit()
+    if not acquired:
+        conn.close()
+        return None, False
+    return conn, True
+
+
+def drain_until_idle(db, dispatch):
+    """Drain repeatedly until a pass makes no progress. Only one process
+    drains at a time; others return (0, 0) immediately."""
+    conn, acquired = _try_advisory_lock(db)
+    if not acquired:
+        return 0, 0
+    total_processed = 0
+    total_failed = 0
+    try:
+        while True:
+            processed, failed = drain_inbox(db, dispatch)
+            total_processed += processed
+            total_failed += failed
+            if processed == 0:
+                break
+    finally:
+        if conn is not None:
+            conn.execute(select(func.pg_advisory_unlock(ADVISORY_LOCK_KEY)))
+            conn.commit()
+            conn.close()
+    return total_processed, total_failed
+
+
+def purge_old_events(db, now=None):
+    """Delete processed events past PROCESSED_RETENTION_DAYS and dead ones
+    past DEAD_RETENTION_DAYS. Pending events are never purged. Returns the
+    number of rows deleted."""
+    now = now or datetime.utcnow()
+    deleted = db.session.query(StripeWebhookEvent).filter(
+        StripeWebhookEvent.status == WEBHOOK_PROCESSED,
+        StripeWebhookEvent.processed_at < now - timedelta(days=PROCESSED_RETENTION_DAYS)
+    ).delete(synchronize_session=False)
+    deleted += db.session.query(StripeWebhookEvent).filter(
+        StripeWebhookEvent.status == WEBHOOK_DEAD,
+        StripeWebhookEvent.received_at < now - timedelta(days=DEAD_RETENTION_DAYS)
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        logger.info("Purged %s old webhook inbox events", deleted, extra={'event': 'stripe.webhook_inbox_purged'})
+    return deleted
+
+
+def wake_worker():
+    _wake.set()
+
+
+def start_worker(app, db, dispatch):
+    """Start the in-process inbox worker thread (STRIPE_WEBHOOK_WORKER=0 disables)"""
+    global _worker_started
+    if _worker_started or os.environ.get('STRIPE_WEBHOOK_WORKER', '1') == '0':
+        return
+    _worker_started = True
+
+    def run():
+        last_purge = 0
+        while True:
+            _wake.wait(POLL_INTERVAL_SECONDS)
+            _wake.clear()
+            with app.app_context():
+                try:
+                    drain_until_idle(db, dispatch)
+                    if time.monotonic() - last_purge >= PURGE_INTERVAL_SECONDS:
+                        last_purge = time.monotonic()
+                        purge_old_events(db)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.exception("Webhook inbox worker error: %s", e, extra={'event': 'stripe.webhook_worker_error'})
+                finally:
+                    db.session.remove()
+
+    threading.Thread(target=run, name='stripe-webhook-inbox', daemon=True).start()
+
+
+def replay_events(db, event_ids=None, dead=False):
+    """Reset events to pending so the worker processes them again"""
+    query = db.session.query(StripeWebhookEvent)
+    if event_ids:
+        query = query.filter(StripeWebhookEvent.id.in_(event_ids))
+    elif dead:
+        query = query.filter(StripeWebhookEvent.status == WEBHOOK_DEAD)
+    else:
+        return 0
+    count = 0
+    for row in query:
+        row.status = WEBHOOK_PENDING
+        row.attempts = 0
+        row.last_error = None
+        row.next_attempt_at = datetime.utcnow()
+        row.processed_at = None
+        count += 1
+    db.session.commit()
+    wake_worker()
+    return count
+
+
+def inbox_stats(db):
+    counts = dict(db.session.query(
+        StripeWebhookEvent.status,
+        func.count(StripeWebhookEvent.id)
+    ).group_by(StripeWebhookEvent.status).all())
+    oldest_pending = db.session.query(func.min(StripeWebhookEvent.received_at)).filter(
+        StripeWebhookEvent.status == WEBHOOK_PENDING
+    ).scalar()
+    return {
+        'pending': counts.get(WEBHOOK_PENDING, 0),
+        'processed': counts.get(WEBHOOK_PROCESSED, 0),
+        'dead': counts.get(WEBHOOK_DEAD, 0),
+        'oldest_pending_age_seconds': (datetime.utcnow() - oldest_pending).total_seconds() if oldest_pending else None
+    }